@@ -0,0 +1,262 @@
+"""
+This module measures the throughput of the marketplace on generated workloads
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "test-gen"))
+
+# pylint: disable=wrong-import-position
+import test_generator
+from tema.engines import ENGINES, run_market
+from tema.log_config import configure_logging, LOG_MODES
+from tema.persistence import WriteAheadLog, recover
+from tema.scenario import resolve_market_config
+from tema.selection import SELECTION_POLICIES
+
+MEASURED_OPERATIONS = ['publish_many', 'add_to_cart', 'remove_from_cart', 'place_order']
+WAL_MODES = ['off', 'async', 'sync']  # no write-ahead log, or one with or without sync
+
+
+def parse_args():
+    """
+        Parse the command line: the values to sweep and the run options
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--producers", type=int, nargs='+', default=[1, 5, 20],
+                        help="producer counts to sweep")
+    parser.add_argument("--consumers", type=int, nargs='+', default=[10, 50, 200],
+                        help="consumer counts to sweep")
+    parser.add_argument("--products", type=int, nargs='+', default=[2, 10],
+                        help="product counts to sweep")
+    parser.add_argument("--queue-sizes", type=int, nargs='+', default=[10, 40],
+                        help="queue_size_per_producer values to sweep")
+    parser.add_argument("--carts", type=int, nargs=2, default=[1, 5], metavar=("MIN", "MAX"),
+                        help="number of carts per consumer")
+    parser.add_argument("--basic", action="store_true",
+                        help="generate basic workloads (fewer, smaller cart operations)")
+    parser.add_argument("--selection", choices=SELECTION_POLICIES, nargs='+',
+                        default=["first-fit"], help="selection policies to sweep")
+    parser.add_argument("--wal", choices=WAL_MODES, nargs='+', default=["off"],
+                        help="write-ahead log modes to sweep; the runs with a log also "
+                             "measure how long recovering it takes")
+    parser.add_argument("--engine", choices=ENGINES, default="threads")
+    parser.add_argument("--blocking", action="store_true",
+                        help="producers and consumers wait in the marketplace for room/stock")
+    parser.add_argument("--log", choices=LOG_MODES, default="off",
+                        help="marketplace trace mode during the runs")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs of every configuration")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds after which a run is abandoned")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json",
+                        help="JSON file the results are written to")
+
+    args = parser.parse_args()
+    if args.engine == "processes":
+        parser.error("the processes engine does not collect metrics, it cannot be benchmarked")
+    if args.blocking and args.engine == "sim":
+        parser.error("--blocking is not supported by the sim engine")
+    if args.wal != ["off"] and args.engine not in ("threads", "sim"):
+        parser.error("--wal is only supported by the threads and sim engines")
+    return args
+
+
+def generate_workload(num_producers, num_consumers, num_products, queue_size,
+                      min_carts, max_carts, basic, seed):
+    """
+    Generates a market configuration, in the tests/*.in format, with test_generator
+    and sets every production time and retry wait to zero.
+
+    A producer whose buffer is full of one product cannot publish its others, so with
+    enough demand the generated scenarios can deadlock. Here every producer keeps a single
+    product (assigned round-robin): a full buffer then means that product is in stock.
+    """
+    # pylint: disable=too-many-arguments
+    random.seed(seed)
+
+    products = test_generator.generate_products(num_products)
+    producers = test_generator.generate_producers(num_producers, products, basic)
+
+    product_ids = list(products.keys())
+    for product in products.values():
+        product["is_produced"] = False
+    for idx, producer in enumerate(producers):
+        prod_id = product_ids[idx % len(product_ids)]
+        producer["products"] = [[prod_id] + producer["products"][0][1:]]
+        products[prod_id]["is_produced"] = True
+
+    for prod_id in list(products.keys()):
+        if not products[prod_id]["is_produced"]:
+            del products[prod_id]
+    consumers = test_generator.generate_consumers(num_consumers, products,
+                                                  min_carts, max_carts,
+                                                  has_remove_operation=True,
+                                                  basic_test=basic)
+
+    for product in products.values():
+        del product["is_produced"]
+
+    for producer in producers:
+        producer["republish_wait_time"] = 0
+        producer["products"] = [[prod_id, quantity, 0]
+                                for prod_id, quantity, _ in producer["products"]]
+
+    for consumer in consumers:
+        consumer["retry_wait_time"] = 0
+        consumer["carts"] = [cart["ops"] for cart in consumer["carts"]]
+
+    return {"products": products, "producers": producers, "consumers": consumers,
+            "marketplace": test_generator.generate_marketplace(queue_size)}
+
+
+def run_workload(market_config, engine, blocking, log_mode, selection, wal_mode, results):
+    """
+    Runs a workload with metrics enabled, in a worker process, and sends its measurements
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    configure_logging(log_mode, filename=os.devnull, max_bytes=0)
+    resolve_market_config(market_config)
+    market_config['marketplace']['metrics'] = True
+    market_config['marketplace']['selection'] = selection
+    wal_directory = None
+    if wal_mode != 'off':
+        wal_directory = tempfile.mkdtemp(prefix='wal')
+        market_config['marketplace']['wal'] = WriteAheadLog(wal_directory,
+                                                            sync=wal_mode == 'sync')
+
+    printed = io.StringIO()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(printed):
+        marketplace = run_market(engine, market_config, blocking)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    wal = {}
+    if wal_directory is not None:
+        # without the snapshot close() writes, recovery replays the whole last segment
+        marketplace.wal.flush()
+        wal['wal_bytes'] = sum(os.path.getsize(os.path.join(wal_directory, filename))
+                               for filename in os.listdir(wal_directory))
+        recover_start = time.perf_counter()
+        _, wal['wal_records'] = recover(wal_directory)
+        wal['recover_s'] = time.perf_counter() - recover_start
+        marketplace.wal.close()
+        shutil.rmtree(wal_directory)
+
+    # every unit bought is printed on its own line
+    units = printed.getvalue().count('\n')
+
+    snapshot = marketplace.metrics_snapshot()
+    latency = {name: {key: snapshot['latency'][name][key]
+                      for key in ('count', 'p50_us', 'p99_us')}
+               for name in MEASURED_OPERATIONS}
+    # the failed attempts are counted by the latency histograms too, leave them out
+    retries = snapshot['retries']
+    operations = sum(stats['count'] for stats in latency.values()) \
+        - retries.get('publish', 0) - retries.get('add_to_cart', 0)
+
+    results.put({
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'units_bought': units,
+        'units_per_s': units / wall if wall else 0,
+        'operations': operations,
+        'ops_per_s': operations / wall if wall else 0,
+        'latency': latency,
+        'retries': retries,
+        # the time the producers' buffers stayed full, stalling their producers
+        'stall_ms': snapshot['stall']['total_us'] / 1000,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        **wal,
+    })
+
+
+def benchmark(market_config, selection, wal_mode, args):
+    """
+    Runs a workload in a fresh process, so its peak RSS is its own
+
+    :returns the measurements, or a dict with the failure status
+    """
+    results = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=run_workload,
+                                     args=(market_config, args.engine, args.blocking,
+                                           args.log, selection, wal_mode, results))
+    worker.start()
+    worker.join(args.timeout)
+    if worker.is_alive():
+        worker.kill()
+        worker.join()
+        return {'status': 'timeout'}
+    if worker.exitcode != 0:
+        return {'status': 'error', 'exitcode': worker.exitcode}
+    return dict(results.get(), status='ok')
+
+
+def main():
+    """
+        Sweep the workload parameters, print a summary table and write the results
+    """
+    args = parse_args()
+
+    runs = []
+    print("{:>9} {:>9} {:>8} {:>6} {:>13} {:>5} {:>9} {:>11} {:>9} {:>10} {:>10} {:>10} "
+          "{:>10} {:>9}".format("producers", "consumers", "products", "queue", "selection",
+                                "wal", "wall_s", "units/s", "retries", "stall_ms",
+                                "add_p50us", "add_p99us", "rss_kb", "recover_s"))
+
+    sweep = itertools.product(args.producers, args.consumers, args.products,
+                              args.queue_sizes, range(args.repeat))
+    for num_producers, num_consumers, num_products, queue_size, repeat in sweep:
+        workload = generate_workload(num_producers, num_consumers, num_products, queue_size,
+                                     args.carts[0], args.carts[1], args.basic,
+                                     args.seed + repeat)
+        # every policy and log mode runs the same workload
+        for selection, wal_mode in itertools.product(args.selection, args.wal):
+            result = benchmark(workload, selection, wal_mode, args)
+            result.update({'producers': num_producers, 'consumers': num_consumers,
+                           'products': num_products, 'queue_size_per_producer': queue_size,
+                           'selection': selection, 'wal': wal_mode, 'repeat': repeat})
+            runs.append(result)
+
+            if result['status'] == 'ok':
+                print("{:>9} {:>9} {:>8} {:>6} {:>13} {:>5} {:>9.3f} {:>11.0f} {:>9} {:>10.1f} "
+                      "{:>10.1f} {:>10.1f} {:>10} {:>9}".format(
+                          num_producers, num_consumers, num_products, queue_size, selection,
+                          wal_mode, result['wall_s'], result['units_per_s'],
+                          sum(result['retries'].values()), result['stall_ms'],
+                          result['latency']['add_to_cart']['p50_us'],
+                          result['latency']['add_to_cart']['p99_us'], result['peak_rss_kb'],
+                          "{:.3f}".format(result['recover_s']) if 'recover_s' in result
+                          else "-"))
+            else:
+                print("{:>9} {:>9} {:>8} {:>6} {:>13} {:>5} {:>9}".format(
+                    num_producers, num_consumers, num_products, queue_size, selection,
+                    wal_mode, result['status']))
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'engine': args.engine, 'blocking': args.blocking, 'log': args.log,
+                   'python': sys.version, 'cpus': os.cpu_count(), 'runs': runs},
+                  output_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
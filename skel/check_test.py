@@ -5,8 +5,68 @@ Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
-import subprocess
+import re
 import sys
+from collections import Counter
+from itertools import repeat
+
+# the aggregated output (test.py --aggregate) and the generator's .ref.counts files
+# hold "<consumer> bought <count> x <product>" lines
+AGGREGATED_LINE = re.compile(r"(.* bought )(\d+) x (.*)")
+READ_SIZE = 1 << 20  # characters read at a time, only the distinct lines are kept in memory
+MAX_MISMATCHES = 10  # the mismatching lines printed for a failed test
+
+
+def count_lines(lines, counts):
+    """
+    Adds the units of the given lines to a Counter<"<consumer> bought <product>", units>,
+    with the aggregated lines expanded to their number of units
+    """
+    lines = [line + ")" for line in map(str.strip, lines) if line]
+    if not any(" x " in line for line in lines):
+        counts.update(lines)
+        return
+
+    for line in lines:
+        match = AGGREGATED_LINE.fullmatch(line)
+        if match:
+            counts[match.group(1) + match.group(3)] += int(match.group(2))
+        else:
+            counts[line] += 1
+
+
+def count_file(filename, read_size=READ_SIZE):
+    """
+    Reads an output or reference in chunks, so that its size does not matter
+
+    :returns a Counter<"<consumer> bought <product>", units> of the file
+    """
+    counts = Counter()
+    rest = ""
+    with open(filename) as input_file:
+        while True:
+            chunk = input_file.read(read_size)
+            # sometimes there is no new line between consumer outputs
+            lines = (rest + chunk).split(")")
+            if not chunk:
+                count_lines(lines, counts)
+                return counts
+            # the last line may go on in the next chunk
+            rest = lines.pop()
+            count_lines(lines, counts)
+
+
+def find_mismatches(output_counts, ref_counts):
+    """
+    :returns a sorted list of the (consumer, product, units expected, units bought) that
+    differ between the reference and the output
+    """
+    mismatches = []
+    for line in output_counts.keys() | ref_counts.keys():
+        if output_counts[line] != ref_counts[line]:
+            consumer, _, product = line.partition(" bought ")
+            mismatches.append((consumer, product, ref_counts[line], output_counts[line]))
+    return sorted(mismatches)
 
 
 def main():
@@ -17,29 +77,28 @@ def main():
     testname = sys.argv[1]
     output_filename = sys.argv[2]
     ref_filename = sys.argv[3]
-    # load the lines from the output file and sort them
-    with open(output_filename) as output_file:
-        output_lines = output_file.read()
-
-    output_lines = output_lines.split(")")  # sometimes there is no new line between consumer outputs
-    output_lines = [line.strip() + ")" for line in output_lines if len(line.strip()) > 0]
-
-    output_lines.sort()
+    # load the lines of both files as multisets, so either may be aggregated
+    output_counts = count_file(output_filename)
+    ref_counts = count_file(ref_filename)
 
     sorted_output_filename = output_filename + ".sorted"
 
-    # write to input file (tests/{test_name}.in)
+    # write the sorted output, one line per unit, for inspection; only the distinct
+    # lines are sorted
     with open(sorted_output_filename, 'w') as sorted_output_file:
-        for line in output_lines:
-            print(line, file=sorted_output_file)
+        for line in sorted(output_counts):
+            sorted_output_file.writelines(repeat(line + "\n", output_counts[line]))
 
-    command = subprocess.Popen(["diff", sorted_output_filename, ref_filename], stdout=subprocess.PIPE)
-    out, err = command.communicate()
-
-    if len(out) == 0:
+    if output_counts == ref_counts:
         print(f"Test {testname}" + ":\t\t" + "PASSED")
-    else:
-        print(f"Test {testname}" + ":\t\t" + "FAILED")
+        return
+
+    print(f"Test {testname}" + ":\t\t" + "FAILED")
+    mismatches = find_mismatches(output_counts, ref_counts)
+    for consumer, product, expected, bought in mismatches[:MAX_MISMATCHES]:
+        print(f"\t{consumer} bought {bought} x {product}, expected {expected}")
+    if len(mismatches) > MAX_MISMATCHES:
+        print(f"\t... {len(mismatches) - MAX_MISMATCHES} more mismatching lines")
 
 
 if __name__ == "__main__":
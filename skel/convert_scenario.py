@@ -0,0 +1,30 @@
+"""
+This module converts a market configuration (tests/*.in) to the binary scenario format,
+which test.py loads by memory-mapping it
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import argparse
+import time
+
+from tema.scenario import convert_to_binary
+
+
+def main():
+    """
+        Convert the JSON input file given on the command line
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", help="the market configuration (tests/*.in)")
+    parser.add_argument("output_file", help="the binary scenario to write")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    consumers = convert_to_binary(args.input_file, args.output_file)
+    print("Converted {} consumers in {:.2f}s".format(consumers, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+This module converts marketplace.log files to the binary trace format, which
+replay_trace.py replays
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import argparse
+import time
+
+from tema.trace import convert_log
+
+
+def main():
+    """
+        Convert the log files given on the command line
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_files", nargs='+',
+                        help="the logs, oldest first (marketplace.log.1 marketplace.log)")
+    parser.add_argument("output_file", help="the trace to write")
+    parser.add_argument("--queue-size", type=int, default=0,
+                        help="the queue_size_per_producer of the marketplace, if the log "
+                             "does not start with its __init__ call")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    calls = convert_log(args.log_files, args.output_file, args.queue_size)
+    print("Converted {} calls in {:.2f}s".format(calls, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+This module replays a binary trace of marketplace calls (test.py --trace, or
+convert_trace.py) on a new Marketplace and compares the latencies with the traced ones
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import argparse
+import json
+
+from tema.marketplace import Marketplace
+from tema.selection import SELECTION_POLICIES
+from tema.trace import OPERATIONS, TraceReplayer, read_trace
+
+
+def parse_args():
+    """
+        Parse the command line: the trace and the marketplace to replay it on
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace_file", help="the trace to replay")
+    parser.add_argument("--pace", choices=["full", "original"], default="full",
+                        help="start the calls in the traced order without waiting, or "
+                             "as long after the start as they were traced")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="the queue_size_per_producer of the marketplace (default: "
+                             "the traced one)")
+    parser.add_argument("--lock-stripes", type=int, default=16)
+    parser.add_argument("--selection", choices=SELECTION_POLICIES, default="first-fit")
+    parser.add_argument("--max-timeout", type=float, default=1.0, metavar="SECONDS",
+                        help="the longest a replayed call waits in the marketplace")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    return parser.parse_args()
+
+
+def main():
+    """
+        Replay the trace and print, for every operation, its calls, the calls whose result
+        differs from the traced one and the traced and replayed latencies
+    """
+    args = parse_args()
+    trace = read_trace(args.trace_file)
+    queue_size = args.queue_size or trace['queue_size_per_producer']
+    if not queue_size:
+        raise SystemExit("the trace does not know the queue size, give --queue-size")
+
+    marketplace = Marketplace(queue_size, lock_stripes=args.lock_stripes,
+                              selection=args.selection)
+    results = TraceReplayer(trace, marketplace, args.pace, args.max_timeout).run()
+
+    print("{:<18} {:>8} {:>10} {:>7} {:>12} {:>12} {:>12} {:>12}".format(
+        "operation", "calls", "mismatches", "errors", "traced_p50", "traced_p99",
+        "replay_p50", "replay_p99"))
+    for name in OPERATIONS:
+        if name not in results['latency']:
+            continue
+        traced, replayed = results['traced'][name], results['latency'][name]
+        print("{:<18} {:>8} {:>10} {:>7} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            name, replayed['count'], results['mismatches'].get(name, 0),
+            results['errors'].get(name, 0), traced['p50_us'], traced['p99_us'],
+            replayed['p50_us'], replayed['p99_us']))
+    print("{} calls replayed in {:.3f} s, traced in {:.3f} s".format(
+        results['calls'], results['wall_s'], results['traced_s']))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+This module runs the test scenarios in parallel and checks their output
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+SKEL_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_SCRIPT = os.path.join(SKEL_DIR, "test.py")
+CHECK_SCRIPT = os.path.join(SKEL_DIR, "check_test.py")
+REF_SUFFIXES = [".ref.out", ".ref.counts"]  # the references check_test.py accepts
+# the limits of run_tests.sh, for the tests not listed the default is used
+TIMEOUTS = {"09": 60, "10": 60}
+DEFAULT_TIMEOUT = 30
+
+
+def parse_args():
+    """
+        Parse the command line: the tests and the run options. The arguments after '--'
+        are passed to every test.py run, e.g. '-- --engine sim --aggregate'
+    """
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [options] [scenario ...] [-- test.py options]")
+    parser.add_argument("tests", nargs="*", metavar="scenario",
+                        help="the .in files to run (default: every scenario in --tests-dir "
+                             "that has a .ref.out or .ref.counts reference)")
+    parser.add_argument("--tests-dir", default=os.path.join(SKEL_DIR, "tests"))
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+                        help="tests run at the same time (default: one per CPU)")
+    parser.add_argument("--timeout", type=float, default=None, metavar="SECONDS",
+                        help="seconds after which a test is killed (default: the limits "
+                             "of run_tests.sh)")
+    parser.add_argument("--output-dir", default=os.path.join(SKEL_DIR, "out"),
+                        help="where every test writes its output and its marketplace.log")
+    parser.add_argument("--json", default="test_results.json",
+                        help="JSON file the results are written to")
+
+    argv = sys.argv[1:]
+    test_args = []
+    if "--" in argv:
+        test_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+    args.test_args = test_args
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+
+def find_reference(input_filename):
+    """
+    :returns the reference of a scenario, or None if it has none
+    """
+    stem = input_filename[:-len(".in")] if input_filename.endswith(".in") else input_filename
+    for suffix in REF_SUFFIXES:
+        if os.path.exists(stem + suffix):
+            return stem + suffix
+    return None
+
+
+def find_tests(args):
+    """
+    :returns a list of dict<'name', 'stem', 'input', 'ref', 'timeout'>, one per test
+    """
+    if args.tests:
+        input_filenames = args.tests
+    else:
+        input_filenames = [filename
+                           for filename in sorted(glob.glob(os.path.join(args.tests_dir, "*.in")))
+                           if find_reference(filename) is not None]
+
+    tests = []
+    for input_filename in input_filenames:
+        stem = os.path.basename(input_filename)
+        stem = stem[:-len(".in")] if stem.endswith(".in") else stem
+        tests.append({
+            # run_tests.sh names tests/01.in "Test 1"
+            'name': str(int(stem)) if stem.isdigit() else stem,
+            'stem': stem,
+            'input': os.path.abspath(input_filename),
+            'ref': find_reference(input_filename),
+            'timeout': args.timeout or TIMEOUTS.get(stem, DEFAULT_TIMEOUT),
+        })
+    return tests
+
+
+def run_scenario(test, workdir, test_args):
+    """
+    Runs test.py on a scenario in its own directory, killing it after the test's timeout
+
+    :returns a dict with the exit code, whether it timed out, the wall and CPU time
+    and the peak RSS of the run
+    """
+    output_filename = os.path.join(workdir, test['stem'] + ".out")
+    start = time.perf_counter()
+    with open(output_filename, 'w') as output_file, \
+            open(os.path.join(workdir, test['stem'] + ".err"), 'w') as error_file:
+        process = subprocess.Popen([sys.executable, TEST_SCRIPT, test['input']] + test_args,
+                                   stdout=output_file, stderr=error_file, cwd=workdir)
+
+    state = {'finished': False, 'timed_out': False}
+    state_lock = threading.Lock()
+
+    def expire():
+        with state_lock:
+            if not state['finished']:
+                state['timed_out'] = True
+                process.kill()
+
+    timer = threading.Timer(test['timeout'], expire)
+    timer.start()
+    # wait without reaping the process, so the timer never kills a reused pid
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    with state_lock:
+        state['finished'] = True
+    timer.cancel()
+
+    # reap it, with the resources it (and the processes it waited for) used
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return {
+        'output': output_filename,
+        'exitcode': process.returncode,
+        'timed_out': state['timed_out'],
+        'wall_s': wall,
+        'cpu_s': rusage.ru_utime + rusage.ru_stime,
+        'peak_rss_kb': rusage.ru_maxrss,
+    }
+
+
+def run_test(test, args):
+    """
+    Runs a test and checks its output with check_test.py
+
+    :returns the test's results, with the lines to print in 'report'
+    """
+    workdir = os.path.join(args.output_dir, test['stem'])
+    os.makedirs(workdir, exist_ok=True)
+    result = dict(test, **run_scenario(test, workdir, args.test_args))
+
+    report = []
+    if result['timed_out']:
+        report.append("TIMEOUT. Test {} exceeded maximum allowed time of {:g}".format(
+            test['name'], test['timeout']))
+    elif result['exitcode'] != 0:
+        report.append("ERROR. Test {} exited with code {}".format(test['name'],
+                                                                 result['exitcode']))
+
+    if test['ref'] is None:
+        report.append("Test {}:\t\tFAILED".format(test['name']))
+        report.append("\tno .ref.out or .ref.counts reference")
+        result['status'] = 'FAILED'
+    else:
+        check = subprocess.run([sys.executable, CHECK_SCRIPT, test['name'], result['output'],
+                                test['ref']], stdout=subprocess.PIPE, text=True, check=False)
+        report += check.stdout.splitlines()
+        result['status'] = 'PASSED' if 'PASSED' in check.stdout else 'FAILED'
+
+    result['report'] = report
+    return result
+
+
+def main():
+    """
+        Run the tests, print their check_test.py lines as they finish, then a summary
+        table, and write the results
+    """
+    args = parse_args()
+    tests = find_tests(args)
+    if not tests:
+        print("No tests found")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    results = []
+    # every test runs in its own process, the pool threads only wait for them
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_test, test, args) for test in tests]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print("\n".join(result.pop('report')), flush=True)
+    wall = time.perf_counter() - start
+
+    results.sort(key=lambda result: result['stem'])
+    print()
+    print("{:<12} {:>7} {:>9} {:>9} {:>9}".format("test", "result", "wall_s", "cpu_s",
+                                                  "peak_mb"))
+    for result in results:
+        status = 'TIMEOUT' if result['timed_out'] else result['status']
+        print("{:<12} {:>7} {:>9.2f} {:>9.2f} {:>9.1f}".format(
+            result['stem'], status, result['wall_s'], result['cpu_s'],
+            result['peak_rss_kb'] / 1024))
+
+    passed = sum(result['status'] == 'PASSED' for result in results)
+    print("{} of {} tests passed in {:.2f} s with {} jobs".format(passed, len(results), wall,
+                                                                 args.jobs))
+
+    with open(args.json, 'w') as json_file:
+        json.dump({'test_args': args.test_args, 'jobs': args.jobs, 'python': sys.version,
+                   'cpus': os.cpu_count(), 'wall_s': wall, 'passed': passed,
+                   'failed': len(results) - passed, 'tests': results}, json_file, indent=4)
+
+    if passed != len(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
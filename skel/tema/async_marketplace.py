@@ -0,0 +1,333 @@
+"""
+This module represents the asyncio flavour of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import asyncio
+import io
+import unittest
+from contextlib import redirect_stdout
+
+from .marketplace import Marketplace
+from .product import Tea, Coffee
+
+
+class AsyncMarketplace:
+    """
+    Marketplace used by coroutine-based producers and consumers that all run in one
+    event loop. The stock is kept by a regular Marketplace; this class adds the waiting,
+    so that producers and consumers await room or stock instead of sleeping.
+    """
+
+    def __init__(self, queue_size_per_producer, metrics=False, selection='first-fit'):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type metrics: Bool
+        :param metrics: if True, the underlying Marketplace takes metrics
+
+        :type selection: String
+        :param selection: the policy choosing which producer's units a consumer gets
+        """
+        # Everything runs in one thread, a single stripe is enough
+        self.marketplace = Marketplace(queue_size_per_producer, lock_stripes=1,
+                                       metrics=metrics, selection=selection)
+        self.stock_conditions = {}  # a dict<product, asyncio.Condition> for waiting consumers
+        # a dict<producer_id, asyncio.Condition>, for a producer waiting for room
+        self.capacity_conditions = {}
+
+        # the consumers need to know which buffers they took from, to wake only those producers
+        # pylint: disable=protected-access
+        self._add_to_cart = self.marketplace._add_to_cart
+        if metrics:
+            self._add_to_cart = self.marketplace.metrics.timed('add_to_cart', self._add_to_cart)
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        prod_id = self.marketplace.register_producer()
+        self.capacity_conditions[prod_id] = asyncio.Condition()
+        return prod_id
+
+    def unregister_producer(self, producer_id):
+        """
+        Takes a producer and its units in stock out of the marketplace
+
+        :returns a list with the producer's unsold products
+        """
+        return self.marketplace.unregister_producer(producer_id)
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        return self.marketplace.new_cart()
+
+    async def publish_many(self, producer_id, product, quantity):
+        """
+        Adds up to quantity units of the product to the marketplace, waiting until there is
+        room for at least one of them in the producer's buffer
+
+        :returns the number of units published
+        """
+        buffer = self.marketplace.producers.buffers[producer_id]
+        if len(buffer) >= self.marketplace.queue_size_per_producer:
+            capacity = self.capacity_conditions[producer_id]
+            async with capacity:
+                await capacity.wait_for(
+                    lambda: len(buffer) < self.marketplace.queue_size_per_producer)
+
+        published = self.marketplace.publish_many(producer_id, product, quantity)
+        await self._notify(self._stock_condition(product), published)
+        return published
+
+    async def add_to_cart(self, cart_id, product, quantity=1):
+        """
+        Adds up to quantity units of a product to the given cart, waiting until at least
+        one of them is in stock
+
+        :returns the number of units added
+        """
+        product_id = self.marketplace.registry.intern(product)
+        if not self.marketplace.available(product_id):
+            stock = self._stock_condition(product)
+            async with stock:
+                await stock.wait_for(lambda: self.marketplace.available(product_id))
+
+        added, taken = self._add_to_cart(cart_id, product_id, quantity, 0)
+        for producer_id in taken:
+            await self._notify(self.capacity_conditions[producer_id], 1)
+        return added
+
+    async def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        Removes up to quantity units of a product from cart
+
+        :returns the number of units removed
+        """
+        removed = self.marketplace.remove_from_cart(cart_id, product, quantity)
+        await self._notify(self._stock_condition(product), removed)
+        return removed
+
+    def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart.
+        """
+        return self.marketplace.place_order(cart_id)
+
+    def release_cart(self, cart_id):
+        """
+        Gives up a cart once its order was placed, so that its id is reused
+        """
+        self.marketplace.release_cart(cart_id)
+
+    def metrics_snapshot(self):
+        """
+        Returns the measurements of the underlying Marketplace
+        """
+        return self.marketplace.metrics_snapshot()
+
+    def _stock_condition(self, product):
+        """
+        Returns the condition the consumers of the given product wait on
+        """
+        stock = self.stock_conditions.get(product)
+        if stock is None:
+            stock = self.stock_conditions[product] = asyncio.Condition()
+        return stock
+
+    @staticmethod
+    async def _notify(condition, count):
+        """
+        Wakes up count coroutines waiting on the condition
+        """
+        if count == 0:
+            return
+        async with condition:
+            condition.notify(count)
+
+
+async def produce(marketplace, products, republish_wait_time, name):
+    """
+    Coroutine version of Producer.run, publishes the products forever
+    """
+    # pylint: disable=unused-argument
+    # republish_wait_time and name are part of the producer configuration, but a producer
+    # that awaits room in its buffer never needs to retry
+    prod_id = marketplace.register_producer()
+
+    # With nothing to publish, the loop below would never await
+    if not any(quantity > 0 for _, quantity, _ in products):
+        marketplace.unregister_producer(prod_id)
+        return
+
+    while True:
+        for product, quantity, wait_time in products:
+            while quantity > 0:
+                published = await marketplace.publish_many(prod_id, product, quantity)
+                # Each unit takes wait_time to produce
+                await asyncio.sleep(wait_time * published)
+                quantity -= published
+
+
+async def consume(marketplace, carts, retry_wait_time, name, output=None):
+    """
+    Coroutine version of Consumer.run, executes the cart operations and prints the order,
+    or submits it to the output OrderWriter
+    """
+    # pylint: disable=unused-argument
+    # a consumer that awaits stock never needs retry_wait_time
+    cart_id = marketplace.new_cart()
+
+    for cart in carts:
+        for operation in cart:
+            action = operation['type']
+            product = operation['product']
+            quantity = operation['quantity']
+
+            if action == 'add':
+                while quantity > 0:
+                    quantity -= await marketplace.add_to_cart(cart_id, product, quantity)
+
+            elif action == 'remove':
+                await marketplace.remove_from_cart(cart_id, product, quantity)
+
+    ordered_products = marketplace.place_order(cart_id)
+    marketplace.release_cart(cart_id)
+    if output is not None:
+        output.submit(name, ordered_products)
+        return
+    for product in ordered_products:
+        print("{} bought {}".format(name, product))
+
+
+async def run_market(market_config, output=None):
+    """
+    Runs the producers and consumers of the given configuration (with the product ids
+    already turned into products) until every consumer placed its order
+
+    :type output: OrderWriter
+    :param output: the writer the orders are submitted to, None prints them directly
+
+    :returns the AsyncMarketplace used
+    """
+    marketplace = AsyncMarketplace(**market_config['marketplace'])
+
+    producers = [asyncio.create_task(produce(marketplace, **producer))
+                 for producer in market_config['producers']]
+
+    await asyncio.gather(*(consume(marketplace, **consumer, output=output)
+                           for consumer in market_config['consumers']))
+
+    for producer in producers:
+        producer.cancel()
+    await asyncio.gather(*producers, return_exceptions=True)
+    return marketplace
+
+
+class TestAsyncMarketplace(unittest.TestCase):
+    """
+    Unit testing for the waiting done by AsyncMarketplace
+    """
+
+    def setUp(self):
+        """
+        Set up the products used by the tests
+        """
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+    def test_add_to_cart_waits_for_stock(self):
+        """
+        Check that a consumer awaiting a product gets it once it is published
+        """
+        async def scenario():
+            marketplace = AsyncMarketplace(2)
+            prod_id = marketplace.register_producer()
+            cart_id = marketplace.new_cart()
+
+            consumer = asyncio.create_task(marketplace.add_to_cart(cart_id, self.tea_product, 3))
+            await asyncio.sleep(0)
+            self.assertFalse(consumer.done())
+
+            self.assertEqual(await marketplace.publish_many(prod_id, self.tea_product, 3), 2)
+            self.assertEqual(await consumer, 2)
+            self.assertListEqual(marketplace.place_order(cart_id), [self.tea_product] * 2)
+
+        asyncio.run(scenario())
+
+    def test_only_the_emptied_producer_wakes_up(self):
+        """
+        Check that a purchase wakes up the producer it took from, not every producer
+        """
+        async def scenario():
+            marketplace = AsyncMarketplace(1)
+            tea_producer = marketplace.register_producer()
+            coffee_producer = marketplace.register_producer()
+            cart_id = marketplace.new_cart()
+            await marketplace.publish_many(tea_producer, self.tea_product, 1)
+            await marketplace.publish_many(coffee_producer, self.coffee_product, 1)
+
+            tea = asyncio.create_task(marketplace.publish_many(tea_producer,
+                                                               self.tea_product, 1))
+            coffee = asyncio.create_task(marketplace.publish_many(coffee_producer,
+                                                                  self.coffee_product, 1))
+            await asyncio.sleep(0)
+
+            self.assertEqual(await marketplace.add_to_cart(cart_id, self.tea_product), 1)
+            self.assertEqual(await tea, 1)
+            await asyncio.sleep(0)
+            self.assertFalse(coffee.done())
+            coffee.cancel()
+
+        asyncio.run(scenario())
+
+    def test_publish_waits_for_room(self):
+        """
+        Check that a producer awaiting room publishes once a unit is bought
+        """
+        async def scenario():
+            marketplace = AsyncMarketplace(1)
+            prod_id = marketplace.register_producer()
+            cart_id = marketplace.new_cart()
+
+            await marketplace.publish_many(prod_id, self.tea_product, 1)
+            producer = asyncio.create_task(
+                marketplace.publish_many(prod_id, self.coffee_product, 1))
+            await asyncio.sleep(0)
+            self.assertFalse(producer.done())
+
+            self.assertEqual(await marketplace.add_to_cart(cart_id, self.tea_product), 1)
+            self.assertEqual(await producer, 1)
+
+        asyncio.run(scenario())
+
+    def test_run_market(self):
+        """
+        Check that every consumer gets its cart and the producers are stopped
+        """
+        market_config = {
+            'marketplace': {'queue_size_per_producer': 3},
+            'producers': [{'name': 'prod1', 'republish_wait_time': 0.1,
+                           'products': [(self.coffee_product, 2, 0)]}],
+            'consumers': [{'name': 'cons%d' % i, 'retry_wait_time': 0.1,
+                           'carts': [[{'type': 'add', 'product': self.coffee_product,
+                                       'quantity': 2},
+                                      {'type': 'remove', 'product': self.coffee_product,
+                                       'quantity': 1}]]}
+                          for i in range(3)]
+        }
+        output = io.StringIO()
+        with redirect_stdout(output):
+            asyncio.run(asyncio.wait_for(run_market(market_config), 5))
+
+        self.assertListEqual(sorted(output.getvalue().splitlines()),
+                             ["cons%d bought %s" % (i, self.coffee_product) for i in range(3)])
@@ -0,0 +1,169 @@
+"""
+This module represents a producer's buffer in the Marketplace and the table of the
+producers' buffers.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import itertools
+import unittest
+from itertools import chain, repeat
+
+from .product import Tea, Coffee
+
+
+class ProducerBuffer:
+    """
+    A multiset of the units a producer has in the marketplace. The units are counted per
+    product, so adding or removing them does not depend on the size of the buffer.
+    The Marketplace only changes it while holding the producer's capacity lock.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.products = {}  # a dict<product, count>
+        self.size = 0  # the number of units in the buffer
+
+    def add(self, product, count=1):
+        """
+        Adds count units of the product
+        """
+        self.products[product] = self.products.get(product, 0) + count
+        self.size += count
+
+    def remove(self, product, count=1):
+        """
+        Removes count units of the product, which must be in the buffer
+        """
+        held = self.products[product]
+        if held == count:
+            del self.products[product]
+        else:
+            self.products[product] = held - count
+        self.size -= count
+
+    def count(self, product):
+        """
+        Returns the number of units of the product in the buffer
+        """
+        return self.products.get(product, 0)
+
+    def __contains__(self, product):
+        return product in self.products
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """
+        Iterates over the units in the buffer, one product per unit
+        """
+        return chain.from_iterable(repeat(product, count)
+                                   for product, count in self.products.items())
+
+
+class ProducerTable:
+    """
+    The producers registered in a Marketplace, indexed by producer id. The ids are reused
+    once released, so the lists only grow with the number of producers registered at the
+    same time. The ids are handed out and released under the producers_id_lock.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        # a list<ProducerBuffer> indexed by producer id, the units of each producer,
+        # None for a free id
+        self.buffers = []
+        # a list<(producer_id, generation)> indexed by producer id, set at registration and
+        # None once the producer unregistered, changed under the producer's lock. The carts
+        # hold these keys, so units returned after the producer left are not mixed with
+        # those of a new producer with the same id.
+        self.keys = []
+        self.free_ids = []  # the ids of the unregistered producers
+        self.generations = itertools.count()  # tells apart the producers with the same id
+
+    def allocate(self):
+        """
+        Returns a free producer id, or a new one at the end of the lists
+        """
+        if self.free_ids:
+            return self.free_ids.pop()
+        self.buffers.append(None)
+        self.keys.append(None)
+        return len(self.buffers) - 1
+
+    def start(self, producer_id):
+        """
+        Gives an allocated id an empty buffer and a new key, called under the producer's lock
+
+        :returns the key
+        """
+        self.buffers[producer_id] = ProducerBuffer()
+        key = self.keys[producer_id] = (producer_id, next(self.generations))
+        return key
+
+    def release(self, producer_id):
+        """
+        Drops the buffer of an unregistered producer and frees its id, called under the
+        producer's lock
+        """
+        self.buffers[producer_id] = None
+        self.free_ids.append(producer_id)
+
+    def __len__(self):
+        """
+        Returns the number of producers registered
+        """
+        return len(self.buffers) - len(self.free_ids)
+
+
+class TestProducerBuffer(unittest.TestCase):
+    """
+    Unit testing for the producer's buffer
+    """
+
+    def setUp(self):
+        """
+        Set up the products used by the tests
+        """
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+    def test_add_remove(self):
+        """
+        Check that the units are counted per product
+        """
+        buffer = ProducerBuffer()
+        buffer.add(self.tea_product, 3)
+        buffer.add(self.coffee_product)
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.count(self.tea_product), 3)
+
+        buffer.remove(self.tea_product, 2)
+        buffer.remove(self.coffee_product)
+        self.assertNotIn(self.coffee_product, buffer)
+        self.assertListEqual(list(buffer), [self.tea_product])
+        self.assertEqual(len(buffer), 1)
+
+    def test_producer_table(self):
+        """
+        Check that the ids are reused, each time with an empty buffer and a new key
+        """
+        table = ProducerTable()
+        ids = [table.allocate() for _ in range(2)]
+        keys = [table.start(idx) for idx in ids]
+        self.assertListEqual(ids, [0, 1])
+        table.buffers[1].add(self.tea_product)
+
+        table.keys[1] = None
+        table.release(1)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.allocate(), 1)
+        self.assertNotEqual(table.start(1), keys[1])
+        self.assertEqual(len(table.buffers[1]), 0)
+        self.assertEqual(len(table), 2)
@@ -0,0 +1,191 @@
+"""
+This module represents a consumer's Cart.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+from collections import Counter
+from itertools import chain, repeat
+from threading import Lock
+
+from .product import Tea, Coffee
+
+
+class Cart:
+    """
+    A multiset of (producer_id, product) pairs. The units are counted per product and
+    per producer, so adding or removing them does not depend on the size of the cart.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.products = {}  # a dict<product, Counter<producer_id>>
+        self.size = 0  # the number of units in the cart
+
+    def add(self, producer_id, product, count=1):
+        """
+        Adds count units of the product, reserved from the given producer
+        """
+        producers = self.products.get(product)
+        if producers is None:
+            producers = self.products[product] = Counter()
+        producers[producer_id] += count
+        self.size += count
+
+    def remove(self, product, count=1):
+        """
+        Removes up to count units of the product
+
+        :returns a dict<producer_id, count> with the units removed from each producer
+        """
+        producers = self.products.get(product)
+        removed = {}
+        while producers and count > 0:
+            producer_id, held = next(iter(producers.items()))
+            taken = min(held, count)
+            if taken == held:
+                del producers[producer_id]
+            else:
+                producers[producer_id] -= taken
+            removed[producer_id] = taken
+            count -= taken
+            self.size -= taken
+
+        if producers is not None and not producers:
+            del self.products[product]
+        return removed
+
+    def count(self, product):
+        """
+        Returns the number of units of the product in the cart
+        """
+        producers = self.products.get(product)
+        return sum(producers.values()) if producers else 0
+
+    def expand(self):
+        """
+        Returns an iterator over every unit in the cart, as products
+        """
+        return chain.from_iterable(repeat(product, sum(producers.values()))
+                                   for product, producers in self.products.items())
+
+    def items(self):
+        """
+        Returns an iterator over every unit in the cart, as (producer_id, product) pairs
+        """
+        return chain.from_iterable(repeat((producer_id, product), count)
+                                   for product, producers in self.products.items()
+                                   for producer_id, count in producers.items())
+
+    def clear(self):
+        """
+        Empties the cart
+        """
+        self.products.clear()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.items()
+
+
+class CartTable:
+    """
+    The carts of a marketplace, indexed by cart id. The ids are reused once released, so
+    the table only grows with the number of carts in use at the same time.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.carts = []  # a list<Cart> indexed by cart id
+        self.free_ids = []  # the ids of the released carts, which are empty
+        self.lock = Lock()  # guards the two lists
+
+    def new(self):
+        """
+        Returns the id of an empty cart, a released one if there is any
+        """
+        with self.lock:
+            if self.free_ids:
+                return self.free_ids.pop()
+            self.carts.append(Cart())
+            return len(self.carts) - 1
+
+    def release(self, cart_id):
+        """
+        Frees the id of a cart that was emptied
+        """
+        with self.lock:
+            self.free_ids.append(cart_id)
+
+    def __getitem__(self, cart_id):
+        return self.carts[cart_id]
+
+
+class TestCart(unittest.TestCase):
+    """
+    Unit testing for the Cart multiset
+    """
+
+    def setUp(self):
+        """
+        Set up a cart with 2xTea from producer 0, 1xTea from producer 1 and 1xCoffee
+        """
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+        self.cart = Cart()
+        self.cart.add(0, self.tea_product, 2)
+        self.cart.add(1, self.tea_product)
+        self.cart.add(1, self.coffee_product)
+
+    def test_add(self):
+        """
+        Check that the units are counted per product and per producer
+        """
+        self.assertEqual(len(self.cart), 4)
+        self.assertEqual(self.cart.count(self.tea_product), 3)
+        self.assertEqual(self.cart.count(Tea("Other tea", 1, "Green")), 0)
+        self.assertListEqual(sorted(self.cart.items(), key=str),
+                             sorted([(0, self.tea_product), (0, self.tea_product),
+                                     (1, self.tea_product), (1, self.coffee_product)], key=str))
+
+    def test_remove(self):
+        """
+        Check that the units are taken from the producers in the order they were added
+        """
+        self.assertDictEqual(self.cart.remove(self.tea_product, 3), {0: 2, 1: 1})
+        self.assertDictEqual(self.cart.remove(self.tea_product), {})
+        self.assertDictEqual(self.cart.remove(self.coffee_product, 5), {1: 1})
+        self.assertEqual(len(self.cart), 0)
+        self.assertDictEqual(self.cart.products, {})
+
+    def test_expand(self):
+        """
+        Check that the cart expands to one product per unit
+        """
+        self.assertEqual(sorted(map(str, self.cart.expand())),
+                         sorted(map(str, [self.tea_product] * 3 + [self.coffee_product])))
+        self.cart.clear()
+        self.assertListEqual(list(self.cart.expand()), [])
+
+    def test_cart_table(self):
+        """
+        Check that the ids of the released carts are reused
+        """
+        table = CartTable()
+        self.assertListEqual([table.new(), table.new()], [0, 1])
+        table[1].add(0, self.tea_product)
+        table[1].clear()
+        table.release(1)
+        self.assertEqual(table.new(), 1)
+        self.assertEqual(len(table[1]), 0)
+        self.assertEqual(table.new(), 2)
@@ -8,13 +8,16 @@ March 2021
 import time
 from threading import Thread
 
+from .retry import RETRY_POLICIES
+
 
 class Consumer(Thread):
     """
     Class that represents a consumer.
     """
 
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, blocking=False, output=None,
+                 retry='fixed', **kwargs):
         """
         Constructor.
 
@@ -28,6 +31,18 @@ class Consumer(Thread):
         :param retry_wait_time: the number of seconds that a producer must wait
         until the Marketplace becomes available
 
+        :type blocking: Bool
+        :param blocking: if True, wait inside the Marketplace (up to retry_wait_time, or until
+        woken up if it is 0) for the product to be published instead of sleeping between
+        attempts
+
+        :type output: OrderWriter
+        :param output: the writer the order is submitted to, None prints it directly
+
+        :type retry: String
+        :param retry: the policy, one of retry.RETRY_POLICIES, deciding how long to sleep
+        between attempts, based on retry_wait_time and the marketplace's hints
+
         :type kwargs:
         :param kwargs: other arguments that are passed to the Thread's __init__()
         """
@@ -36,10 +51,22 @@ class Consumer(Thread):
         self.carts = carts
         self.marketplace = marketplace
         self.retry_wait_time = retry_wait_time
+        self.blocking = blocking
+        self.output = output
         self.name = kwargs['name']
+        self.retry = RETRY_POLICIES[retry](retry_wait_time, seed=self.name)
         self.cart_id = None
 
     def run(self):
+        for delay in self.steps():
+            time.sleep(delay)
+
+    def steps(self):
+        """
+        The consumer's work, as a generator that yields each time the consumer has to
+        sleep, the number of seconds to sleep. run() really sleeps, the simulation
+        engine only moves its virtual clock.
+        """
         # Get a card ID from the marketplace
         self.cart_id = self.marketplace.new_cart()
 
@@ -51,20 +78,37 @@ class Consumer(Thread):
                 quantity = operation['quantity']
 
                 if action == 'add':
+                    # a zero wait blocks until woken up, a 0 timeout would spin
+                    timeout = (self.retry_wait_time or None) if self.blocking else 0
                     while quantity > 0:
-                        found_it = self.marketplace.add_to_cart(self.cart_id, product)
-                        if found_it:
-                            quantity -= 1
+                        # a product that is out of stock is not asked for, which takes
+                        # no lock, unless the consumer waits for it in the marketplace
+                        if not self.blocking and not self.marketplace.available(product):
+                            self.marketplace.record_retry('available')
+                            yield self.retry.delay(self.marketplace.add_retry_after(product))
+                            continue
+
+                        added = self.marketplace.add_to_cart(self.cart_id, product,
+                                                             quantity, timeout)
+                        quantity -= added
+                        if added:
+                            self.retry.reset()
                         else:
-                            time.sleep(self.retry_wait_time)
+                            self.marketplace.record_retry('add_to_cart')
+                            if not self.blocking:
+                                yield self.retry.delay(
+                                    self.marketplace.add_retry_after(product))
 
                 elif action == 'remove':
-                    while quantity > 0:
-                        self.marketplace.remove_from_cart(self.cart_id, product)
-                        quantity -= 1
+                    self.marketplace.remove_from_cart(self.cart_id, product, quantity)
 
         # Place the order
         ordered_products = self.marketplace.place_order(self.cart_id)
+        self.marketplace.release_cart(self.cart_id)
+
+        if self.output is not None:
+            self.output.submit(self.name, ordered_products)
+            return
 
         print_lock = self.marketplace.get_print_lock()
 
@@ -0,0 +1,139 @@
+"""
+This module runs a market configuration on one of the marketplace engines.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import asyncio
+
+from . import async_marketplace, sharded_marketplace, simulation
+from .consumer import Consumer
+from .marketplace import Marketplace
+from .output import OrderWriter
+from .producer import Producer
+from .worker_pool import WorkerPool
+
+ENGINES = ["threads", "asyncio", "processes", "sim"]
+
+
+def run_threads(market_config, blocking=False, output=None, retry='fixed', workers=None):
+    """
+    Runs every producer in its own thread and the consumers either in their own threads
+    too or on a pool of worker threads, until every consumer placed its order
+
+    :type output: OrderWriter
+    :param output: the writer the orders are submitted to, None prints them directly
+
+    :type retry: String
+    :param retry: the retry policy of the producers and consumers
+
+    :type workers: Int
+    :param workers: the number of threads running the consumers, which sleep between
+    retries without holding one. None runs a thread per consumer. Blocking consumers
+    would keep their worker while waiting, so the pool cannot be used with blocking.
+
+    :returns the Marketplace used
+    """
+    if workers is not None and blocking:
+        raise ValueError("blocking consumers would keep their worker while waiting")
+
+    # build the marketplace
+    marketplace = Marketplace(**market_config['marketplace'])
+
+    # build and start the producers
+    producers = [Producer(**p_market_config, marketplace=marketplace,
+                          blocking=blocking, retry=retry, daemon=True)
+                 for p_market_config in market_config['producers']]
+
+    for producer in producers:
+        producer.start()
+
+    if workers is not None:
+        run_pool(market_config['consumers'], marketplace, output, retry, workers)
+        return marketplace
+
+    # build and start the consumers, as they are read when the configuration is streamed
+    consumers = []
+    for c_market_config in market_config['consumers']:
+        consumer = Consumer(**c_market_config, marketplace=marketplace, blocking=blocking,
+                            output=output, retry=retry)
+        consumer.start()
+        consumers.append(consumer)
+
+    for consumer in consumers:
+        consumer.join()
+
+    return marketplace
+
+
+def run_pool(consumers_config, marketplace, output, retry, workers):
+    """
+    Runs the consumers on a pool of worker threads, stepping through Consumer.steps() as
+    the sim engine does, but on the real clock
+    """
+    pool = WorkerPool(workers)
+    pool.start()
+    try:
+        # the consumers are spawned as they are read when the configuration is streamed
+        for c_market_config in consumers_config:
+            consumer = Consumer(**c_market_config, marketplace=marketplace, output=output,
+                                retry=retry)
+            pool.spawn(consumer.steps())
+    finally:
+        pool.join()
+
+
+def run_market(engine, market_config, blocking=False, shards=None, time_limit=None,
+               aggregate=False, retry='fixed', workers=None):
+    """
+    Runs the given configuration (with the product ids already turned into products)
+    on the given engine and prints the orders to stdout, through an OrderWriter.
+    Its consumers may be an iterator, as load_market_config returns.
+
+    :type engine: String
+    :param engine: one of ENGINES
+
+    :type blocking: Bool
+    :param blocking: producers and consumers wait in the marketplace instead of sleeping
+    between retries (threads and processes engines)
+
+    :type shards: Int
+    :param shards: the number of worker processes of the processes engine
+
+    :type time_limit: Float
+    :param time_limit: the virtual seconds after which the sim engine gives up, None for
+    a limit derived from the scenario
+
+    :type aggregate: Bool
+    :param aggregate: print "<consumer> bought <count> x <product>" lines, one per
+    product of an order, instead of one line per unit
+
+    :type retry: String
+    :param retry: the policy, one of retry.RETRY_POLICIES, deciding how long producers
+    and consumers sleep between retries. The policies other than 'fixed' get hints from
+    the marketplace (threads and sim engines). The asyncio engine never retries.
+
+    :type workers: Int
+    :param workers: run the consumers of the threads engine on this many worker threads
+    instead of a thread each
+
+    :returns the marketplace used, or None for the processes engine
+    """
+    if engine == "sim" and blocking:
+        raise ValueError("the sim engine runs in a single thread, it cannot block")
+    if engine == "processes":
+        # every shard goes through all the consumers
+        market_config = dict(market_config, consumers=list(market_config['consumers']))
+        sharded_marketplace.run_market(market_config, shards, blocking, aggregate, retry)
+        return None
+    if retry != 'fixed' and engine != "asyncio":
+        market_config = dict(market_config, marketplace=dict(market_config['marketplace'],
+                                                             retry_hints=True))
+
+    with OrderWriter(aggregate=aggregate) as output:
+        if engine == "sim":
+            return simulation.run_market(market_config, time_limit, output, retry)
+        if engine == "asyncio":
+            return asyncio.run(async_marketplace.run_market(market_config, output))
+        return run_threads(market_config, blocking, output, retry, workers)
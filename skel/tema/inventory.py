@@ -0,0 +1,106 @@
+"""
+This module represents the inventory index of the Marketplace: which producers hold the
+units in stock of each product.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+
+from .selection import SELECTION_POLICIES
+
+
+class InventoryIndex:
+    """
+    The units in stock, per product and per producer. The entries of a product are only
+    changed under its lock stripe; the counts are also read without any lock.
+    """
+
+    def __init__(self, selection='first-fit'):
+        """
+        Constructor
+
+        :type selection: String
+        :param selection: the policy choosing which producer's units a consumer gets,
+        one of selection.SELECTION_POLICIES
+        """
+        self.holders = {}  # a dict<product_id, dict<producer_id, count>>
+        # a dict<product_id, units in stock>, changed with the holders, read without any lock
+        self.counts = {}
+        self.selection = SELECTION_POLICIES[selection]()  # chooses the producer to take from
+
+    def add(self, producer_id, product_id, count=1):
+        """
+        Records count more units of product in the buffer of the given producer
+        """
+        holders = self.holders.setdefault(product_id, {})
+        holders[producer_id] = holders.get(producer_id, 0) + count
+        self.counts[product_id] = self.counts.get(product_id, 0) + count
+
+    def remove(self, producer_id, product_id, count=1):
+        """
+        Records count units of product less in the buffer of the given producer
+        """
+        holders = self.holders[product_id]
+        if holders[producer_id] == count:
+            del holders[producer_id]
+        else:
+            holders[producer_id] -= count
+        self.counts[product_id] -= count
+
+    def drop(self, producer_id, product_id):
+        """
+        Takes all the units of product of the given producer out of stock
+
+        :returns the number of units dropped
+        """
+        count = self.holders.get(product_id, {}).pop(producer_id, 0)
+        if count:
+            self.counts[product_id] -= count
+        return count
+
+    def select(self, product_id, buffers):
+        """
+        Chooses the producer the next units of a product in stock are taken from
+
+        :type buffers: List
+        :param buffers: a list<ProducerBuffer> indexed by producer_id
+
+        :returns the producer_id, or None if the product is not in stock
+        """
+        holders = self.holders.get(product_id)
+        if not holders:
+            return None
+        return self.selection.select(product_id, holders, buffers)
+
+    def available(self, product_id):
+        """
+        Returns the number of units of a product in stock
+        """
+        return self.counts.get(product_id, 0)
+
+
+class TestInventoryIndex(unittest.TestCase):
+    """
+    Unit testing for the inventory index
+    """
+
+    def test_index(self):
+        """
+        Check that the holders and the counts follow the units added and removed
+        """
+        inventory = InventoryIndex()
+        inventory.add(0, 7, 2)
+        inventory.add(1, 7)
+        self.assertDictEqual(inventory.holders[7], {0: 2, 1: 1})
+        self.assertEqual(inventory.select(7, []), 0)
+
+        inventory.remove(0, 7, 2)
+        self.assertDictEqual(inventory.holders[7], {1: 1})
+        self.assertEqual(inventory.available(7), 1)
+        self.assertEqual(inventory.drop(1, 7), 1)
+        self.assertEqual(inventory.drop(1, 7), 0)
+        self.assertEqual(inventory.available(7), 0)
+        self.assertIsNone(inventory.select(7, []))
+        self.assertEqual(inventory.available(8), 0)
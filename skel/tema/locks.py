@@ -0,0 +1,114 @@
+"""
+This module holds the locks and the conditions of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import unittest
+from threading import Condition, Lock
+
+from .metrics import Metrics
+
+
+class MarketLocks:
+    """
+    The locks of a Marketplace: the locks of the ids, the lock stripes guarding the
+    inventory index, each with a condition signaled when a product in the stripe is
+    published or returned from a cart, and the producers' locks, each guarding the
+    producer's buffer, with a condition signaled when a unit leaves the buffer
+    """
+
+    def __init__(self, lock_stripes=16, metrics=None, profile=None):
+        """
+        Constructor
+
+        :type lock_stripes: Int
+        :param lock_stripes: the number of stripes, each product is mapped to one of them
+
+        :type metrics: metrics.Metrics
+        :param metrics: if given, the waits for the locks are timed under their names
+
+        :type profile: profiling.LockProfile
+        :param profile: if given, the waits and the holds of the locks are recorded per
+        call site, under their names
+        """
+        self.metrics = metrics
+        self.profile = profile
+        # lock access to the producers' ids
+        self.producers_id_lock = self.new_lock('producers_id_lock')
+        # lock access to the carts' ids
+        self.consumers_id_lock = self.new_lock('consumers_id_lock')
+        # used to control access to the inventory index, striped by product id
+        self.buffer_locks = [self.new_lock('buffer_locks[%d]' % stripe)
+                             for stripe in range(max(1, lock_stripes))]
+        # signaled when a product in the stripe is published or returned from a cart
+        self.stock_conditions = [Condition(lock) for lock in self.buffer_locks]
+        # a list<Condition> indexed by producer id, grown under producers_id_lock. It is
+        # kept when the id is freed.
+        self.capacity_conditions = []
+        self.print_lock = self.new_lock('print_lock')  # used for print() calls by consumers
+
+    def new_lock(self, name):
+        """
+        Returns a new lock, timed under the given name when the metrics are enabled and
+        profiled when a LockProfile was given
+        """
+        lock = Lock()
+        if self.metrics is not None:
+            lock = self.metrics.timed_lock(name, lock)
+        if self.profile is not None:
+            lock = self.profile.wrap(name, lock)
+        return lock
+
+    def add_capacity_condition(self):
+        """
+        Creates the condition of the next producer id, called under producers_id_lock
+
+        :returns the new Condition
+        """
+        producer_id = len(self.capacity_conditions)
+        condition = Condition(self.new_lock('capacity_conditions[%d]' % producer_id))
+        self.capacity_conditions.append(condition)
+        return condition
+
+    def stock_condition(self, product_id):
+        """
+        Returns the condition built on the lock stripe guarding the stock of the given product
+        """
+        return self.stock_conditions[product_id % len(self.stock_conditions)]
+
+
+class TestMarketLocks(unittest.TestCase):
+    """
+    Unit testing for the locks of the Marketplace
+    """
+
+    def test_stripes(self):
+        """
+        Check that every product maps to a stripe and a single stripe holds them all
+        """
+        locks = MarketLocks(16)
+        self.assertEqual(len(locks.buffer_locks), 16)
+        self.assertIs(locks.stock_condition(3), locks.stock_conditions[3])
+        self.assertIs(locks.stock_condition(19), locks.stock_conditions[3])
+
+        single = MarketLocks(1)
+        self.assertIs(single.stock_condition(0), single.stock_condition(5))
+
+    def test_timed_locks(self):
+        """
+        Check that the locks are timed under their names when the metrics are enabled
+        """
+        metrics = Metrics()
+        locks = MarketLocks(2, metrics=metrics)
+        condition = locks.add_capacity_condition()
+        with condition:
+            condition.notify()
+        with locks.producers_id_lock:
+            pass
+
+        lock_waits = metrics.snapshot()['lock_wait']
+        self.assertEqual(lock_waits['capacity_conditions[0]']['count'], 1)
+        self.assertEqual(lock_waits['producers_id_lock']['count'], 1)
+        self.assertIn('buffer_locks[1]', lock_waits)
@@ -0,0 +1,145 @@
+"""
+This module configures the logging of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import logging
+import queue
+import time
+import unittest
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+LOG_FORMAT = "[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s"
+LOG_DATE_FORMAT = '%Y-%m-%d T%H:%M:%S'
+LOG_MODES = ["sync", "queue", "off"]
+
+TRACE_LOGGER = "tema.marketplace"  # the logger the Marketplace traces its calls to
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through one record out of every sample_every
+    """
+
+    def __init__(self, sample_every):
+        super().__init__()
+        self.sample_every = sample_every
+        self.seen = 0
+
+    def filter(self, record):
+        # an unlocked counter is fine, a lost increment only shifts the sample
+        self.seen += 1
+        return self.seen % self.sample_every == 0
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves the formatting of the message to the listener's thread.
+    The arguments logged by the Marketplace are immutable, so they can be formatted later.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(mode="sync", filename="marketplace.log", max_bytes=10000,
+                      backup_count=1, sample_every=1):
+    """
+    Configures the marketplace logging.
+
+    :type mode: String
+    :param mode: "sync" writes the records from the calling thread, "queue" hands them
+    to a background thread that does the formatting and the writing, "off" disables the
+    per-call tracing of the Marketplace
+
+    :type filename: String
+    :param filename: the log file
+
+    :type max_bytes: Int
+    :param max_bytes: the size at which the log file is rotated, 0 never rotates it
+
+    :type backup_count: Int
+    :param backup_count: how many rotated log files are kept
+
+    :type sample_every: Int
+    :param sample_every: keep only one record out of every sample_every
+
+    :returns the QueueListener of the "queue" mode, which the caller should stop() at
+    exit so the remaining records are written, or None
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+    if mode == "off":
+        logging.getLogger(TRACE_LOGGER).setLevel(logging.WARNING)
+        return None
+    logging.getLogger(TRACE_LOGGER).setLevel(logging.NOTSET)
+
+    formatter = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
+    formatter.converter = time.gmtime
+    file_handler = RotatingFileHandler(filename, mode='a', maxBytes=max_bytes,
+                                       backupCount=backup_count)
+    file_handler.setFormatter(formatter)
+
+    listener = None
+    if mode == "queue":
+        handler = DeferredQueueHandler(queue.SimpleQueue())
+        listener = QueueListener(handler.queue, file_handler)
+        listener.start()
+    else:
+        handler = file_handler
+
+    if sample_every > 1:
+        handler.addFilter(SamplingFilter(sample_every))
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+    return listener
+
+
+class TestLogConfig(unittest.TestCase):
+    """
+    Unit testing for the logging modes
+    """
+
+    def tearDown(self):
+        """
+        Leave the root logger without handlers
+        """
+        configure_logging("off")
+        logging.getLogger(TRACE_LOGGER).setLevel(logging.NOTSET)
+
+    def test_sampling(self):
+        """
+        Check that the filter keeps one record in every sample_every
+        """
+        sampling = SamplingFilter(3)
+        record = logging.makeLogRecord({})
+        self.assertListEqual([sampling.filter(record) for _ in range(6)],
+                             [False, False, True, False, False, True])
+
+    def test_off(self):
+        """
+        Check that the tracing can be disabled
+        """
+        self.assertIsNone(configure_logging("off"))
+        self.assertFalse(logging.getLogger(TRACE_LOGGER).isEnabledFor(logging.INFO))
+        self.assertListEqual(logging.getLogger().handlers, [])
+
+    def test_queue(self):
+        """
+        Check that the queue mode writes the records from the listener
+        """
+        listener = configure_logging("queue", filename="/dev/null", max_bytes=0)
+        # the file handler belongs to the listener, configure_logging does not close it
+        for file_handler in listener.handlers:
+            self.addCleanup(file_handler.close)
+        self.addCleanup(listener.stop)
+
+        handler = logging.getLogger().handlers[0]
+        self.assertIsInstance(handler, DeferredQueueHandler)
+        self.assertTrue(logging.getLogger(TRACE_LOGGER).isEnabledFor(logging.INFO))
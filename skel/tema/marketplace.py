@@ -8,16 +8,18 @@ March 2021
 import time
 import unittest
 import logging
-from threading import Lock
-from logging.handlers import RotatingFileHandler
-from .product import Tea, Coffee
+from threading import Timer
+from .buffer import ProducerTable
+from .cart import Cart
+from . import persistence
+from .inventory import InventoryIndex
+from .locks import MarketLocks
+from .metrics import Metrics
+from .product import Tea, Coffee, ProductRegistry
+from .retry import RetryHints
 
-logging.basicConfig(
-    handlers=[RotatingFileHandler("marketplace.log", mode='a', maxBytes=10000, backupCount=1)],
-    level=logging.DEBUG,
-    format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
-    datefmt='%Y-%m-%d T%H:%M:%S')
-logging.Formatter.converter = time.gmtime
+# The handlers are set up by log_config.configure_logging, not when this module is imported
+LOGGER = logging.getLogger(__name__)
 
 
 class Marketplace:
@@ -26,50 +28,166 @@ class Marketplace:
     The producers and consumers use its methods concurrently.
     """
 
-    def __init__(self, queue_size_per_producer):
+    def __init__(self, queue_size_per_producer, lock_stripes=16, metrics=False,
+                 selection='first-fit', retry_hints=False, wal=None, trace=None,
+                 profile=None):
         """
         Constructor
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type lock_stripes: Int
+        :param lock_stripes: the number of locks guarding the producers' buffers. Each product
+        is mapped to one of them, so consumers buying different products rarely contend
+
+        :type metrics: Bool
+        :param metrics: if True, measure the latency of the methods, the waits on the locks,
+        the retries and the buffers' occupancy (see metrics_snapshot). Otherwise the methods
+        and the locks are left as they are.
+
+        :type selection: String
+        :param selection: the policy choosing which producer's units a consumer gets,
+        one of selection.SELECTION_POLICIES
+
+        :type retry_hints: Bool
+        :param retry_hints: if True, track how often units arrive in stock and leave the
+        buffers, so publish_retry_after and add_retry_after can estimate when a failed
+        operation could succeed
+
+        :type wal: persistence.WriteAheadLog
+        :param wal: if given, every change of the producers, the stock and the carts is
+        logged to it, so the marketplace can be recovered (see persistence.open_marketplace)
+
+        :type trace: trace.TraceRecorder
+        :param trace: if given, the calls to the marketplace are recorded in a binary trace,
+        which trace.TraceReplayer can replay
+
+        :type profile: profiling.LockProfile
+        :param profile: if given, the locks are wrapped so that their waits and holds are
+        recorded per call site
+
+        The methods accept a product either as a Product or as the id it was given by
+        the marketplace's registry.
         """
-        logging.info('Call __init__(queue_size_per_producer = %d)', queue_size_per_producer)
+        LOGGER.info('Call __init__(queue_size_per_producer = %d, lock_stripes = %d)',
+                    queue_size_per_producer, lock_stripes)
 
         self.queue_size_per_producer = queue_size_per_producer
-        self.num_producers = 0  # the number of producers currently registered in the marketplace
-        self.num_consumers = 0  # number of consumers/carts currently registered in the marketplace
-        self.producers_id_lock = Lock()  # lock access to atomic integer num_producers
-        self.consumers_id_lock = Lock()  # lock access to atomic integer num_consumers
-        self.buffer_removal_lock = Lock()  # used to control access to producers buffers
-        self.print_lock = Lock()  # lock used for print() calls by consumers
-        self.carts = {}  # a dict<id, cart>, a cart is a list of tuples (buffer_id, product)
-        self.producers_buffers = {}  # a dict<id, buffer>, a buffer is a list of products
+        self.metrics = Metrics() if metrics else None
+        self.locks = MarketLocks(lock_stripes, self.metrics, profile)
+        self.registry = ProductRegistry()  # gives every distinct product an integer id
+        self.producers = ProducerTable()  # the producers' buffers, indexed by producer id
+        # a list<Cart> indexed by cart id, a multiset of (producer key, product_id) pairs.
+        # The ids are reused once released, so it only grows with the number of carts in
+        # use at the same time.
+        self.carts = []
+        self.free_cart_ids = []  # the ids of the released carts, reused by new_cart
+        self.inventory = InventoryIndex(selection)  # the units in stock, per producer
+        # the estimates of publish_retry_after and add_retry_after, None without retry_hints
+        self.hints = RetryHints() if retry_hints else None
+        self.wal = wal
+        if wal is not None:
+            wal.attach(self.registry)
+
+        if self.metrics is not None:
+            for name in ['publish', 'publish_many', 'add_to_cart', 'remove_from_cart',
+                         'place_order']:
+                setattr(self, name, self.metrics.timed(name, getattr(self, name)))
+        if trace is not None:
+            trace.attach(self)
+
+        LOGGER.info('Ret __init__')
+
+    @property
+    def num_producers(self):
+        """
+        The number of producers currently registered in the marketplace
+        """
+        return len(self.producers)
 
-        logging.info('Ret __init__')
+    @property
+    def num_consumers(self):
+        """
+        The number of carts currently in use
+        """
+        return len(self.carts) - len(self.free_cart_ids)
 
     def get_print_lock(self):
         """
         Returns the lock used for printing consumer lists
         """
-        logging.info('Call get_print_lock()')
-        logging.info('Ret get_print_lock')
-        return self.print_lock
+        LOGGER.info('Call get_print_lock()')
+        LOGGER.info('Ret get_print_lock')
+        return self.locks.print_lock
 
     def register_producer(self):
         """
         Returns an id for the producer that calls this.
         """
-        logging.info('Call register_producer()')
+        LOGGER.info('Call register_producer()')
 
-        with self.producers_id_lock:
-            prod_id = self.num_producers
-            self.producers_buffers[prod_id] = []
-            self.num_producers += 1
+        with self.locks.producers_id_lock:
+            prod_id = self.producers.allocate()
+            if prod_id == len(self.locks.capacity_conditions):
+                self.locks.add_capacity_condition()
+            with self.locks.capacity_conditions[prod_id]:
+                key = self.producers.start(prod_id)
+            if self.wal is not None:
+                self.wal.append((persistence.REGISTER,) + key)
 
-        logging.info('Ret register_producer')
+        if self.wal is not None:
+            self.wal.commit()
+
+        LOGGER.info('Ret register_producer')
         return prod_id
 
-    def publish(self, producer_id, product):
+    def unregister_producer(self, producer_id):
+        """
+        Takes a producer out of the marketplace, along with its units still in stock. It is
+        called by the producer itself, once it stopped publishing. The units it sold that
+        are still in carts stay there; if a consumer removes them, they are dropped.
+        The producer's id may then be given to a new producer.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :returns a list with the producer's unsold products, one per unit
+        """
+        LOGGER.info('Call unregister_producer(producer_id = %d)', producer_id)
+
+        capacity = self.locks.capacity_conditions[producer_id]
+        with capacity:
+            # From now on, its units taken or returned by consumers skip its buffer
+            self.producers.keys[producer_id] = None
+            products = list(self.producers.buffers[producer_id].products)
+
+        # Take its units out of stock. Those a consumer reserved meanwhile are not in the
+        # index anymore, they are the consumer's.
+        unsold = []
+        for product in products:
+            product_id = self.registry.intern(product)
+            with self.locks.stock_condition(product_id):
+                count = self.inventory.drop(producer_id, product_id)
+            unsold += [product] * count
+
+        with self.locks.producers_id_lock:
+            with capacity:
+                self.producers.release(producer_id)
+            if self.hints is not None:
+                self.hints.forget_producer(producer_id)
+            if self.metrics is not None:
+                self.metrics.full_since.pop(producer_id, None)
+            if self.wal is not None:
+                self.wal.append((persistence.UNREGISTER, producer_id))
+
+        if self.wal is not None:
+            self.wal.commit()
+
+        LOGGER.info('Ret unregister_producer = %d units', len(unsold))
+        return unsold
+
+    def publish(self, producer_id, product, timeout=0):
         """
         Adds the product provided by the producer to the marketplace
 
@@ -79,18 +197,47 @@ class Marketplace:
         :type product: Product
         :param product: the Product that will be published in the Marketplace
 
+        :type timeout: Float
+        :param timeout: how many seconds to wait for room in the producer's buffer.
+        0 returns immediately, None waits for as long as it takes
+
         :returns True or False. If the caller receives False, it should wait and then try again.
         """
-        logging.info('Call publish(producer_id = %d, product = %s)', producer_id, product)
+        LOGGER.info('Call publish(producer_id = %d, product = %s)', producer_id, product)
+
+        published = self._publish(producer_id, product, 1, timeout) == 1
+
+        LOGGER.info('Ret publish = %s', published)
+        return published
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds up to quantity units of the product to the marketplace, as many as there
+        is room for in the producer's buffer
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type quantity: Int
+        :param quantity: the number of units to publish
+
+        :type timeout: Float
+        :param timeout: how many seconds to wait for room in the producer's buffer.
+        0 returns immediately, None waits for as long as it takes
+
+        :returns the number of units published. If the caller receives 0, it should wait
+        and then try again.
+        """
+        LOGGER.info('Call publish_many(producer_id = %d, product = %s, quantity = %d)',
+                    producer_id, product, quantity)
 
-        products = self.producers_buffers[producer_id]
-        if len(products) < self.queue_size_per_producer:
-            products.append(product)
-            logging.info('Ret publish = True')
-            return True
+        published = self._publish(producer_id, product, quantity, timeout)
 
-        logging.info('Ret publish = False')
-        return False
+        LOGGER.info('Ret publish_many = %d', published)
+        return published
 
     def new_cart(self):
         """
@@ -98,19 +245,51 @@ class Marketplace:
 
         :returns an int representing the cart_id
         """
-        logging.info('Call new_cart()')
+        LOGGER.info('Call new_cart()')
+
+        with self.locks.consumers_id_lock:
+            if self.free_cart_ids:
+                # released carts are empty
+                cons_id = self.free_cart_ids.pop()
+            else:
+                cons_id = len(self.carts)
+                self.carts.append(Cart())
+            if self.wal is not None:
+                self.wal.append((persistence.NEW_CART, cons_id))
+
+        if self.wal is not None:
+            self.wal.commit()
+
+        LOGGER.info('Ret new_cart')
+        return cons_id
 
-        with self.consumers_id_lock:
-            cons_id = self.num_consumers
-            self.carts[cons_id] = []
-            self.num_consumers += 1
+    def release_cart(self, cart_id):
+        """
+        Gives up a cart once its order was placed: the units still in it go back in stock
+        and its id may be given to a new cart, so it must not be used anymore
 
-        logging.info('Ret new_cart')
-        return cons_id
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        LOGGER.info('Call release_cart(cart_id = %d)', cart_id)
+
+        cart = self.carts[cart_id]
+        for product_id in list(cart.products):
+            self.remove_from_cart(cart_id, product_id, cart.count(product_id))
+
+        with self.locks.consumers_id_lock:
+            self.free_cart_ids.append(cart_id)
+            if self.wal is not None:
+                self.wal.append((persistence.RELEASE_CART, cart_id))
 
-    def add_to_cart(self, cart_id, product):
+        if self.wal is not None:
+            self.wal.commit()
+
+        LOGGER.info('Ret release_cart')
+
+    def add_to_cart(self, cart_id, product, quantity=1, timeout=0):
         """
-        Adds a product to the given cart.
+        Adds up to quantity units of a product to the given cart.
 
         :type cart_id: Int
         :param cart_id: id cart
@@ -118,46 +297,140 @@ class Marketplace:
         :type product: Product
         :param product: the product to add to cart
 
-        Returns True or False. If the caller receives False, it should wait and then try again
+        :type quantity: Int
+        :param quantity: the number of units to add
+
+        :type timeout: Float
+        :param timeout: how many seconds to wait for the product to be in stock.
+        0 returns immediately, None waits for as long as it takes
+
+        Returns the number of units added. If the caller receives 0, it should wait and
+        then try again
         """
-        logging.info('Call add_to_cart(cart_id = %d, product = %s)', cart_id, product)
+        LOGGER.info('Call add_to_cart(cart_id = %d, product = %s, quantity = %d)',
+                    cart_id, product, quantity)
 
-        # Look for the product in the producers' buffers
-        with self.buffer_removal_lock:
-            for idx, buffer in self.producers_buffers.items():
-                if buffer.count(product) > 0:
-                    # Add it to the cart
-                    self.carts[cart_id].append((idx, product))
-                    # Remove it from the producer's buffer (restrict other consumers from buying)
-                    buffer.remove(product)
+        added, _ = self._add_to_cart(cart_id, product, quantity, timeout)
 
-                    logging.info('Call add_to_cart = True')
-                    return True
-        logging.info('Call add_to_cart = False')
-        return False
+        LOGGER.info('Ret add_to_cart = %d', added)
+        return added
 
-    def remove_from_cart(self, cart_id, product):
+    def _add_to_cart(self, cart_id, product, quantity, timeout):
         """
-        Removes a product from cart.
+        Does the work of add_to_cart
+
+        :returns the number of units added and a dict<producer_id, count> of the units
+        taken from each producer's buffer
+        """
+        product_id, product = self._intern(product)
+        taken = {}  # a dict<producer_id, count> of the units reserved from each buffer
+        keys = {}  # a dict<producer_id, the key of the producer they were reserved from>
+
+        # Look up the producers holding the product in the inventory index
+        inventory = self.inventory
+        stock = self.locks.stock_condition(product_id)
+        with stock:
+            if not inventory.available(product_id) and timeout != 0:
+                stock.wait_for(lambda: inventory.available(product_id), timeout)
+
+            added = 0
+            while added < quantity:
+                idx = inventory.select(product_id, self.producers.buffers)
+                if idx is None:
+                    break
+                count = min(inventory.holders[product_id][idx], quantity - added)
+                # Out of the index, no other consumer can reserve them
+                inventory.remove(idx, product_id, count)
+                # Add them to the cart
+                # a producer that started unregistering has no key anymore: its units are
+                # sold under one that is never current, as those of a departed producer
+                keys[idx] = self.producers.keys[idx] or (idx, -1)
+                self.carts[cart_id].add(keys[idx], product_id, count)
+                taken[idx] = count
+                added += count
+                if self.wal is not None:
+                    self.wal.append((persistence.ADD, cart_id, product_id) + keys[idx]
+                                    + (count,))
+
+        # Free their room in the producers' buffers and wake up the producers waiting for it
+        for idx, count in taken.items():
+            capacity = self.locks.capacity_conditions[idx]
+            with capacity:
+                if self.producers.keys[idx] is not keys[idx]:
+                    # the producer unregistered meanwhile, its buffer is gone
+                    continue
+                buffer = self.producers.buffers[idx]
+                if self.metrics is not None and len(buffer) >= self.queue_size_per_producer:
+                    self.metrics.record_buffer_freed(idx)
+                buffer.remove(product, count)
+                if self.hints is not None:
+                    self.hints.record_departure(idx)
+                capacity.notify(count)
+
+        if added and self.wal is not None:
+            self.wal.commit()
+        return added, taken
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        Removes up to quantity units of a product from cart.
 
         :type cart_id: Int
         :param cart_id: id cart
 
         :type product: Product
         :param product: the product to remove from cart
-        """
-        logging.info('Call remove_from_cart(cart_id = %d, product = %s)', cart_id, product)
 
-        # Search for the product in the cart
-        for (idx, prod) in self.carts[cart_id]:
-            if prod == product:
-                # Remove it from the cart
-                self.carts[cart_id].remove((idx, prod))
-                # Add it back to the producer's buffer
-                self.producers_buffers[idx].append(product)
-                break
+        :type quantity: Int
+        :param quantity: the number of units to remove
 
-        logging.info('Ret remove_from_cart')
+        Returns the number of units removed
+        """
+        LOGGER.info('Call remove_from_cart(cart_id = %d, product = %s, quantity = %d)',
+                    cart_id, product, quantity)
+
+        product_id, product = self._intern(product)
+
+        # Take the units out of the cart, along with the producers they came from
+        removed_units = self.carts[cart_id].remove(product_id, quantity)
+        removed = sum(removed_units.values())
+
+        # Add them back to the producers' buffers, then back in stock. The units of the
+        # producers that unregistered are dropped.
+        returned = {}  # a dict<producer key, count> of the units added back
+        for key, count in removed_units.items():
+            idx = key[0]
+            with self.locks.capacity_conditions[idx]:
+                if self.producers.keys[idx] is not key:
+                    continue
+                buffer = self.producers.buffers[idx]
+                buffer.add(product, count)
+                if self.metrics is not None and len(buffer) >= self.queue_size_per_producer:
+                    self.metrics.record_buffer_full(idx)
+            returned[key] = count
+
+        if returned:
+            stock = self.locks.stock_condition(product_id)
+            with stock:
+                for key, count in list(returned.items()):
+                    # unless the producer started unregistering meanwhile
+                    if self.producers.keys[key[0]] is key:
+                        self.inventory.add(key[0], product_id, count)
+                    else:
+                        del returned[key]
+                if self.hints is not None:
+                    self.hints.record_arrival(product_id)
+                stock.notify_all()
+                # logged under the stripe, as the units taken from stock are
+                if self.wal is not None:
+                    self.wal.append_removed(cart_id, product_id, removed_units, returned)
+        elif removed and self.wal is not None:
+            self.wal.append_removed(cart_id, product_id, removed_units, returned)
+        if removed and self.wal is not None:
+            self.wal.commit()
+
+        LOGGER.info('Ret remove_from_cart = %d', removed)
+        return removed
 
     def place_order(self, cart_id):
         """
@@ -166,18 +439,149 @@ class Marketplace:
         :type cart_id: Int
         :param cart_id: id cart
         """
-        logging.info('Call place_order(cart_id = %d)', cart_id)
+        LOGGER.info('Call place_order(cart_id = %d)', cart_id)
+
+        # Expand the cart to one product per unit, then empty it
+        cart = self.carts[cart_id]
+        products = self.registry.products
+        result = [products[product_id] for product_id in cart.expand()]
+        cart.clear()
+        if self.wal is not None:
+            self.wal.append((persistence.ORDER, cart_id))
+            self.wal.commit()
+
+        LOGGER.info('Ret place_order')
+        return result
 
-        result = []
-        # Add each product to return list
-        for (_, prod) in self.carts[cart_id]:
-            result.append(prod)
+    def available(self, product):
+        """
+        Returns the number of units of a product in stock, without taking any lock: a unit
+        counted here may be taken by another consumer before add_to_cart is called
 
-        # Empty this cart
-        self.carts[cart_id].clear()
+        :type product: Product
+        :param product: the product, or its id
+        """
+        if isinstance(product, int):
+            product_id = product
+        else:
+            # a product never published is not registered
+            product_id = self.registry.ids.get(product)
+        return self.inventory.available(product_id)
+
+    def inventory_snapshot(self):
+        """
+        Returns a dict<product, units in stock> of the products in stock, without taking any
+        lock. The count of each product is one that really was in stock, but the counts of
+        different products may have been read between two changes.
+        """
+        # copied in one step, the other threads cannot change it meanwhile
+        stock_counts = self.inventory.counts.copy()
+        products = self.registry.products
+        return {products[product_id]: count
+                for product_id, count in stock_counts.items() if count}
 
-        logging.info('Ret place_order')
-        return result
+    def publish_retry_after(self, producer_id):
+        """
+        Estimates when the producer's full buffer will have room again, from how often
+        units left it so far
+
+        :type producer_id: Int
+        :param producer_id: producer id
+
+        :returns the number of seconds, or None without retry_hints or enough history
+        """
+        if self.hints is None:
+            return None
+        return self.hints.room_wait(producer_id)
+
+    def add_retry_after(self, product):
+        """
+        Estimates when a product that is out of stock will be published again, from how
+        often its units arrived so far
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :returns the number of seconds, or None without retry_hints or enough history
+        """
+        if self.hints is None:
+            return None
+        product_id, _ = self._intern(product)
+        return self.hints.stock_wait(product_id)
+
+    def record_retry(self, operation):
+        """
+        Called by producers and consumers when an operation failed and has to be retried
+
+        :type operation: String
+        :param operation: the name of the method that failed
+        """
+        if self.metrics is not None:
+            self.metrics.record_retry(operation)
+
+    def metrics_snapshot(self):
+        """
+        Returns the measurements taken so far as a dict: the latency histograms of the
+        methods, the waits on each lock, the retry counts, how long the buffers stayed
+        full and the peak and current occupancy of each producer's buffer. Without
+        metrics, only the occupancy is known.
+        """
+        snapshot = self.metrics.snapshot() if self.metrics is not None else {}
+        snapshot['enabled'] = self.metrics is not None
+        snapshot['occupancy'] = {prod_id: len(buffer)
+                                 for prod_id, buffer in enumerate(list(self.producers.buffers))
+                                 if buffer is not None}
+        return snapshot
+
+    def _intern(self, product):
+        """
+        Returns the id and the interned instance of a product given as a Product or an id
+        """
+        if isinstance(product, int):
+            product_id = product
+        else:
+            product_id = self.registry.intern(product)
+        return product_id, self.registry.products[product_id]
+
+    def _publish(self, producer_id, product, quantity, timeout):
+        """
+        Appends up to quantity units of the product to the producer's buffer, waiting at most
+        timeout seconds for room in it. Returns the number of units appended
+        """
+        product_id, product = self._intern(product)
+        buffer = self.producers.buffers[producer_id]
+
+        # Take room in the buffer, under the producer's lock
+        capacity = self.locks.capacity_conditions[producer_id]
+        with capacity:
+            if len(buffer) >= self.queue_size_per_producer and timeout != 0:
+                capacity.wait_for(lambda: len(buffer) < self.queue_size_per_producer,
+                                  timeout)
+
+            count = min(quantity, self.queue_size_per_producer - len(buffer))
+            if count <= 0:
+                return 0
+            buffer.add(product, count)
+            occupancy = len(buffer)
+            if self.metrics is not None and occupancy >= self.queue_size_per_producer:
+                self.metrics.record_buffer_full(producer_id)
+
+        # Then put the units in stock
+        stock = self.locks.stock_condition(product_id)
+        with stock:
+            self.inventory.add(producer_id, product_id, count)
+            if self.hints is not None:
+                self.hints.record_arrival(product_id)
+            stock.notify_all()
+            if self.wal is not None:
+                self.wal.append((persistence.PUBLISH, producer_id, product_id, count))
+
+        if self.wal is not None:
+            self.wal.commit()
+
+        if self.metrics is not None:
+            self.metrics.record_occupancy(producer_id, occupancy)
+        return count
 
 
 class TestMarketplace(unittest.TestCase):
@@ -211,8 +615,8 @@ class TestMarketplace(unittest.TestCase):
         self.assertEqual(self.prod_1, 1)
         self.assertEqual(self.marketplace.num_producers, 2)
 
-        self.assertListEqual(self.marketplace.producers_buffers[0], [])
-        self.assertTrue(len(self.marketplace.producers_buffers[0]) == 0)
+        self.assertListEqual(list(self.marketplace.producers.buffers[0]), [])
+        self.assertTrue(len(self.marketplace.producers.buffers[0]) == 0)
 
     def test_publish(self):
         """
@@ -222,21 +626,213 @@ class TestMarketplace(unittest.TestCase):
         self.assertTrue(self.marketplace.publish(self.prod_0, self.tea_product))
         self.assertTrue(self.marketplace.publish(self.prod_0, self.coffee_product))
 
-        self.assertIn(self.tea_product, self.marketplace.producers_buffers[0])
-        self.assertIn(self.coffee_product, self.marketplace.producers_buffers[0])
-        self.assertNotIn(self.coffee_product, self.marketplace.producers_buffers[1])
+        self.assertIn(self.tea_product, self.marketplace.producers.buffers[0])
+        self.assertIn(self.coffee_product, self.marketplace.producers.buffers[0])
+        self.assertNotIn(self.coffee_product, self.marketplace.producers.buffers[1])
 
         self.assertTrue(self.marketplace.publish(self.prod_1, self.coffee_product))
-        self.assertIn(self.coffee_product, self.marketplace.producers_buffers[1])
+        self.assertIn(self.coffee_product, self.marketplace.producers.buffers[1])
 
-        self.assertEqual(len(self.marketplace.producers_buffers[0]), 2)
-        self.assertEqual(len(self.marketplace.producers_buffers[1]), 1)
+        self.assertEqual(len(self.marketplace.producers.buffers[0]), 2)
+        self.assertEqual(len(self.marketplace.producers.buffers[1]), 1)
 
         # Test buffer size doesn't exceed limit
         for i in range(2, self.max_buffer_size):
             self.assertTrue(self.marketplace.publish(self.prod_0, self.tea_product))
         self.assertFalse(self.marketplace.publish(self.prod_0, self.tea_product))
 
+    def test_inventory_index(self):
+        """
+        Check that the inventory index follows the producers' buffers
+        """
+        self.marketplace.publish(self.prod_0, self.tea_product)
+        self.marketplace.publish(self.prod_0, self.tea_product)
+        self.marketplace.publish(self.prod_1, self.tea_product)
+        tea_id = self.marketplace.registry.intern(self.tea_product)
+        self.assertDictEqual(self.marketplace.inventory.holders[tea_id],
+                             {self.prod_0: 2, self.prod_1: 1})
+
+        self.marketplace.add_to_cart(self.cons_0, self.tea_product)
+        self.marketplace.add_to_cart(self.cons_0, tea_id)
+        self.assertEqual(sum(self.marketplace.inventory.holders[tea_id].values()), 1)
+
+        self.marketplace.remove_from_cart(self.cons_0, self.tea_product)
+        self.assertEqual(sum(self.marketplace.inventory.holders[tea_id].values()), 2)
+
+        self.marketplace.place_order(self.cons_0)
+        self.assertEqual(sum(self.marketplace.inventory.holders[tea_id].values()), 2)
+        self.assertNotIn(self.marketplace.registry.intern(self.coffee_product),
+                         self.marketplace.inventory.holders)
+
+    def test_product_registry(self):
+        """
+        Check that equal products are interned once and the orders hold the interned ones
+        """
+        tea_copy = Tea("Some tea", 10, "A bit lame")
+        self.marketplace.publish(self.prod_0, self.tea_product)
+        self.marketplace.publish(self.prod_0, tea_copy)
+        self.assertEqual(self.marketplace.registry.intern(tea_copy),
+                         self.marketplace.registry.intern(self.tea_product))
+        self.assertEqual(len(self.marketplace.registry.products), 1)
+
+        self.marketplace.add_to_cart(self.cons_0, tea_copy, 2)
+        for product in self.marketplace.place_order(self.cons_0):
+            self.assertIs(product, self.tea_product)
+
+    def test_lock_stripes(self):
+        """
+        Check that the stripes are created and a single stripe, shared by every product,
+        still works
+        """
+        self.assertEqual(len(self.marketplace.locks.buffer_locks), 16)
+        self.assertEqual(len(self.marketplace.locks.stock_conditions), 16)
+
+        marketplace = Marketplace(self.max_buffer_size, lock_stripes=1)
+        self.assertEqual(len(marketplace.locks.stock_conditions), 1)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+        self.assertTrue(marketplace.publish(producer, self.tea_product))
+        self.assertTrue(marketplace.publish(producer, self.coffee_product))
+        self.assertTrue(marketplace.add_to_cart(cart, self.coffee_product))
+        self.assertListEqual(list(marketplace.producers.buffers[producer]), [self.tea_product])
+
+    def test_blocking_add_to_cart(self):
+        """
+        Check that a waiting consumer is woken up as soon as the product is published
+        """
+        self.assertFalse(self.marketplace.add_to_cart(self.cons_0, self.tea_product, timeout=0.01))
+
+        publisher = Timer(0.05, self.marketplace.publish, (self.prod_0, self.tea_product))
+        publisher.start()
+        start = time.monotonic()
+        self.assertTrue(self.marketplace.add_to_cart(self.cons_0, self.tea_product, timeout=5))
+        self.assertLess(time.monotonic() - start, 5)
+        publisher.join()
+
+    def test_blocking_publish(self):
+        """
+        Check that a producer waiting for room is woken up when a unit is bought
+        """
+        for _ in range(self.max_buffer_size):
+            self.marketplace.publish(self.prod_0, self.tea_product)
+        self.assertFalse(self.marketplace.publish(self.prod_0, self.tea_product, timeout=0.01))
+
+        buyer = Timer(0.05, self.marketplace.add_to_cart, (self.cons_0, self.tea_product))
+        buyer.start()
+        start = time.monotonic()
+        self.assertTrue(self.marketplace.publish(self.prod_0, self.coffee_product, timeout=5))
+        self.assertLess(time.monotonic() - start, 5)
+        buyer.join()
+
+    def test_bulk_operations(self):
+        """
+        Check that the quantity-aware operations move as many units as they can
+        """
+        self.assertEqual(self.marketplace.publish_many(self.prod_0, self.tea_product, 5), 5)
+        self.assertEqual(self.marketplace.publish_many(self.prod_0, self.coffee_product, 5), 3)
+        self.assertEqual(self.marketplace.publish_many(self.prod_0, self.coffee_product, 1), 0)
+        self.assertEqual(self.marketplace.publish_many(self.prod_1, self.tea_product, 2), 2)
+
+        self.assertEqual(self.marketplace.add_to_cart(self.cons_0, self.tea_product, 6), 6)
+        self.assertEqual(self.marketplace.add_to_cart(self.cons_1, self.tea_product, 6), 1)
+        self.assertEqual(self.marketplace.add_to_cart(self.cons_1, self.tea_product, 6), 0)
+        self.assertEqual(len(self.marketplace.carts[0]), 6)
+
+        self.assertEqual(self.marketplace.remove_from_cart(self.cons_0, self.tea_product, 4), 4)
+        self.assertEqual(self.marketplace.remove_from_cart(self.cons_0, self.coffee_product, 4), 0)
+        self.assertEqual(len(self.marketplace.carts[0]), 2)
+        tea_id = self.marketplace.registry.intern(self.tea_product)
+        self.assertEqual(sum(self.marketplace.inventory.holders[tea_id].values()), 4)
+        self.assertEqual(len(self.marketplace.producers.buffers[0])
+                         + len(self.marketplace.producers.buffers[1]), 7)
+
+    def test_metrics(self):
+        """
+        Check that the metrics are only taken when enabled
+        """
+        self.marketplace.publish(self.prod_0, self.tea_product)
+        snapshot = self.marketplace.metrics_snapshot()
+        self.assertFalse(snapshot['enabled'])
+        self.assertDictEqual(snapshot['occupancy'], {self.prod_0: 1, self.prod_1: 0})
+
+        marketplace = Marketplace(self.max_buffer_size, metrics=True)
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+        marketplace.publish_many(producer, self.tea_product, 3)
+        marketplace.add_to_cart(cart, self.tea_product, 2)
+        marketplace.add_to_cart(cart, self.coffee_product)
+        marketplace.record_retry('add_to_cart')
+        marketplace.place_order(cart)
+
+        snapshot = marketplace.metrics_snapshot()
+        self.assertTrue(snapshot['enabled'])
+        self.assertEqual(snapshot['latency']['add_to_cart']['count'], 2)
+        self.assertEqual(snapshot['latency']['place_order']['count'], 1)
+        self.assertGreater(snapshot['lock_wait']['consumers_id_lock']['count'], 0)
+        self.assertDictEqual(snapshot['retries'], {'add_to_cart': 1})
+        self.assertDictEqual(snapshot['peak_occupancy'], {producer: 3})
+        self.assertDictEqual(snapshot['occupancy'], {producer: 1})
+
+    def test_selection(self):
+        """
+        Check that the selection policy chooses the buffer the units are taken from, and
+        that the time a buffer stays full is measured
+        """
+        marketplace = Marketplace(2, metrics=True, selection='fullest-first')
+        producers = [marketplace.register_producer() for _ in range(2)]
+        cart = marketplace.new_cart()
+        marketplace.publish(producers[0], self.tea_product)
+        marketplace.publish(producers[0], self.coffee_product)
+        marketplace.publish_many(producers[1], self.tea_product, 2)
+
+        # first-fit would take the tea of producers[0], whose buffer it fills only half
+        self.assertEqual(marketplace.add_to_cart(cart, self.tea_product), 1)
+        self.assertDictEqual(marketplace.metrics_snapshot()['occupancy'],
+                             {producers[0]: 2, producers[1]: 1})
+        self.assertEqual(marketplace.metrics_snapshot()['stall']['count'], 1)
+
+        with self.assertRaises(KeyError):
+            Marketplace(2, selection='best-fit')
+
+    def test_available(self):
+        """
+        Check that the stock counts and the snapshot follow the inventory
+        """
+        self.assertEqual(self.marketplace.available(self.tea_product), 0)
+        self.marketplace.publish_many(self.prod_0, self.tea_product, 3)
+        self.marketplace.publish(self.prod_1, self.tea_product)
+        self.marketplace.publish(self.prod_1, self.coffee_product)
+        self.marketplace.add_to_cart(self.cons_0, self.coffee_product)
+        self.marketplace.add_to_cart(self.cons_0, self.tea_product, 2)
+
+        self.assertEqual(self.marketplace.available(self.tea_product), 2)
+        self.assertEqual(self.marketplace.available(self.coffee_product), 0)
+        self.assertDictEqual(self.marketplace.inventory_snapshot(), {self.tea_product: 2})
+
+        self.marketplace.remove_from_cart(self.cons_0, self.coffee_product)
+        coffee_id = self.marketplace.registry.intern(self.coffee_product)
+        self.assertEqual(self.marketplace.available(coffee_id), 1)
+
+    def test_retry_hints(self):
+        """
+        Check that the hints follow the intervals between arrivals and departures
+        """
+        self.assertIsNone(self.marketplace.add_retry_after(self.tea_product))
+
+        marketplace = Marketplace(1, retry_hints=True)
+        now = [0]
+        marketplace.hints.clock = lambda: now[0]
+        producer = marketplace.register_producer()
+        cart = marketplace.new_cart()
+        for now[0] in [0, 4]:
+            marketplace.publish(producer, self.tea_product)
+            marketplace.add_to_cart(cart, self.tea_product)
+
+        now[0] = 5
+        self.assertEqual(marketplace.add_retry_after(self.tea_product), 3)
+        self.assertEqual(marketplace.publish_retry_after(producer), 3)
+        self.assertIsNone(marketplace.add_retry_after(self.coffee_product))
+
     def test_new_cart(self):
         """
         Check that the consumers ID were given correctly and their carts exist and are empty
@@ -245,7 +841,7 @@ class TestMarketplace(unittest.TestCase):
         self.assertEqual(self.cons_2, 2)
         self.assertEqual(self.marketplace.num_consumers, 3)
 
-        self.assertListEqual(self.marketplace.carts[0], [])
+        self.assertIsInstance(self.marketplace.carts[0], Cart)
         self.assertTrue(len(self.marketplace.carts[0]) == 0)
 
     def test_add_to_cart(self):
@@ -269,8 +865,8 @@ class TestMarketplace(unittest.TestCase):
         # No more coffee available
         self.assertFalse(self.marketplace.add_to_cart(self.cons_0, self.coffee_product))
         self.assertFalse(self.marketplace.add_to_cart(self.cons_1, self.coffee_product))
-        self.assertNotIn(self.coffee_product, self.marketplace.producers_buffers[0])
-        self.assertNotIn(self.coffee_product, self.marketplace.producers_buffers[1])
+        self.assertNotIn(self.coffee_product, self.marketplace.producers.buffers[0])
+        self.assertNotIn(self.coffee_product, self.marketplace.producers.buffers[1])
 
     def test_remove_from_cart(self):
         """
@@ -297,8 +893,8 @@ class TestMarketplace(unittest.TestCase):
         self.assertEqual(len(self.marketplace.carts[0]), 1)
 
         # Producers received their Coffee back
-        self.assertIn(self.coffee_product, self.marketplace.producers_buffers[0])
-        self.assertIn(self.coffee_product, self.marketplace.producers_buffers[1])
+        self.assertIn(self.coffee_product, self.marketplace.producers.buffers[0])
+        self.assertIn(self.coffee_product, self.marketplace.producers.buffers[1])
 
         self.marketplace.remove_from_cart(self.cons_1, self.tea_product)
         self.marketplace.add_to_cart(self.cons_1, self.coffee_product)
@@ -328,8 +924,44 @@ class TestMarketplace(unittest.TestCase):
         self.assertIn(self.tea_product, order_1)
         self.assertIn(self.coffee_product, order_1)
         self.assertEqual(len(order_1), 3)
-        self.assertListEqual(self.marketplace.carts[1], [])
+        self.assertEqual(len(self.marketplace.carts[1]), 0)
 
         # No one gets their coffee back
-        self.assertNotIn(self.coffee_product, self.marketplace.producers_buffers[0])
-        self.assertNotIn(self.coffee_product, self.marketplace.producers_buffers[1])
+        self.assertNotIn(self.coffee_product, self.marketplace.producers.buffers[0])
+        self.assertNotIn(self.coffee_product, self.marketplace.producers.buffers[1])
+
+    def test_release_cart(self):
+        """
+        Check that a released cart returns its units in stock and its id is reused
+        """
+        self.marketplace.publish_many(self.prod_0, self.tea_product, 2)
+        self.marketplace.add_to_cart(self.cons_1, self.tea_product, 2)
+
+        self.marketplace.release_cart(self.cons_1)
+        self.assertEqual(self.marketplace.available(self.tea_product), 2)
+        self.assertEqual(self.marketplace.num_consumers, 2)
+
+        self.assertEqual(self.marketplace.new_cart(), self.cons_1)
+        self.assertEqual(len(self.marketplace.carts[self.cons_1]), 0)
+        self.assertEqual(len(self.marketplace.carts), 3)
+
+    def test_unregister_producer(self):
+        """
+        Check that an unregistered producer takes back its stock, the units of it
+        returned from carts are dropped and its id is reused with an empty buffer
+        """
+        self.marketplace.publish_many(self.prod_0, self.tea_product, 3)
+        self.marketplace.add_to_cart(self.cons_0, self.tea_product)
+
+        unsold = self.marketplace.unregister_producer(self.prod_0)
+        self.assertListEqual(unsold, [self.tea_product] * 2)
+        self.assertEqual(self.marketplace.available(self.tea_product), 0)
+        self.assertEqual(self.marketplace.num_producers, 1)
+        self.assertNotIn(self.prod_0, self.marketplace.metrics_snapshot()['occupancy'])
+
+        prod_id = self.marketplace.register_producer()
+        self.assertEqual(prod_id, self.prod_0)
+        self.assertEqual(self.marketplace.remove_from_cart(self.cons_0, self.tea_product), 1)
+        self.assertEqual(len(self.marketplace.producers.buffers[prod_id]), 0)
+        self.assertEqual(self.marketplace.available(self.tea_product), 0)
+        self.assertListEqual(self.marketplace.place_order(self.cons_0), [])
@@ -0,0 +1,291 @@
+"""
+This module offers the instrumentation used by the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import time
+import unittest
+from functools import wraps
+from threading import Lock
+
+SUB_BUCKETS = 4  # each power of two is split into this many histogram buckets
+
+
+def bucket_index(value):
+    """
+    Returns the histogram bucket of a non-negative integer value
+    """
+    if value < SUB_BUCKETS:
+        return value
+    exponent = value.bit_length() - 3
+    return (exponent + 1) * SUB_BUCKETS + ((value >> exponent) & (SUB_BUCKETS - 1))
+
+
+def bucket_bound(index):
+    """
+    Returns the smallest value that falls in the given histogram bucket
+    """
+    if index < SUB_BUCKETS:
+        return index
+    exponent = index // SUB_BUCKETS - 1
+    return (SUB_BUCKETS + index % SUB_BUCKETS) << exponent
+
+
+class Histogram:
+    """
+    Log-bucketed histogram of durations in nanoseconds, with a 25% resolution
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.buckets = {}  # a dict<bucket index, count>
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = Lock()
+
+    def record(self, value):
+        """
+        Adds a duration, in nanoseconds
+        """
+        index = bucket_index(value)
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        """
+        Returns an upper bound, in nanoseconds, of the given quantile (0..1)
+        """
+        with self.lock:
+            buckets = sorted(self.buckets.items())
+            count = self.count
+            maximum = self.max
+        if not count:
+            return 0
+
+        rank = fraction * count
+        seen = 0
+        for index, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= rank:
+                return min(bucket_bound(index + 1), maximum)
+        return maximum
+
+    def snapshot(self):
+        """
+        Returns the count and the duration statistics, in microseconds
+        """
+        with self.lock:
+            count, total, maximum = self.count, self.total, self.max
+        return {
+            'count': count,
+            'total_us': total / 1000,
+            'mean_us': total / count / 1000 if count else 0,
+            'p50_us': self.quantile(0.5) / 1000,
+            'p90_us': self.quantile(0.9) / 1000,
+            'p99_us': self.quantile(0.99) / 1000,
+            'max_us': maximum / 1000,
+        }
+
+
+class TimedLock:
+    """
+    Wraps a Lock and records how long each acquire() waited for it
+    """
+
+    def __init__(self, lock, histogram):
+        """
+        Constructor
+
+        :type lock: Lock
+        :param lock: the wrapped lock
+
+        :type histogram: Histogram
+        :param histogram: where the waits are recorded
+        """
+        self.lock = lock
+        self.histogram = histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the wrapped lock, recording the time spent waiting for it
+        """
+        start = time.perf_counter_ns()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.histogram.record(time.perf_counter_ns() - start)
+        return acquired
+
+    def release(self):
+        """
+        Releases the wrapped lock
+        """
+        self.lock.release()
+
+    def locked(self):
+        """
+        Returns True if the wrapped lock is held
+        """
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Metrics:
+    """
+    The measurements of one Marketplace: latency of its methods, waits on its locks,
+    retries of its producers and consumers and occupancy of the producers' buffers
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.latencies = {}  # a dict<method name, Histogram>
+        self.lock_waits = {}  # a dict<lock name, Histogram>
+        self.retries = {}  # a dict<operation, count> of the failed attempts
+        self.peak_occupancy = {}  # a dict<producer_id, the most units ever in its buffer>
+        # a dict<producer_id, when its buffer got full>, each key only changed under its
+        # producer's lock
+        self.full_since = {}
+        self.stalls = Histogram()  # how long the buffers stayed full, stalling their producers
+        self.lock = Lock()  # guards the dicts above
+
+    def timed(self, name, method):
+        """
+        Returns method wrapped so that each call's latency is recorded under name
+        """
+        histogram = self.latencies.setdefault(name, Histogram())
+
+        @wraps(method)
+        def timed_method(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter_ns() - start)
+
+        return timed_method
+
+    def timed_lock(self, name, lock):
+        """
+        Returns lock wrapped so that the waits for it are recorded under name
+        """
+        with self.lock:
+            histogram = self.lock_waits.setdefault(name, Histogram())
+        return TimedLock(lock, histogram)
+
+    def record_retry(self, operation):
+        """
+        Counts one failed attempt of the given operation
+        """
+        with self.lock:
+            self.retries[operation] = self.retries.get(operation, 0) + 1
+
+    def record_occupancy(self, producer_id, occupancy):
+        """
+        Records the number of units in a producer's buffer
+        """
+        if occupancy > self.peak_occupancy.get(producer_id, 0):
+            with self.lock:
+                if occupancy > self.peak_occupancy.get(producer_id, 0):
+                    self.peak_occupancy[producer_id] = occupancy
+
+    def record_buffer_full(self, producer_id):
+        """
+        Records that a producer's buffer got full, called under the producer's lock
+        """
+        self.full_since.setdefault(producer_id, time.perf_counter_ns())
+
+    def record_buffer_freed(self, producer_id):
+        """
+        Records that room was made in a full buffer, called under the producer's lock
+        """
+        since = self.full_since.pop(producer_id, None)
+        if since is not None:
+            self.stalls.record(time.perf_counter_ns() - since)
+
+    def snapshot(self):
+        """
+        Returns all the measurements as a dict of plain values
+        """
+        with self.lock:
+            lock_waits = dict(self.lock_waits)
+            retries = dict(self.retries)
+            peak_occupancy = dict(self.peak_occupancy)
+        return {
+            'latency': {name: histogram.snapshot()
+                        for name, histogram in self.latencies.items()},
+            'lock_wait': {name: histogram.snapshot() for name, histogram in lock_waits.items()},
+            'retries': retries,
+            'peak_occupancy': peak_occupancy,
+            'stall': self.stalls.snapshot(),
+        }
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Unit testing for the histograms and the instrumentation helpers
+    """
+
+    def test_buckets(self):
+        """
+        Check that every value falls between the bounds of its bucket
+        """
+        for value in list(range(100)) + [1000, 12345, 10 ** 9]:
+            index = bucket_index(value)
+            self.assertLessEqual(bucket_bound(index), value)
+            self.assertLess(value, bucket_bound(index + 1))
+
+    def test_quantiles(self):
+        """
+        Check that the quantiles are within the histogram's resolution
+        """
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value * 1000)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.quantile(0.5), 500000, delta=500000 * 0.25)
+        self.assertAlmostEqual(histogram.quantile(0.99), 990000, delta=990000 * 0.25)
+        self.assertEqual(histogram.quantile(1), 1000000)
+        self.assertEqual(Histogram().quantile(0.5), 0)
+
+    def test_instrumentation(self):
+        """
+        Check that the wrapped methods and locks are measured
+        """
+        metrics = Metrics()
+        method = metrics.timed('double', lambda value: 2 * value)
+        self.assertEqual(method(21), 42)
+
+        lock = metrics.timed_lock('lock', Lock())
+        with lock:
+            self.assertTrue(lock.locked())
+        self.assertFalse(lock.acquire(blocking=False) and lock.acquire(blocking=False))
+        lock.release()
+
+        metrics.record_retry('publish')
+
+        metrics.record_buffer_full(0)
+        metrics.record_buffer_freed(0)
+        metrics.record_buffer_freed(1)
+        self.assertEqual(metrics.snapshot()['stall']['count'], 1)
+        metrics.record_occupancy(0, 3)
+        metrics.record_occupancy(0, 1)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['latency']['double']['count'], 1)
+        self.assertEqual(snapshot['lock_wait']['lock']['count'], 2)
+        self.assertDictEqual(snapshot['retries'], {'publish': 1})
+        self.assertDictEqual(snapshot['peak_occupancy'], {0: 3})
@@ -0,0 +1,153 @@
+"""
+This module prints the orders placed by the consumers.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import io
+import queue
+import sys
+import unittest
+from collections import Counter
+from threading import Thread
+
+from .product import Tea, Coffee
+
+MAX_BATCH_ORDERS = 4096  # the most orders written with one write() call
+
+
+class OrderWriter(Thread):
+    """
+    Prints the orders of all the consumers from a single thread. Consumers only queue
+    their order; the writer renders every order queued meanwhile and writes them
+    with a single call, so the consumers neither wait for a print lock nor for the
+    output. Every product is rendered once.
+    """
+
+    def __init__(self, stream=None, aggregate=False):
+        """
+        Constructor
+
+        :type stream: File
+        :param stream: where the orders are written, sys.stdout by default
+
+        :type aggregate: Bool
+        :param aggregate: write "<consumer> bought <count> x <product>" once per product
+        of an order, instead of "<consumer> bought <product>" once per unit
+        """
+        Thread.__init__(self, name='OrderWriter', daemon=True)
+
+        self.stream = stream if stream is not None else sys.stdout
+        self.aggregate = aggregate
+        self.orders = queue.SimpleQueue()  # the (consumer name, products) not written yet
+        self.reprs = {}  # a dict<product, its text>, used by the writer thread only
+
+    def submit(self, consumer_name, products):
+        """
+        Queues an order to be written
+
+        :type consumer_name: String
+        :param consumer_name: the consumer that placed the order
+
+        :type products: List
+        :param products: the products returned by place_order()
+        """
+        self.orders.put((consumer_name, products))
+
+    def close(self):
+        """
+        Writes the orders still queued and stops the writer
+        """
+        self.orders.put(None)
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _product_repr(self, product):
+        """
+        Returns the text of a product, rendered the first time it is needed
+        """
+        text = self.reprs.get(product)
+        if text is None:
+            text = self.reprs[product] = str(product)
+        return text
+
+    def _render(self, consumer_name, products):
+        """
+        Returns the lines of an order
+        """
+        if self.aggregate:
+            return ['{} bought {} x {}\n'.format(consumer_name, count,
+                                                 self._product_repr(product))
+                    for product, count in Counter(products).items()]
+
+        prefix = consumer_name + ' bought '
+        return [prefix + self._product_repr(product) + '\n' for product in products]
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            orders = [self.orders.get()]
+            # take everything queued meanwhile, to write it at once
+            while len(orders) < MAX_BATCH_ORDERS and orders[-1] is not None:
+                try:
+                    orders.append(self.orders.get_nowait())
+                except queue.Empty:
+                    break
+
+            if orders[-1] is None:
+                stopping = True
+                orders.pop()
+
+            lines = []
+            for consumer_name, products in orders:
+                lines += self._render(consumer_name, products)
+            if lines:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+
+
+class TestOrderWriter(unittest.TestCase):
+    """
+    Unit testing for the order output
+    """
+
+    def setUp(self):
+        """
+        Set up the products used by the tests
+        """
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+    def test_write(self):
+        """
+        Check that every unit is written on its own line, in the order of the orders
+        """
+        stream = io.StringIO()
+        with OrderWriter(stream) as writer:
+            writer.submit('cons1', [self.tea_product, self.tea_product])
+            writer.submit('cons2', [])
+            writer.submit('cons2', [self.coffee_product])
+
+        self.assertListEqual(stream.getvalue().splitlines(),
+                             ['cons1 bought {}'.format(self.tea_product)] * 2
+                             + ['cons2 bought {}'.format(self.coffee_product)])
+        self.assertEqual(len(writer.reprs), 2)
+
+    def test_aggregate(self):
+        """
+        Check that the aggregated mode writes a count per product of an order
+        """
+        stream = io.StringIO()
+        with OrderWriter(stream, aggregate=True) as writer:
+            writer.submit('cons1', [self.tea_product, self.coffee_product, self.tea_product])
+
+        self.assertListEqual(stream.getvalue().splitlines(),
+                             ['cons1 bought 2 x {}'.format(self.tea_product),
+                              'cons1 bought 1 x {}'.format(self.coffee_product)])
@@ -0,0 +1,775 @@
+"""
+This module persists the state of a Marketplace: a write-ahead log of its changes,
+written in groups, and periodic snapshots, so it can be recovered after a restart.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import glob
+import itertools
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import zlib
+from collections import Counter
+from threading import Condition, Thread
+from unittest import mock
+
+from .product import Tea, Coffee
+
+# The record types, one per change of the marketplace's state. The records hold the
+# effects of the calls (e.g. which producer's units went in a cart), not their arguments,
+# so replaying them does not depend on the order the threads ran in.
+PRODUCT = 0  # a product got an id in the registry
+REGISTER = 1  # a producer registered, with the generation of its key
+UNREGISTER = 2  # a producer left, with its units in stock
+NEW_CART = 3
+RELEASE_CART = 4
+PUBLISH = 5  # units were added to a producer's buffer and to the stock
+ADD = 6  # units of a producer went from the stock to a cart
+REMOVE = 7  # units left a cart, going back in stock or dropped
+ORDER = 8  # a cart was emptied by place_order
+
+# a dict<record type, Struct> of the fields following the type byte, for the fixed-size
+# records; a PRODUCT record holds the product id and the length of the pickled product
+RECORD_FORMATS = {
+    PRODUCT: struct.Struct('<II'),
+    REGISTER: struct.Struct('<Iq'),
+    UNREGISTER: struct.Struct('<I'),
+    NEW_CART: struct.Struct('<I'),
+    RELEASE_CART: struct.Struct('<I'),
+    PUBLISH: struct.Struct('<III'),
+    ADD: struct.Struct('<IIIqI'),
+    REMOVE: struct.Struct('<IIIqIB'),
+    ORDER: struct.Struct('<I'),
+}
+FRAME_HEADER = struct.Struct('<II')  # the length and the CRC-32 of a group of records
+SNAPSHOT_HEADER = struct.Struct('<8sQI')  # the magic, the log position and the CRC-32
+SNAPSHOT_MAGIC = b'MKTSNAP1'
+SEGMENT_PATTERN = 'wal.{:016d}.log'  # named after the position of their first record
+SNAPSHOT_PATTERN = 'snapshot.{:016d}.bin'  # named after the position they were taken at
+
+
+class MarketState:
+    """
+    The state of a marketplace as the log describes it: the stock of every producer and
+    the content of every cart. Units reserved by add_to_cart or returned by
+    remove_from_cart are in a buffer or in a cart, never in between.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.products = []  # the products, indexed by their id in the registry
+        self.keys = {}  # a dict<producer_id, generation> of the registered producers
+        self.stock = {}  # a dict<producer_id, Counter<product_id>> of the units in stock
+        # a dict<cart_id, Counter<(product_id, producer_id, generation)>> of the carts in use
+        self.carts = {}
+        self.generation = 0  # the next generation of a producer key
+
+    def apply(self, record):
+        """
+        Applies a record, a tuple starting with its type, to the state
+        """
+        self.APPLIERS[record[0]](self, *record[1:])
+
+    def _publish(self, producer_id, product_id, count):
+        """
+        Applies a PUBLISH record
+        """
+        self.stock[producer_id][product_id] += count
+
+    def _add(self, cart_id, product_id, producer_id, generation, count):
+        """
+        Applies an ADD record
+        """
+        stock = self.stock[producer_id]
+        stock[product_id] -= count
+        if not stock[product_id]:
+            del stock[product_id]
+        self.carts[cart_id][(product_id, producer_id, generation)] += count
+
+    def _remove(self, cart_id, product_id, producer_id, generation, count, returned):
+        """
+        Applies a REMOVE record
+        """
+        cart = self.carts[cart_id]
+        key = (product_id, producer_id, generation)
+        cart[key] -= count
+        if not cart[key]:
+            del cart[key]
+        if returned:
+            self.stock[producer_id][product_id] += count
+
+    def _order(self, cart_id):
+        """
+        Applies an ORDER record
+        """
+        self.carts[cart_id].clear()
+
+    def _new_cart(self, cart_id):
+        """
+        Applies a NEW_CART record
+        """
+        self.carts[cart_id] = Counter()
+
+    def _release_cart(self, cart_id):
+        """
+        Applies a RELEASE_CART record
+        """
+        del self.carts[cart_id]
+
+    def _register(self, producer_id, generation):
+        """
+        Applies a REGISTER record
+        """
+        self.keys[producer_id] = generation
+        self.stock[producer_id] = Counter()
+        self.generation = max(self.generation, generation + 1)
+
+    def _unregister(self, producer_id):
+        """
+        Applies an UNREGISTER record
+        """
+        del self.keys[producer_id]
+        del self.stock[producer_id]
+
+    def _product(self, product_id, product):
+        """
+        Applies a PRODUCT record
+        """
+        assert product_id == len(self.products)
+        self.products.append(product)
+
+    # a dict<record type, the method applying its records, called with their fields>
+    APPLIERS = {PUBLISH: _publish, ADD: _add, REMOVE: _remove, ORDER: _order,
+                NEW_CART: _new_cart, RELEASE_CART: _release_cart, REGISTER: _register,
+                UNREGISTER: _unregister, PRODUCT: _product}
+
+    def restore(self, marketplace):
+        """
+        Loads the state in a new Marketplace, that has no producers, carts or products yet
+        and no write-ahead log attached
+        """
+        for product in self.products:
+            marketplace.registry.intern(product)
+        self._restore_producers(marketplace)
+        self._restore_carts(marketplace)
+
+    def _restore_producers(self, marketplace):
+        """
+        Registers the producers, with their keys, and fills their buffers
+        """
+        # the ids not in use go to the free lists, as if they had been released
+        num_producers = max(self.keys, default=-1) + 1
+        for producer_id in range(num_producers):
+            marketplace.register_producer()
+        for producer_id in reversed(range(num_producers)):
+            if producer_id not in self.keys:
+                marketplace.unregister_producer(producer_id)
+            else:
+                marketplace.producers.keys[producer_id] = (producer_id,
+                                                           self.keys[producer_id])
+        marketplace.producers.generations = itertools.count(self.generation)
+
+        for producer_id, stock in self.stock.items():
+            buffer = marketplace.producers.buffers[producer_id]
+            for product_id, count in stock.items():
+                buffer.add(self.products[product_id], count)
+                marketplace.inventory.add(producer_id, product_id, count)
+
+    def _restore_carts(self, marketplace):
+        """
+        Creates the carts and fills them with the units they held
+        """
+        num_carts = max(self.carts, default=-1) + 1
+        for _ in range(num_carts):
+            marketplace.new_cart()
+        for cart_id in reversed(range(num_carts)):
+            if cart_id not in self.carts:
+                marketplace.release_cart(cart_id)
+
+        for cart_id, units in self.carts.items():
+            cart = marketplace.carts[cart_id]
+            for (product_id, producer_id, generation), count in units.items():
+                key = marketplace.producers.keys[producer_id] \
+                    if producer_id < len(marketplace.producers.keys) else None
+                if key is None or key[1] != generation:
+                    # the producer left, these units are dropped if they are removed
+                    key = (producer_id, generation)
+                cart.add(key, product_id, count)
+
+
+def encode_records(records, products, num_defined):
+    """
+    Encodes records in the log format. The products that got an id since the last call
+    are defined first, with PRODUCT records.
+
+    :type products: List
+    :param products: the products of the registry, indexed by id
+
+    :type num_defined: Int
+    :param num_defined: the number of products already defined in the log
+
+    :returns the encoded records, the list of the records written (definitions included)
+    and the new number of products defined
+    """
+    chunks = []
+    written = []
+    for record in records:
+        kind = record[0]
+        if kind in (PUBLISH, ADD, REMOVE):
+            product_id = record[2]
+            while num_defined <= product_id:
+                definition = (PRODUCT, num_defined, products[num_defined])
+                data = pickle.dumps(definition[2], pickle.HIGHEST_PROTOCOL)
+                chunks.append(bytes([PRODUCT]))
+                chunks.append(RECORD_FORMATS[PRODUCT].pack(num_defined, len(data)))
+                chunks.append(data)
+                written.append(definition)
+                num_defined += 1
+        chunks.append(bytes([kind]))
+        chunks.append(RECORD_FORMATS[kind].pack(*record[1:]))
+        written.append(record)
+    return b''.join(chunks), written, num_defined
+
+
+def decode_records(data):
+    """
+    Decodes the records of a frame
+
+    :returns a list of records, as tuples starting with their type
+    """
+    records = []
+    offset = 0
+    while offset < len(data):
+        kind = data[offset]
+        record_format = RECORD_FORMATS[kind]
+        fields = record_format.unpack_from(data, offset + 1)
+        offset += 1 + record_format.size
+        if kind == PRODUCT:
+            product_id, length = fields
+            fields = (product_id, pickle.loads(data[offset:offset + length]))
+            offset += length
+        records.append((kind,) + fields)
+    return records
+
+
+def read_segment(filename):
+    """
+    Reads the records of a log segment, up to its first incomplete or corrupt frame,
+    which a crash in the middle of a write leaves at its end
+
+    :returns a list of records
+    """
+    records = []
+    with open(filename, 'rb') as segment:
+        data = segment.read()
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(data):
+        length, crc = FRAME_HEADER.unpack_from(data, offset)
+        frame = data[offset + FRAME_HEADER.size:offset + FRAME_HEADER.size + length]
+        if len(frame) < length or zlib.crc32(frame) != crc:
+            break
+        records += decode_records(frame)
+        offset += FRAME_HEADER.size + length
+    return records
+
+
+def write_snapshot(directory, state, position):
+    """
+    Writes the state, taken at the given log position, as the newest snapshot. The file
+    is only renamed in place once written, so a crash leaves the previous one.
+    """
+    data = pickle.dumps({'products': state.products, 'keys': state.keys,
+                         'stock': state.stock, 'carts': state.carts,
+                         'generation': state.generation}, pickle.HIGHEST_PROTOCOL)
+    temporary = os.path.join(directory, 'snapshot.tmp')
+    with open(temporary, 'wb') as snapshot:
+        snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, position, zlib.crc32(data)))
+        snapshot.write(data)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, os.path.join(directory, SNAPSHOT_PATTERN.format(position)))
+    sync_directory(directory)
+
+
+def read_snapshot(filename):
+    """
+    :returns the state and the log position of a snapshot, or None if it is corrupt
+    """
+    with open(filename, 'rb') as snapshot:
+        header = snapshot.read(SNAPSHOT_HEADER.size)
+        data = snapshot.read()
+    if len(header) < SNAPSHOT_HEADER.size:
+        return None
+    magic, position, crc = SNAPSHOT_HEADER.unpack(header)
+    if magic != SNAPSHOT_MAGIC or zlib.crc32(data) != crc:
+        return None
+
+    state = MarketState()
+    for name, value in pickle.loads(data).items():
+        setattr(state, name, value)
+    return state, position
+
+
+def sync_directory(directory):
+    """
+    Makes the files created, renamed or deleted in a directory durable
+    """
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def log_files(directory, pattern):
+    """
+    :returns a sorted list of (position, filename) of the segments or snapshots
+    """
+    prefix, suffix = pattern.split('{')[0], pattern.split('}')[1]
+    files = []
+    for filename in glob.glob(os.path.join(directory, prefix + '*' + suffix)):
+        position = os.path.basename(filename)[len(prefix):-len(suffix)]
+        if position.isdigit():
+            files.append((int(position), filename))
+    return sorted(files)
+
+
+def recover(directory):
+    """
+    Rebuilds the state saved in a directory: loads the newest valid snapshot, then
+    replays the records logged after it
+
+    :returns the MarketState and the log position it is at
+    """
+    state, position = MarketState(), 0
+    for _, filename in reversed(log_files(directory, SNAPSHOT_PATTERN)):
+        snapshot = read_snapshot(filename)
+        if snapshot is not None:
+            state, position = snapshot
+            break
+
+    # a segment only goes on from where the previous one ended
+    for segment_position, filename in log_files(directory, SEGMENT_PATTERN):
+        if segment_position < position:
+            continue
+        if segment_position > position:
+            break
+        records = read_segment(filename)
+        for record in records:
+            state.apply(record)
+        position += len(records)
+    return state, position
+
+
+class LogWriter:
+    """
+    The files of a log, only used by its writer thread: the segment the records are
+    written to, the snapshots, and the state the records written so far describe, saved
+    as a snapshot every snapshot_every records. The log then starts a new segment and the
+    older segments and snapshots are deleted, so recovering only replays the records of
+    the last segment.
+    """
+
+    def __init__(self, directory, state, position, snapshot_every):
+        """
+        Constructor. Writes the state as the first snapshot and deletes the files of any
+        other log in the directory.
+        """
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.state = state
+        self.position = position  # the number of records in the log
+        self.since_snapshot = 0  # the records written since the last snapshot
+        self.products = []  # the registry's products, indexed by id, set by attach
+
+        os.makedirs(directory, exist_ok=True)
+        old_files = log_files(directory, SEGMENT_PATTERN) \
+            + log_files(directory, SNAPSHOT_PATTERN)
+        write_snapshot(directory, self.state, position)
+        self.segment = self._open_segment()
+        try:
+            # the files just written may have the names of old ones
+            for file_position, filename in old_files:
+                if file_position != self.position:
+                    os.remove(filename)
+            sync_directory(directory)
+        except OSError:
+            self.segment.close()
+            raise
+
+    def write(self, records):
+        """
+        Writes a group of records as one frame, syncs it, then applies it to the state
+        """
+        data, written, _ = encode_records(records, self.products, len(self.state.products))
+        self.segment.write(FRAME_HEADER.pack(len(data), zlib.crc32(data)))
+        self.segment.write(data)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+
+        for record in written:
+            self.state.apply(record)
+        self.position += len(written)
+        self.since_snapshot += len(written)
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Saves the state, then goes on in a new segment and deletes the older files
+        """
+        write_snapshot(self.directory, self.state, self.position)
+        old_files = [filename for position, filename in log_files(self.directory,
+                                                                   SEGMENT_PATTERN)
+                     + log_files(self.directory, SNAPSHOT_PATTERN)
+                     if position < self.position]
+        self.segment.close()
+        self.segment = self._open_segment()
+        for filename in old_files:
+            os.remove(filename)
+        sync_directory(self.directory)
+        self.since_snapshot = 0
+
+    def close(self):
+        """
+        Writes a last snapshot if records were written since the previous one, then
+        closes the segment
+        """
+        try:
+            if self.since_snapshot:
+                self.snapshot()
+        finally:
+            self.segment.close()
+
+    def _open_segment(self):
+        """
+        Opens the segment the next records go to. It stays open across the writes, until
+        the next snapshot or close().
+        """
+        filename = os.path.join(self.directory, SEGMENT_PATTERN.format(self.position))
+        return open(filename, 'wb')  # pylint: disable=consider-using-with
+
+
+class WriteAheadLog:
+    """
+    Logs the changes of a Marketplace to a directory. The threads changing the
+    marketplace only queue their records; a background thread writes them in groups,
+    one write and one fsync per group, to a LogWriter.
+    """
+
+    def __init__(self, directory, state=None, position=0, sync=False, flush_interval=0.01,
+                 snapshot_every=100000):
+        """
+        Constructor. The log replaces any other log in the directory: to go on with
+        one, recover() it and pass its state and position.
+
+        :type directory: String
+        :param directory: where the segments and the snapshots are written
+
+        :type state: MarketState
+        :param state: the state recovered from the directory, None for a new log
+
+        :type position: Int
+        :param position: the log position of the recovered state
+
+        :type sync: Bool
+        :param sync: if True, the marketplace's methods return once their records are
+        on disk. Otherwise they are written within flush_interval seconds.
+
+        :type flush_interval: Float
+        :param flush_interval: the longest time a record is queued without sync
+
+        :type snapshot_every: Int
+        :param snapshot_every: the number of records between two snapshots
+        """
+        # pylint: disable=too-many-arguments
+        self.sync = sync
+        self.files = LogWriter(directory, state if state is not None else MarketState(),
+                               position, snapshot_every)
+        self.condition = Condition()  # guards the attributes below
+        self.pending = []  # the records queued, not written yet
+        self.queued = 0  # the number of records ever queued
+        self.durable = 0  # the number of queued records written and synced
+        self.waiting = 0  # the number of threads waiting for their records to be synced
+        self.closed = False
+        self.error = None  # the error that stopped the writer, raised to the callers
+
+        self.writer = Thread(target=self._write_loop, args=(flush_interval,),
+                             name='wal-writer', daemon=True)
+        self.writer.start()
+
+    def attach(self, registry):
+        """
+        Called by the Marketplace the log is given to, so that the products can be
+        defined in the log the first time a record refers to them
+        """
+        self.files.products = registry.products
+
+    def append(self, record):
+        """
+        Queues a record. Called with the marketplace's locks that order the change held,
+        so the records of a product or a cart are logged in the order they happened.
+        """
+        with self.condition:
+            self.pending.append(record)
+            self.queued += 1
+
+    def append_removed(self, cart_id, product_id, removed_units, returned):
+        """
+        Queues the records of the units removed from a cart, one per producer key. The
+        units of the keys in returned went back in stock, the others were dropped.
+        """
+        with self.condition:
+            for key, count in removed_units.items():
+                self.pending.append((REMOVE, cart_id, product_id) + key
+                                    + (count, key in returned))
+                self.queued += 1
+
+    def commit(self):
+        """
+        With sync, waits until the records queued so far are on disk. The records of the
+        threads waiting at the same time are written together.
+        """
+        if self.sync:
+            self.flush()
+
+    def flush(self):
+        """
+        Waits until the records queued so far are on disk
+        """
+        with self.condition:
+            target = self.queued
+            if self.durable >= target:
+                return
+            self.waiting += 1
+            self.condition.notify_all()
+            while self.durable < target and self.error is None:
+                self.condition.wait()
+            self.waiting -= 1
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        """
+        Writes the records still queued and a last snapshot, then stops the writer
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        if self.error is not None:
+            self.files.segment.close()
+            raise self.error
+        self.files.close()
+
+    def _write_loop(self, flush_interval):
+        """
+        The loop of the writer thread
+
+        :type flush_interval: Float
+        :param flush_interval: the longest time a record is queued without sync
+        """
+        while True:
+            with self.condition:
+                # unless a thread waits for its records, give the others time to queue
+                # more records for the group
+                if not self.closed and not (self.waiting and self.pending):
+                    self.condition.wait(flush_interval)
+                records, self.pending = self.pending, []
+                closed = self.closed
+
+            if records:
+                try:
+                    self.files.write(records)
+                except OSError as error:
+                    with self.condition:
+                        self.error = error
+                        self.condition.notify_all()
+                    return
+
+            with self.condition:
+                self.durable += len(records)
+                self.condition.notify_all()
+            if closed and not records:
+                return
+
+
+def open_marketplace(directory, queue_size_per_producer, sync=False, snapshot_every=100000,
+                     **kwargs):
+    """
+    Recovers the marketplace saved in a directory, or creates an empty one, and logs its
+    changes there from now on
+
+    :returns the Marketplace
+    """
+    # imported here, the marketplace module imports this one
+    from .marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+
+    state, position = recover(directory)
+    marketplace = Marketplace(queue_size_per_producer, **kwargs)
+    state.restore(marketplace)
+    wal = WriteAheadLog(directory, state, position, sync=sync,
+                        snapshot_every=snapshot_every)
+    marketplace.wal = wal
+    wal.attach(marketplace.registry)
+    return marketplace
+
+
+class TestPersistence(unittest.TestCase):
+    """
+    Unit testing for the write-ahead log and the recovery
+    """
+
+    def setUp(self):
+        """
+        Set up a directory for the log and 2 products
+        """
+        self.directory = tempfile.mkdtemp()
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def contents(marketplace):
+        """
+        Returns what the marketplace holds: the stock, the buffers and the carts
+        """
+        products = marketplace.registry.products
+        buffers = {idx: sorted(map(repr, buffer))
+                   for idx, buffer in enumerate(marketplace.producers.buffers)
+                   if buffer is not None}
+        carts = {idx: sorted(map(repr, (products[product_id] for product_id in cart.expand())))
+                 for idx, cart in enumerate(marketplace.carts)
+                 if idx not in marketplace.free_cart_ids}
+        return marketplace.inventory_snapshot(), buffers, carts
+
+    def fill(self, marketplace):
+        """
+        Runs a few operations of 2 producers and 3 consumers, one of which is released
+        """
+        prod_0 = marketplace.register_producer()
+        prod_1 = marketplace.register_producer()
+        marketplace.publish_many(prod_0, self.tea_product, 5)
+        marketplace.publish_many(prod_1, self.coffee_product, 3)
+
+        carts = [marketplace.new_cart() for _ in range(3)]
+        marketplace.add_to_cart(carts[0], self.tea_product, 2)
+        marketplace.add_to_cart(carts[0], self.coffee_product)
+        marketplace.add_to_cart(carts[1], self.tea_product)
+        marketplace.remove_from_cart(carts[0], self.tea_product)
+        marketplace.add_to_cart(carts[2], self.coffee_product)
+        marketplace.place_order(carts[2])
+        marketplace.release_cart(carts[2])
+        return prod_0, prod_1, carts
+
+    def test_recover(self):
+        """
+        Check that a marketplace is recovered from its log, without a snapshot, as it was
+        """
+        marketplace = persistence_marketplace(self.directory, sync=True)
+        self.fill(marketplace)
+        expected = self.contents(marketplace)
+
+        # no close(): the synced records are all there is after a crash
+        recovered = open_marketplace(self.directory, 8)
+        self.assertEqual(self.contents(recovered), expected)
+        self.assertEqual(recovered.new_cart(), 2)
+        self.assertEqual(recovered.register_producer(), 2)
+        recovered.wal.close()
+
+    def test_snapshots(self):
+        """
+        Check that snapshots replace the older segments and the recovery goes on from
+        the last one
+        """
+        marketplace = persistence_marketplace(self.directory, snapshot_every=5)
+        prod_0, _, carts = self.fill(marketplace)
+        marketplace.publish_many(prod_0, self.tea_product, 2)
+        marketplace.wal.close()
+        expected = self.contents(marketplace)
+
+        self.assertEqual(len(log_files(self.directory, SNAPSHOT_PATTERN)), 1)
+        self.assertEqual(len(log_files(self.directory, SEGMENT_PATTERN)), 1)
+        recovered = open_marketplace(self.directory, 8)
+        self.assertEqual(self.contents(recovered), expected)
+        self.assertEqual(recovered.remove_from_cart(carts[0], self.coffee_product), 1)
+        self.assertEqual(recovered.available(self.coffee_product), 2)
+        recovered.wal.close()
+
+    def test_torn_frame(self):
+        """
+        Check that a frame written in part is ignored, with the records after it
+        """
+        marketplace = persistence_marketplace(self.directory, sync=True)
+        prod_0 = marketplace.register_producer()
+        marketplace.publish_many(prod_0, self.tea_product, 2)
+        _, filename = log_files(self.directory, SEGMENT_PATTERN)[-1]
+        size = os.path.getsize(filename)
+        marketplace.publish_many(prod_0, self.tea_product, 1)
+
+        os.truncate(filename, size + FRAME_HEADER.size + 3)
+        state, position = recover(self.directory)
+        self.assertDictEqual(dict(state.stock[prod_0]), {0: 2})
+        # the product, the producer and its publish
+        self.assertEqual(position, 3)
+
+    def test_departed_producer(self):
+        """
+        Check that the units of an unregistered producer are still dropped when they are
+        removed from a cart after a recovery, even if a new producer got its id
+        """
+        marketplace = persistence_marketplace(self.directory, sync=True)
+        prod_0 = marketplace.register_producer()
+        cart_id = marketplace.new_cart()
+        marketplace.publish_many(prod_0, self.tea_product, 2)
+        marketplace.add_to_cart(cart_id, self.tea_product)
+        marketplace.unregister_producer(prod_0)
+        self.assertEqual(marketplace.register_producer(), prod_0)
+
+        recovered = open_marketplace(self.directory, 8)
+        self.assertEqual(recovered.remove_from_cart(cart_id, self.tea_product), 1)
+        self.assertEqual(recovered.available(self.tea_product), 0)
+        recovered.wal.close()
+
+    def test_group_commit(self):
+        """
+        Check that the records of concurrent operations are written in fewer groups
+        """
+        marketplace = open_marketplace(self.directory, 100, sync=True)
+        prod_id = marketplace.register_producer()
+        files = marketplace.wal.files
+
+        def publish():
+            for _ in range(20):
+                marketplace.publish_many(prod_id, self.tea_product, 1)
+                time.sleep(0.001)
+
+        with mock.patch.object(files, 'write', wraps=files.write) as write:
+            threads = [Thread(target=publish) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            marketplace.wal.close()
+
+        writes = [len(call.args[0]) for call in write.call_args_list]
+        self.assertEqual(sum(writes), 80)
+        self.assertLess(len(writes), 80)
+
+
+def persistence_marketplace(directory, **kwargs):
+    """
+    Returns a new Marketplace, with a buffer of 8 units per producer, logging to directory
+    """
+    return open_marketplace(directory, 8, **kwargs)
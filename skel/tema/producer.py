@@ -8,13 +8,16 @@ March 2021
 import time
 from threading import Thread
 
+from .retry import RETRY_POLICIES
+
 
 class Producer(Thread):
     """
     Class that represents a producer.
     """
 
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, blocking=False,
+                 retry='fixed', **kwargs):
         """
         Constructor.
 
@@ -28,6 +31,14 @@ class Producer(Thread):
         @param republish_wait_time: the number of seconds that a producer must
         wait until the marketplace becomes available
 
+        @type blocking: Bool
+        @param blocking: if True, wait inside the marketplace (up to republish_wait_time, or
+        until woken up if it is 0) for room in the buffer instead of sleeping between attempts
+
+        @type retry: String
+        @param retry: the policy, one of retry.RETRY_POLICIES, deciding how long to sleep
+        between attempts, based on republish_wait_time and the marketplace's hints
+
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
         """
@@ -36,13 +47,29 @@ class Producer(Thread):
         self.products = products
         self.marketplace = marketplace
         self.republish_wait_time = republish_wait_time
+        self.blocking = blocking
         self.name = kwargs['name']
+        self.retry = RETRY_POLICIES[retry](republish_wait_time, seed=self.name)
         self.prod_id = None
 
     def run(self):
+        for delay in self.steps():
+            time.sleep(delay)
+
+    def steps(self):
+        """
+        The producer's work, as a generator that yields each time the producer has to
+        sleep, the number of seconds to sleep. run() really sleeps, the simulation
+        engine only moves its virtual clock.
+        """
         # Register to the marketplace and get an ID
         self.prod_id = self.marketplace.register_producer()
 
+        # With nothing to publish, the loop below would never yield
+        if not any(product[1] > 0 for product in self.products):
+            self.marketplace.unregister_producer(self.prod_id)
+            return
+
         # Publish the products
         while True:
             for product in self.products:
@@ -50,10 +77,18 @@ class Producer(Thread):
                 quantity = product[1]
                 wait_time = product[2]
 
+                # a zero wait blocks until woken up, a 0 timeout would spin
+                timeout = (self.republish_wait_time or None) if self.blocking else 0
                 while quantity > 0:
-                    published_it = self.marketplace.publish(self.prod_id, name)
-                    if published_it:
-                        time.sleep(wait_time)
-                        quantity -= 1
+                    published = self.marketplace.publish_many(self.prod_id, name,
+                                                              quantity, timeout)
+                    if published:
+                        self.retry.reset()
+                        # Each unit takes wait_time to produce
+                        yield wait_time * published
+                        quantity -= published
                     else:
-                        time.sleep(self.republish_wait_time)
+                        self.marketplace.record_retry('publish')
+                        if not self.blocking:
+                            yield self.retry.delay(
+                                self.marketplace.publish_retry_after(self.prod_id))
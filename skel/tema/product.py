@@ -6,19 +6,42 @@ Assignment 1
 March 2021
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
+from threading import Lock
 
 
-@dataclass(init=True, repr=True, order=False, frozen=True)
+@dataclass(init=True, repr=True, order=False, frozen=True, eq=False, slots=True)
 class Product:
     """
     Class that represents a product.
     """
     name: str
     price: int
+    # the values of the fields and their hash, computed once since products never change
+    _key: tuple = field(init=False, repr=False, compare=False)
+    _hash: int = field(init=False, repr=False, compare=False)
 
+    def __post_init__(self):
+        key = tuple(getattr(self, f.name) for f in fields(self) if f.init)
+        object.__setattr__(self, '_key', key)
+        object.__setattr__(self, '_hash', hash(key))
 
-@dataclass(init=True, repr=True, order=False, frozen=True)
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._hash == other._hash and self._key == other._key
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        # rebuild from the fields, the cached hash is not valid in another process
+        return self.__class__, self._key
+
+
+@dataclass(init=True, repr=True, order=False, frozen=True, eq=False, slots=True)
 class Tea(Product):
     """
     Tea products
@@ -26,10 +49,44 @@ class Tea(Product):
     type: str
 
 
-@dataclass(init=True, repr=True, order=False, frozen=True)
+@dataclass(init=True, repr=True, order=False, frozen=True, eq=False, slots=True)
 class Coffee(Product):
     """
     Coffee products
     """
     acidity: str
     roast_level: str
+
+
+class ProductRegistry:
+    """
+    Interns products: every distinct product is kept once and gets a small integer id
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.ids = {}  # a dict<product, id>
+        self.products = []  # the interned products, indexed by id
+        self.lock = Lock()  # used when a new product is registered
+
+    def intern(self, product):
+        """
+        Returns the id of the product, registering it if it is new
+        """
+        product_id = self.ids.get(product)
+        if product_id is None:
+            with self.lock:
+                product_id = self.ids.get(product)
+                if product_id is None:
+                    product_id = len(self.products)
+                    self.products.append(product)
+                    self.ids[product] = product_id
+        return product_id
+
+    def product(self, product_id):
+        """
+        Returns the interned product with the given id
+        """
+        return self.products[product_id]
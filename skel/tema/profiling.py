@@ -0,0 +1,552 @@
+"""
+This module profiles a run: the contention on the Marketplace's locks, per lock and per
+call site, and optionally where the threads spend the CPU and which lines allocate memory.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import unittest
+from collections import Counter
+
+from .metrics import Histogram
+
+# the frames of these modules are skipped when looking for the call site of an acquire()
+SKIPPED_FILES = {threading.__file__, logging.__file__}
+INDEX = re.compile(r'\[\d+\]')  # the index of a lock in a list, e.g. buffer_locks[3]
+PROFILE_LIMIT = 20  # the number of rows in each table of the report
+
+
+def call_site():
+    """
+    Returns the caller of ProfiledLock.acquire(), as "file:line (function)", skipping
+    ProfiledLock.__enter__() and the frames of threading (a Condition acquiring its lock)
+    and of logging (a handler acquiring its lock, for the code that logged)
+    """
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    if frame.f_code is ProfiledLock.__enter__.__code__:
+        frame = frame.f_back
+    while frame is not None and frame.f_code.co_filename in SKIPPED_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return '{}:{} ({})'.format(os.path.basename(frame.f_code.co_filename), frame.f_lineno,
+                               frame.f_code.co_name)
+
+
+def function_name(code):
+    """
+    Returns a function as "directory/file:first line (function)"
+    """
+    path = os.sep.join(code.co_filename.split(os.sep)[-2:])
+    return '{}:{} ({})'.format(path, code.co_firstlineno, code.co_name)
+
+
+def merge(histograms):
+    """
+    Returns a new Histogram holding the values of all the given ones
+    """
+    merged = Histogram()
+    for histogram in histograms:
+        with histogram.lock:
+            for index, count in histogram.buckets.items():
+                merged.buckets[index] = merged.buckets.get(index, 0) + count
+            merged.count += histogram.count
+            merged.total += histogram.total
+            merged.max = max(merged.max, histogram.max)
+    return merged
+
+
+class LockSiteStats:
+    """
+    The acquisitions of a lock made from one call site
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.waits = Histogram()  # the waits of the acquisitions that found the lock held
+        self.holds = Histogram()  # how long every acquisition held the lock
+
+
+class ProfiledLock:
+    """
+    Wraps a Lock or an RLock and records, per call site, how long each acquire() waited
+    for it and how long it was held. A lock guarding a Condition is released while the
+    thread waits on the Condition, so that time is not counted as held.
+    """
+
+    def __init__(self, lock, name, profile):
+        """
+        Constructor
+
+        :type lock: Lock
+        :param lock: the wrapped lock
+
+        :type name: String
+        :param name: the name of the lock in the report
+
+        :type profile: LockProfile
+        :param profile: where the waits and the holds are recorded
+        """
+        self.lock = lock
+        self.name = name
+        self.profile = profile
+        # the fields below are only changed by the thread holding the lock
+        self.depth = 0  # the number of acquisitions not released, more than 1 for an RLock
+        self.acquired_at = 0  # when the outermost acquisition got the lock
+        self.stats = None  # the LockSiteStats of the outermost acquisition
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the wrapped lock, recording the wait if it was held by another thread
+        """
+        site = call_site()
+        wait = None
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            start = time.perf_counter_ns()
+            if not self.lock.acquire(True, timeout):
+                return False
+            wait = time.perf_counter_ns() - start
+
+        stats = self.profile.site_stats(self.name, site)
+        if wait is not None:
+            stats.waits.record(wait)
+        self.depth += 1
+        if self.depth == 1:
+            self.stats = stats
+            self.acquired_at = time.perf_counter_ns()
+        return True
+
+    def release(self):
+        """
+        Releases the wrapped lock, recording how long it was held
+        """
+        self.depth -= 1
+        if self.depth:
+            self.lock.release()
+            return
+        hold = time.perf_counter_ns() - self.acquired_at
+        stats = self.stats
+        self.lock.release()
+        stats.holds.record(hold)
+
+    def locked(self):
+        """
+        Returns True if the wrapped lock is held
+        """
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class LockProfile:
+    """
+    The waits and the holds of a set of ProfiledLocks, per lock and call site
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.sites = {}  # a dict<(lock name, call site), LockSiteStats>
+        self.lock = threading.Lock()  # guards the insertions in sites
+
+    def wrap(self, name, lock):
+        """
+        Returns lock wrapped so that its waits and holds are recorded under name
+        """
+        return ProfiledLock(lock, name, self)
+
+    def site_stats(self, name, site):
+        """
+        Returns the LockSiteStats of a lock and call site, created on first use
+        """
+        stats = self.sites.get((name, site))
+        if stats is None:
+            with self.lock:
+                stats = self.sites.setdefault((name, site), LockSiteStats())
+        return stats
+
+    def snapshot(self, group_indices=True):
+        """
+        Returns the statistics of every lock and of every call site, in microseconds
+
+        :type group_indices: Bool
+        :param group_indices: if True, the locks of a list (the lock stripes, the
+        producers' locks) are reported together, as e.g. buffer_locks[*]
+        """
+        with self.lock:
+            sites = list(self.sites.items())
+
+        by_lock = {}  # a dict<lock name, list<LockSiteStats>>
+        by_site = {}  # a dict<(lock name, call site), list<LockSiteStats>>
+        for (name, site), stats in sites:
+            if group_indices:
+                name = INDEX.sub('[*]', name)
+            by_lock.setdefault(name, []).append(stats)
+            by_site.setdefault((name, site), []).append(stats)
+
+        def summary(stats_list):
+            waits = merge(stats.waits for stats in stats_list).snapshot()
+            holds = merge(stats.holds for stats in stats_list).snapshot()
+            return {
+                'acquired': holds['count'],
+                'contended': waits['count'],
+                'wait_total_us': waits['total_us'],
+                'wait_p99_us': waits['p99_us'],
+                'wait_max_us': waits['max_us'],
+                'hold_total_us': holds['total_us'],
+                'hold_p99_us': holds['p99_us'],
+                'hold_max_us': holds['max_us'],
+            }
+
+        locks = [dict(summary(stats_list), lock=name) for name, stats_list in by_lock.items()]
+        call_sites = [dict(summary(stats_list), lock=name, site=site)
+                      for (name, site), stats_list in by_site.items()]
+        for rows in (locks, call_sites):
+            rows.sort(key=lambda row: (row['wait_total_us'], row['hold_total_us']),
+                      reverse=True)
+        return {'locks': locks, 'call_sites': call_sites}
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the other threads at a fixed interval and charges each stack
+    with the CPU time its thread used since the previous sample, so the threads sleeping
+    or waiting for a lock add next to nothing. Where the platform has no per-thread CPU
+    clocks, every sample is charged the interval instead.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        Constructor
+
+        :type interval: Float
+        :param interval: the seconds between two samples
+        """
+        self.interval = interval
+        self.samples = 0  # the number of thread stacks sampled
+        self.cpu_time = 0  # the seconds charged to the samples
+        self.own = Counter()  # a Counter<function> of the seconds it was running
+        # a Counter<function> of the seconds it was on the stack, itself or its callees
+        self.cumulative = Counter()
+        self.clocks = {}  # a dict<thread ident, (its CPU clock id, its last CPU time)>
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler',
+                                       daemon=True)
+
+    def start(self):
+        """
+        Starts sampling
+        """
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops sampling, the counters can be read afterwards
+        """
+        self.stopped.set()
+        self.thread.join()
+
+    def _cpu_used(self, ident):
+        """
+        Returns the CPU seconds a thread used since the previous sample, 0 the first time
+        it is seen and the interval where the CPU time of a thread cannot be read
+        """
+        if not hasattr(time, 'pthread_getcpuclockid'):
+            return self.interval
+        try:
+            clock, last = self.clocks.get(ident, (None, None))
+            if clock is None:
+                clock = time.pthread_getcpuclockid(ident)
+            now = time.clock_gettime(clock)
+        except OSError:  # the thread exited
+            self.clocks.pop(ident, None)
+            return 0
+        self.clocks[ident] = (clock, now)
+        return now - last if last is not None else 0
+
+    def _run(self):
+        """
+        The loop of the sampling thread
+        """
+        own_ident = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():  # pylint: disable=W0212
+                used = self._cpu_used(ident) if ident != own_ident else 0
+                if not used:
+                    continue
+                self.samples += 1
+                self.cpu_time += used
+                self.own[function_name(frame.f_code)] += used
+                seen = set()  # a recursive function is counted once per sample
+                while frame is not None:
+                    name = function_name(frame.f_code)
+                    if name not in seen:
+                        seen.add(name)
+                        self.cumulative[name] += used
+                    frame = frame.f_back
+
+    def snapshot(self, limit=PROFILE_LIMIT):
+        """
+        Returns the CPU time sampled and the functions that were charged the most of it
+        """
+        return {
+            'interval_s': self.interval,
+            'samples': self.samples,
+            'cpu_s': self.cpu_time,
+            'own': [{'function': name, 'cpu_s': seconds}
+                    for name, seconds in self.own.most_common(limit)],
+            'cumulative': [{'function': name, 'cpu_s': seconds}
+                           for name, seconds in self.cumulative.most_common(limit)],
+        }
+
+
+class Profiler:
+    """
+    Profiles a run: the locks wrapped by its LockProfile (see Marketplace(profile=...)
+    and watch_handlers), and optionally the CPU, with a SamplingProfiler, and the memory,
+    with tracemalloc. The report combines all of them.
+    """
+
+    def __init__(self, cpu=False, memory=False, interval=0.005, frames=1):
+        """
+        Constructor
+
+        :type cpu: Bool
+        :param cpu: if True, sample the threads' stacks while the profiler runs
+
+        :type memory: Bool
+        :param memory: if True, trace the allocations with tracemalloc while it runs
+
+        :type interval: Float
+        :param interval: the seconds between two CPU samples
+
+        :type frames: Int
+        :param frames: the number of frames tracemalloc keeps per allocation
+        """
+        self.locks = LockProfile()
+        self.sampler = SamplingProfiler(interval) if cpu else None
+        self.memory = memory
+        self.frames = frames
+        self.started = None  # when start() was called
+        self.elapsed = None  # the seconds between start() and stop()
+        self.allocations = None  # the tracemalloc.Snapshot taken by stop()
+        self.peak_memory = None  # the most bytes traced at once
+
+    def watch_handlers(self, handlers):
+        """
+        Wraps the locks of logging handlers, so the time spent logging shows up in the
+        report as the locks log_handler[<handler class>]
+        """
+        for handler in handlers:
+            if handler.lock is not None and not isinstance(handler.lock, ProfiledLock):
+                name = 'log_handler[{}]'.format(type(handler).__name__)
+                handler.lock = self.locks.wrap(name, handler.lock)
+
+    def start(self):
+        """
+        Starts the CPU and memory profilers that were enabled
+        """
+        if self.memory:
+            tracemalloc.start(self.frames)
+        if self.sampler is not None:
+            self.sampler.start()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        """
+        Stops the profilers, keeping what they measured
+        """
+        self.elapsed = time.perf_counter() - self.started
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.memory:
+            self.allocations = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def snapshot(self, limit=PROFILE_LIMIT):
+        """
+        Returns the whole profile as a dict of plain values
+        """
+        locks = self.locks.snapshot()
+        profile = {
+            'elapsed_s': self.elapsed,
+            'locks': locks['locks'],
+            'call_sites': locks['call_sites'][:limit],
+        }
+        if self.sampler is not None:
+            profile['cpu'] = self.sampler.snapshot(limit)
+        if self.allocations is not None:
+            profile['memory'] = {
+                'peak_bytes': self.peak_memory,
+                'allocations': [{'line': str(stat.traceback), 'bytes': stat.size,
+                                 'count': stat.count}
+                                for stat in self.allocations.statistics('lineno')[:limit]],
+            }
+        return profile
+
+    def report(self, limit=PROFILE_LIMIT):
+        """
+        Returns the profile as text, one table per section
+        """
+        profile = self.snapshot(limit)
+        lines = ['Profiled run of {:.3f} s'.format(profile['elapsed_s'] or 0), '',
+                 'Locks (the waits of the acquisitions that found the lock held, '
+                 'in microseconds)']
+        columns = '{:>10} {:>10} {:>12} {:>10} {:>12} {:>10}'
+        header = columns.format('acquired', 'contended', 'wait total', 'wait p99',
+                                'hold total', 'hold p99')
+
+        width = max([len('lock')] + [len(stats['lock']) for stats in profile['locks']])
+
+        def row(stats):
+            return '{:<{}} '.format(stats['lock'], width) + columns.format(
+                stats['acquired'], stats['contended'], '%.0f' % stats['wait_total_us'],
+                '%.1f' % stats['wait_p99_us'], '%.0f' % stats['hold_total_us'],
+                '%.1f' % stats['hold_p99_us'])
+
+        lines.append('{:<{}} {}'.format('lock', width, header))
+        lines.extend(row(stats) for stats in profile['locks'])
+        lines += ['', 'Call sites']
+        for stats in profile['call_sites']:
+            lines += [row(stats), '    ' + stats['site']]
+
+        if 'cpu' in profile:
+            cpu = profile['cpu']
+            lines += ['', 'CPU: {:.0f} ms in {} samples, one every {:.0f} ms'.format(
+                cpu['cpu_s'] * 1000, cpu['samples'], cpu['interval_s'] * 1000)]
+            for title, key in (('running', 'own'), ('on the stack', 'cumulative')):
+                lines.append('{:>8} {:>6}  function {}'.format('ms', '%', title))
+                lines.extend('{:>8.1f} {:>6.1f}  {}'.format(
+                    entry['cpu_s'] * 1000, 100 * entry['cpu_s'] / (cpu['cpu_s'] or 1),
+                    entry['function']) for entry in cpu[key])
+
+        if 'memory' in profile:
+            memory = profile['memory']
+            lines += ['', 'Memory: peak of {:.1f} KiB traced, the lines allocating '
+                          'the most still allocated at the end'.format(
+                              memory['peak_bytes'] / 1024)]
+            lines.append('{:>10} {:>8}  line'.format('KiB', 'blocks'))
+            lines.extend('{:>10.1f} {:>8}  {}'.format(entry['bytes'] / 1024, entry['count'],
+                                                       entry['line'])
+                         for entry in memory['allocations'])
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, filename, limit=PROFILE_LIMIT):
+        """
+        Writes the report to a file, as JSON if its name ends with .json, else as text
+        """
+        with open(filename, 'w', encoding='utf-8') as report_file:
+            if filename.endswith('.json'):
+                json.dump(self.snapshot(limit), report_file, indent=4)
+            else:
+                report_file.write(self.report(limit))
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    Unit testing for the lock profiling and the sampling profiler
+    """
+
+    def test_contention(self):
+        """
+        Check that the waits and the holds are recorded per call site and that the locks
+        of a list are reported together
+        """
+        profile = LockProfile()
+        locks = [profile.wrap('stripes[%d]' % idx, threading.Lock()) for idx in range(2)]
+        holding = threading.Event()
+
+        def holder():
+            with locks[0]:
+                holding.set()
+                time.sleep(0.05)
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        holding.wait()
+        with locks[0]:
+            pass
+        thread.join()
+        with locks[1]:
+            pass
+
+        snapshot = profile.snapshot()
+        self.assertEqual(len(snapshot['locks']), 1)
+        stats = snapshot['locks'][0]
+        self.assertEqual(stats['lock'], 'stripes[*]')
+        self.assertEqual((stats['acquired'], stats['contended']), (3, 1))
+        self.assertGreater(stats['wait_total_us'], 20000)
+        self.assertGreater(stats['hold_max_us'], 40000)
+
+        contended = Counter()  # a Counter<function> of the contended acquisitions
+        for row in snapshot['call_sites']:
+            contended[row['site'].split(' ')[-1]] += row['contended']
+        self.assertDictEqual(dict(contended), {'(holder)': 0, '(test_contention)': 1})
+        self.assertEqual(len(profile.snapshot(group_indices=False)['locks']), 2)
+
+    def test_condition(self):
+        """
+        Check that a profiled lock works under a Condition and that the time spent
+        waiting on the Condition is not counted as held
+        """
+        profile = LockProfile()
+        condition = threading.Condition(profile.wrap('capacity', threading.Lock()))
+        with condition:
+            self.assertFalse(condition.wait(0.05))
+        rlock = profile.wrap('log_handler', threading.RLock())
+        with rlock:
+            with rlock:
+                pass
+
+        locks = {row['lock']: row for row in profile.snapshot()['locks']}
+        self.assertEqual(locks['capacity']['acquired'], 2)
+        self.assertLess(locks['capacity']['hold_max_us'], 40000)
+        self.assertEqual(locks['log_handler']['acquired'], 1)
+
+    def test_report(self):
+        """
+        Check that a busy function shows up in the CPU samples and that the report has
+        every section
+        """
+        profiler = Profiler(cpu=True, memory=True, interval=0.001)
+        profiler.start()
+        done = threading.Event()
+
+        def spin():
+            while not done.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=spin)
+        thread.start()
+        time.sleep(0.1)
+        done.set()
+        thread.join()
+        profiler.stop()
+
+        cpu = profiler.snapshot()['cpu']
+        self.assertGreater(cpu['cpu_s'], 0)
+        self.assertTrue(any('(spin)' in entry['function'] for entry in cpu['cumulative']))
+        report = profiler.report()
+        for section in ('Locks', 'Call sites', 'CPU:', 'Memory:'):
+            self.assertIn(section, report)
@@ -0,0 +1,244 @@
+"""
+This module holds the policies deciding how long producers and consumers wait before
+retrying a failed operation, and the estimates the Marketplace gives them as hints.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import random
+import time
+import unittest
+
+HINT_WEIGHT = 0.25  # the weight of the newest interval in an IntervalEstimate
+
+
+class FixedRetry:
+    """
+    Waits the configured time between attempts, whatever the hints
+    """
+
+    def __init__(self, wait_time, seed=None):
+        """
+        Constructor
+
+        :type wait_time: Float
+        :param wait_time: the republish_wait_time or retry_wait_time of the agent
+
+        :type seed: Any
+        :param seed: unused, the wait is always the same
+        """
+        # pylint: disable=unused-argument
+        self.wait_time = wait_time
+
+    def delay(self, hint=None):
+        """
+        Returns the number of seconds to wait before the next attempt
+
+        :type hint: Float
+        :param hint: the marketplace's estimate of when the attempt could succeed, or None
+        """
+        # pylint: disable=unused-argument
+        return self.wait_time
+
+    def reset(self):
+        """
+        Called after an attempt succeeded
+        """
+
+
+class ExponentialBackoff(FixedRetry):
+    """
+    Starts with a fraction of the configured wait and doubles it after every failed attempt,
+    up to a multiple of it. A hint from the marketplace replaces the doubling, within the
+    same bounds. Half of every delay is random, so the agents that failed together do not
+    retry together.
+    """
+
+    def __init__(self, wait_time, seed=None, spread=4, multiplier=2):
+        """
+        Constructor
+
+        :type wait_time: Float
+        :param wait_time: the republish_wait_time or retry_wait_time of the agent
+
+        :type seed: Any
+        :param seed: seeds the random part of the delays, e.g. the agent's name so that
+        simulated runs are reproducible
+
+        :type spread: Float
+        :param spread: the delays go from wait_time / spread to wait_time * spread
+
+        :type multiplier: Float
+        :param multiplier: how much the delay grows after each failed attempt
+        """
+        FixedRetry.__init__(self, wait_time)
+        self.initial = wait_time / spread
+        self.maximum = wait_time * spread
+        self.multiplier = multiplier
+        self.current = self.initial  # the delay of the next attempt, without a hint
+        self.random = random.Random(seed)
+
+    def delay(self, hint=None):
+        if hint is None:
+            base = self.current
+            self.current = min(self.current * self.multiplier, self.maximum)
+        else:
+            base = min(max(hint, self.initial), self.maximum)
+        return base / 2 + self.random.uniform(0, base / 2)
+
+    def reset(self):
+        self.current = self.initial
+
+
+# a dict<name, class> of the policies Producer and Consumer accept
+RETRY_POLICIES = {
+    'fixed': FixedRetry,
+    'backoff': ExponentialBackoff,
+}
+
+
+class IntervalEstimate:
+    """
+    An exponentially weighted mean of the intervals between events, such as units of a
+    product arriving in stock, used to tell when the next one is expected
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.last = None  # when the last event happened
+        self.interval = None  # the mean interval between events, in seconds
+
+    def record(self, now):
+        """
+        Records an event that happened at the given time
+        """
+        if self.last is not None:
+            interval = now - self.last
+            if self.interval is None:
+                self.interval = interval
+            else:
+                self.interval += HINT_WEIGHT * (interval - self.interval)
+        self.last = now
+
+    def expected_wait(self, now):
+        """
+        Returns the seconds until the next event is due, a whole interval if it is overdue,
+        or None before two events were seen
+        """
+        if self.interval is None:
+            return None
+        wait = self.last + self.interval - now
+        return wait if wait > 0 else self.interval
+
+
+class RetryHints:
+    """
+    The estimates a Marketplace gives as hints: when a product out of stock is expected to
+    arrive, and when a full buffer is expected to have room again
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        Constructor
+
+        :type clock: Callable
+        :param clock: returns the current time in seconds, replaced by simulations
+        """
+        self.clock = clock
+        # a dict<product_id, IntervalEstimate> of the arrivals in stock, under the stripes
+        self.stock_intervals = {}
+        # a dict<producer_id, IntervalEstimate> of the units leaving each buffer, under
+        # the producer's lock
+        self.room_intervals = {}
+
+    def record_arrival(self, product_id):
+        """
+        Records units of a product arriving in stock, called under the product's stripe
+        """
+        self._record(self.stock_intervals, product_id)
+
+    def record_departure(self, producer_id):
+        """
+        Records units leaving a producer's buffer, called under the producer's lock
+        """
+        self._record(self.room_intervals, producer_id)
+
+    def forget_producer(self, producer_id):
+        """
+        Drops the estimate of an unregistered producer
+        """
+        self.room_intervals.pop(producer_id, None)
+
+    def stock_wait(self, product_id):
+        """
+        Returns the seconds until units of the product are expected in stock, or None
+        """
+        return self._expected_wait(self.stock_intervals, product_id)
+
+    def room_wait(self, producer_id):
+        """
+        Returns the seconds until the producer's buffer is expected to have room, or None
+        """
+        return self._expected_wait(self.room_intervals, producer_id)
+
+    def _record(self, intervals, key):
+        """
+        Records an event in the IntervalEstimate of key, called under the lock guarding it
+        """
+        estimate = intervals.get(key)
+        if estimate is None:
+            estimate = intervals[key] = IntervalEstimate()
+        estimate.record(self.clock())
+
+    def _expected_wait(self, intervals, key):
+        """
+        Returns the expected wait of the IntervalEstimate of key, None if there is none
+        """
+        estimate = intervals.get(key)
+        return estimate.expected_wait(self.clock()) if estimate is not None else None
+
+
+class TestRetry(unittest.TestCase):
+    """
+    Unit testing for the retry policies and the interval estimates
+    """
+
+    def test_fixed(self):
+        """
+        Check that the fixed policy ignores the hints
+        """
+        policy = FixedRetry(0.5)
+        self.assertListEqual([policy.delay(), policy.delay(3)], [0.5, 0.5])
+
+    def test_backoff(self):
+        """
+        Check that the delays double up to the maximum, follow the hints within bounds
+        and start over after a success
+        """
+        policy = ExponentialBackoff(1, seed='cons1')
+        delays = [policy.delay() for _ in range(6)]
+        for delay, base in zip(delays, [0.25, 0.5, 1, 2, 4, 4]):
+            self.assertTrue(base / 2 <= delay <= base)
+
+        self.assertTrue(2 <= policy.delay(hint=100) <= 4)
+        self.assertTrue(0.125 <= policy.delay(hint=0) <= 0.25)
+        policy.reset()
+        self.assertLessEqual(policy.delay(), 0.25)
+
+        self.assertEqual(ExponentialBackoff(1, seed='cons1').delay(), delays[0])
+
+    def test_interval_estimate(self):
+        """
+        Check that the next event is expected one mean interval after the last one
+        """
+        estimate = IntervalEstimate()
+        estimate.record(0)
+        self.assertIsNone(estimate.expected_wait(0))
+        estimate.record(2)
+        self.assertEqual(estimate.expected_wait(3), 1)
+        estimate.record(6)
+        self.assertEqual(estimate.interval, 2.5)
+        self.assertEqual(estimate.expected_wait(10), 2.5)
@@ -0,0 +1,615 @@
+"""
+This module loads market configurations, from the tests/*.in JSON format or from a
+compact binary format, and turns them into the objects the marketplace engines run on.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import io
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+from array import array
+from json.decoder import WHITESPACE
+
+from .product import Product, Tea, Coffee
+
+PRODUCT_TYPES = {cls.__name__: cls for cls in (Product, Tea, Coffee)}
+
+JSON_CHUNK_SIZE = 1 << 20  # characters read at a time by JsonStreamReader
+JSON_TAIL_SIZE = 1 << 16  # bytes first read from the end of a file by read_trailing_entries
+HEADER_KEYS = {'products', 'producers', 'marketplace'}  # everything but the consumers
+# the possible ends of the consumers array, followed by more keys or by the end of the object
+ARRAY_END = re.compile(r'\](?=\s*[,}])')
+
+# Binary scenario: a fixed header, the JSON of everything but the consumers, then the
+# consumers as columns, each one aligned to 8 bytes so it can be cast in place
+BINARY_MAGIC = b'TEMASCN1'
+BINARY_HEADER = struct.Struct('<8sQQQQ')  # magic, JSON length, consumers, carts, operations
+BINARY_COLUMNS = [
+    ('consumer_carts', 'Q'),  # index of each consumer's first cart, plus the end
+    ('cart_operations', 'Q'),  # index of each cart's first operation, plus the end
+    ('name_offsets', 'Q'),  # offset of each consumer's name in names, plus the end
+    ('retry_wait_time', 'd'),  # one per consumer
+    ('operation_product', 'I'),  # index of the product in the header's products
+    ('operation_quantity', 'I'),
+    ('operation_type', 'B'),  # index in OPERATION_TYPES
+    ('names', 'B'),  # the UTF-8 consumer names, back to back
+]
+OPERATION_TYPES = ['add', 'remove']
+COLUMN_BUFFER = 1 << 16  # values buffered by the converter before a column is flushed
+
+
+def build_products(products_config):
+    """
+    Turns the product definitions into actual products
+
+    :type products_config: Dict
+    :param products_config: a dict<product id, product definition>
+
+    :returns a dict<product id, Product>
+    """
+    products = {}
+    for k, products_dict in products_config.items():
+        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
+        products[k] = PRODUCT_TYPES[products_dict['product_type']](**params)
+    return products
+
+
+def resolve_producer(producer, products):
+    """
+    Replaces, in place, the product ids of a producer with actual products
+
+    :type products: Dict
+    :param products: a dict<product id, Product>
+
+    :returns the same producer
+    """
+    producer['products'] = [(products[i], quantity, sleep_time)
+                            for i, quantity, sleep_time
+                            in producer['products']]
+    return producer
+
+
+def resolve_consumer(consumer, products):
+    """
+    Replaces, in place, the product ids of a consumer's cart operations with actual products
+
+    :type products: Dict
+    :param products: a dict<product id, Product>
+
+    :returns the same consumer
+    """
+    for cart in consumer['carts']:
+        for operation in cart:
+            operation['product'] = products[operation['product']]
+    return consumer
+
+
+def resolve_market_config(market_config):
+    """
+    Replaces, in place, the product ids of the producers and of the consumers' cart
+    operations with actual products and drops the product definitions
+
+    :returns the same market configuration
+    """
+    products = build_products(market_config['products'])
+    del market_config['products']
+
+    for producer in market_config['producers']:
+        resolve_producer(producer, products)
+
+    for consumer in market_config['consumers']:
+        resolve_consumer(consumer, products)
+
+    return market_config
+
+
+def load_market_config(filename):
+    """
+    Loads a market configuration, from a tests/*.in JSON file or from a binary scenario
+    written by convert_to_binary, with the product ids already turned into products.
+    Only the producers are loaded up front: 'consumers' is an iterator that reads the
+    consumers from the file as it is advanced, so it can be iterated only once.
+    """
+    with open(filename, 'rb') as input_file:
+        binary = input_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+    header = read_binary_header(filename)[0] if binary else read_json_header(filename)
+    products = build_products(header['products'])
+
+    if binary:
+        consumers = iter_binary_consumers(filename, list(products.values()))
+    else:
+        consumers = (resolve_consumer(consumer, products)
+                     for consumer in iter_json_consumers(filename))
+
+    return {'marketplace': header['marketplace'],
+            'producers': [resolve_producer(producer, products)
+                          for producer in header['producers']],
+            'consumers': consumers}
+
+
+class JsonStreamReader:
+    """
+    Decodes a JSON document from a text file one value at a time, so that only the
+    value being decoded has to be in memory. The containers whose items should be
+    streamed are walked with object_keys() and array_items().
+    """
+
+    def __init__(self, input_file, chunk_size=JSON_CHUNK_SIZE):
+        """
+        Constructor
+
+        :type input_file: File
+        :param input_file: a text file
+
+        :type chunk_size: Int
+        :param chunk_size: the number of characters read at a time
+        """
+        self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0  # the position of the next character in buffer
+        self.eof = False
+
+    def _read(self, size):
+        """
+        Drops the part of the buffer already decoded and appends size more characters
+        """
+        chunk = self.input_file.read(size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        """
+        Skips the whitespace and returns the next character, '' at the end of the file
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._read(self.chunk_size)
+
+    def expect(self, char):
+        """
+        Consumes the next character, which must be char
+        """
+        if self.peek() != char:
+            raise ValueError("expected {!r} at {!r}".format(
+                char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+        """
+        Decodes and returns the next value
+        """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may go on in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read as much again as is buffered, so a long value is decoded a few times only
+            size = max(size, len(self.buffer) - self.pos)
+            self._read(size)
+
+    def skip(self):
+        """
+        Skips the next value without keeping it. An array is decoded one item at a time.
+        """
+        if self.peek() == '[':
+            for _ in self.array_items():
+                pass
+        else:
+            self.value()
+
+    def object_keys(self):
+        """
+        Yields the keys of the object that starts here. The caller must read the value
+        of each key before asking for the next one.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() != ',':
+                self.expect('}')
+                return
+            self.pos += 1
+
+    def array_items(self):
+        """
+        Yields the values of the array that starts here, one at a time
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() != ',':
+                self.expect(']')
+                return
+            self.pos += 1
+
+
+def read_json_header(filename):
+    """
+    Reads everything but the consumers from a JSON market configuration, without
+    decoding the consumers. When they come last (the order test_generator.py --stream
+    writes) the reading stops before them. When other keys follow them (the marketplace,
+    in tests/*.in) those are read from the end of the file, and the consumers are only
+    skipped if that fails.
+
+    :returns a dict<key, value> of the top-level entries other than 'consumers'
+    """
+    header = {}
+    with open(filename, encoding='utf-8') as input_file:
+        reader = JsonStreamReader(input_file)
+        for key in reader.object_keys():
+            if key != 'consumers':
+                header[key] = reader.value()
+                continue
+            if HEADER_KEYS <= header.keys():
+                break
+            trailing = read_trailing_entries(filename, HEADER_KEYS - header.keys())
+            if trailing is not None:
+                header.update(trailing)
+                break
+            reader.skip()
+    return header
+
+
+def parse_trailing_entries(text):
+    """
+    Parses the end of a JSON object, from just after the value of one of its entries:
+    the (possibly no) ', "key": value' entries that follow and the closing brace
+
+    :returns a dict<key, value> of the entries, or None if text is not such an end
+    """
+    reader = JsonStreamReader(io.StringIO(text))
+    entries = {}
+    try:
+        while reader.peek() == ',':
+            reader.pos += 1
+            key = reader.value()
+            if not isinstance(key, str):
+                return None
+            reader.expect(':')
+            entries[key] = reader.value()
+        reader.expect('}')
+    except ValueError:
+        return None
+    return entries if reader.peek() == '' else None
+
+
+def read_trailing_entries(filename, keys):
+    """
+    Reads the top-level entries that follow the consumers array from the end of the file.
+    Every ']' near the end is tried, from the last one, as the end of the consumers: it is
+    only accepted if the rest of the file is a valid end of the top-level object that
+    holds the given keys.
+
+    :returns a dict<key, value> of the entries after the consumers, or None if the end
+    of the file does not hold all of the keys
+    """
+    file_size = os.path.getsize(filename)
+    tail_size = JSON_TAIL_SIZE
+    while True:
+        with open(filename, 'rb') as input_file:
+            input_file.seek(max(0, file_size - tail_size))
+            # a character cut at the start of the tail does not matter, it is never parsed
+            tail = input_file.read().decode(errors='replace')
+
+        for match in reversed(list(ARRAY_END.finditer(tail))):
+            entries = parse_trailing_entries(tail[match.end():])
+            if entries is not None and keys <= entries.keys():
+                return entries
+
+        if tail_size >= file_size:
+            return None
+        tail_size *= 4
+
+
+def iter_json_consumers(filename):
+    """
+    Yields the consumers of a JSON market configuration, as they are in the file
+    """
+    with open(filename, encoding='utf-8') as input_file:
+        reader = JsonStreamReader(input_file)
+        for key in reader.object_keys():
+            if key == 'consumers':
+                yield from reader.array_items()
+                return
+            reader.skip()
+
+
+class _Column:
+    """
+    A column of the binary format being written: values are buffered in an array and
+    spilled to a temporary file
+    """
+
+    def __init__(self, typecode):
+        self.values = array(typecode)
+        self.file = tempfile.TemporaryFile()
+
+    def append(self, value):
+        """
+        Adds a value at the end of the column
+        """
+        self.values.append(value)
+        if len(self.values) >= COLUMN_BUFFER:
+            self.flush()
+
+    def extend_bytes(self, data):
+        """
+        Adds raw bytes at the end of a 'B' column
+        """
+        self.values.frombytes(data)
+        if len(self.values) >= COLUMN_BUFFER:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered values to the temporary file
+        """
+        self.values.tofile(self.file)
+        del self.values[:]
+
+
+def _padding(size):
+    """
+    Returns the zero bytes that align size to 8
+    """
+    return bytes(-size % 8)
+
+
+def convert_to_binary(json_filename, binary_filename):
+    """
+    Converts a JSON market configuration (tests/*.in) to the binary format, reading one
+    consumer at a time. Only the name, retry_wait_time and carts of the consumers are kept.
+
+    :returns the number of consumers converted
+    """
+    header = read_json_header(json_filename)
+    product_index = {product_id: idx for idx, product_id in enumerate(header['products'])}
+    header['byteorder'] = sys.byteorder
+
+    columns = {name: _Column(typecode) for name, typecode in BINARY_COLUMNS}
+    columns['consumer_carts'].append(0)
+    columns['cart_operations'].append(0)
+    columns['name_offsets'].append(0)
+    consumers = carts = operations = names_size = 0
+
+    try:
+        for consumer in iter_json_consumers(json_filename):
+            consumers += 1
+            name = consumer['name'].encode()
+            names_size += len(name)
+            columns['names'].extend_bytes(name)
+            columns['name_offsets'].append(names_size)
+            columns['retry_wait_time'].append(consumer['retry_wait_time'])
+
+            for cart in consumer['carts']:
+                for operation in cart:
+                    columns['operation_type'].append(OPERATION_TYPES.index(operation['type']))
+                    columns['operation_product'].append(product_index[operation['product']])
+                    columns['operation_quantity'].append(operation['quantity'])
+                operations += len(cart)
+                columns['cart_operations'].append(operations)
+            carts += len(consumer['carts'])
+            columns['consumer_carts'].append(carts)
+
+        header_json = json.dumps(header).encode()
+        with open(binary_filename, 'wb') as output_file:
+            output_file.write(BINARY_HEADER.pack(BINARY_MAGIC, len(header_json),
+                                                 consumers, carts, operations))
+            output_file.write(header_json)
+            output_file.write(_padding(BINARY_HEADER.size + len(header_json)))
+            for name, _ in BINARY_COLUMNS:
+                column = columns[name]
+                column.flush()
+                column.file.seek(0)
+                shutil.copyfileobj(column.file, output_file)
+                output_file.write(_padding(output_file.tell()))
+    finally:
+        for column in columns.values():
+            column.file.close()
+
+    return consumers
+
+
+def read_binary_header(filename):
+    """
+    Reads the header of a binary scenario
+
+    :returns the dict of everything but the consumers, the offset of the first column
+    and the number of consumers, carts and operations
+    """
+    with open(filename, 'rb') as input_file:
+        magic, header_size, consumers, carts, operations = \
+            BINARY_HEADER.unpack(input_file.read(BINARY_HEADER.size))
+        if magic != BINARY_MAGIC:
+            raise ValueError("{} is not a binary scenario".format(filename))
+        header = json.loads(input_file.read(header_size))
+
+    if header['byteorder'] != sys.byteorder:
+        raise ValueError("{} was written on a {} endian machine".format(
+            filename, header['byteorder']))
+    offset = BINARY_HEADER.size + header_size
+    return header, offset + len(_padding(offset)), (consumers, carts, operations)
+
+
+def iter_binary_consumers(filename, products):
+    """
+    Yields the consumers of a binary scenario, built from its memory-mapped columns
+    as they are requested
+
+    :type products: List
+    :param products: the Products, in the order of the header's products
+    """
+    # pylint: disable=too-many-locals
+    _, offset, (consumers, carts, operations) = read_binary_header(filename)
+    lengths = {'consumer_carts': consumers + 1, 'cart_operations': carts + 1,
+               'name_offsets': consumers + 1, 'retry_wait_time': consumers,
+               'operation_product': operations, 'operation_quantity': operations,
+               'operation_type': operations}
+
+    with open(filename, 'rb') as input_file, \
+            mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        data = memoryview(mapped)
+        columns = {}
+        for name, typecode in BINARY_COLUMNS:
+            length = lengths.get(name)
+            if length is None:
+                length = columns['name_offsets'][-1]
+            size = length * array(typecode).itemsize
+            columns[name] = data[offset:offset + size].cast(typecode)
+            offset += size + len(_padding(size))
+
+        try:
+            consumer_carts, cart_operations = columns['consumer_carts'], columns['cart_operations']
+            name_offsets, names = columns['name_offsets'], columns['names']
+            operation_product = columns['operation_product']
+            operation_quantity = columns['operation_quantity']
+            operation_type = columns['operation_type']
+
+            for idx in range(consumers):
+                yield {
+                    'name': bytes(names[name_offsets[idx]:name_offsets[idx + 1]]).decode(),
+                    'retry_wait_time': columns['retry_wait_time'][idx],
+                    'carts': [[{'type': OPERATION_TYPES[operation_type[op]],
+                                'product': products[operation_product[op]],
+                                'quantity': operation_quantity[op]}
+                               for op in range(cart_operations[cart],
+                                               cart_operations[cart + 1])]
+                              for cart in range(consumer_carts[idx], consumer_carts[idx + 1])]
+                }
+        finally:
+            # the map can only be closed once nothing points into it
+            for column in columns.values():
+                column.release()
+            data.release()
+
+
+class TestScenario(unittest.TestCase):
+    """
+    Unit testing for the streaming and binary scenario loaders
+    """
+
+    def setUp(self):
+        """
+        Write a small configuration, with the consumers before the marketplace as in
+        the tests/*.in files
+        """
+        self.market_config = {
+            'products': {
+                'id1': {'product_type': 'Coffee', 'name': 'Arabica', 'price': 10,
+                        'acidity': 5.02, 'roast_level': 'MEDIUM'},
+                'id2': {'product_type': 'Tea', 'name': 'Linden', 'price': 9, 'type': 'Herbal'},
+            },
+            'producers': [{'name': 'prod1', 'products': [['id1', 2, 0.1], ['id2', 1, 0.2]],
+                           'republish_wait_time': 0.15}],
+            'consumers': [
+                {'name': 'cons1', 'retry_wait_time': 0.1,
+                 'carts': [[{'type': 'add', 'product': 'id1', 'quantity': 3},
+                            {'type': 'remove', 'product': 'id1', 'quantity': 1}],
+                           [{'type': 'add', 'product': 'id2', 'quantity': 12345}]]},
+                {'name': 'consă', 'retry_wait_time': 0.25, 'carts': []},
+            ],
+            'marketplace': {'queue_size_per_producer': 8},
+        }
+        # removed with the written files once the test is done
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.json_filename = os.path.join(self.tmpdir, 'test.in')
+        with open(self.json_filename, 'w', encoding='utf-8') as json_file:
+            json.dump(self.market_config, json_file, indent=4)
+
+    def expected_consumers(self):
+        """
+        Returns the consumers, resolved as resolve_market_config does
+        """
+        return resolve_market_config(json.loads(json.dumps(self.market_config)))['consumers']
+
+    def test_stream_reader(self):
+        """
+        Check that values split across many small chunks are decoded
+        """
+        document = '{"a": [1, 22, {"b": "c, d"}] , "e" : 333, "f": [], "g": {}}'
+        reader = JsonStreamReader(io.StringIO(document), chunk_size=3)
+        decoded = {}
+        for key in reader.object_keys():
+            decoded[key] = list(reader.array_items()) if key == 'a' else reader.value()
+        self.assertDictEqual(decoded, {'a': [1, 22, {'b': 'c, d'}], 'e': 333, 'f': [], 'g': {}})
+        self.assertEqual(reader.peek(), '')
+
+        with self.assertRaises(ValueError):
+            list(JsonStreamReader(io.StringIO('{"a": [1, 2'), chunk_size=4).object_keys())
+
+    def test_load_json(self):
+        """
+        Check that the streamed configuration matches the one loaded at once
+        """
+        market_config = load_market_config(self.json_filename)
+        self.assertDictEqual(market_config['marketplace'], {'queue_size_per_producer': 8})
+        self.assertEqual(market_config['producers'][0]['products'][1][0],
+                         Tea('Linden', 9, 'Herbal'))
+        self.assertListEqual(list(market_config['consumers']), self.expected_consumers())
+
+    def test_binary(self):
+        """
+        Check that a converted configuration loads the same as the JSON one
+        """
+        binary_filename = os.path.join(self.tmpdir, 'test.scn')
+        self.assertEqual(convert_to_binary(self.json_filename, binary_filename), 2)
+
+        market_config = load_market_config(binary_filename)
+        self.assertDictEqual(market_config['marketplace'], {'queue_size_per_producer': 8})
+        self.assertEqual(market_config['producers'][0]['products'][0][0],
+                         Coffee('Arabica', 10, 5.02, 'MEDIUM'))
+        self.assertListEqual(list(market_config['consumers']), self.expected_consumers())
+
+    def test_trailing_entries(self):
+        """
+        Check that the keys after the consumers are read from the end of the file, and
+        that an end that does not parse is rejected
+        """
+        self.assertDictEqual(read_trailing_entries(self.json_filename, {'marketplace'}),
+                             {'marketplace': {'queue_size_per_producer': 8}})
+        self.assertIsNone(parse_trailing_entries(', "a": [1]], "b": 2}'))
+
+        # the producers after the consumers too, an array ending right before the marketplace
+        reordered = {key: self.market_config[key]
+                     for key in ('products', 'consumers', 'producers', 'marketplace')}
+        with open(self.json_filename, 'w', encoding='utf-8') as json_file:
+            json.dump(reordered, json_file)
+        self.assertDictEqual(read_json_header(self.json_filename),
+                             {key: self.market_config[key]
+                              for key in ('products', 'producers', 'marketplace')})
+
+        # an end that is not the end of a JSON object is never guessed at
+        with open(self.json_filename, 'a', encoding='utf-8') as json_file:
+            json_file.write('x')
+        self.assertIsNone(read_trailing_entries(self.json_filename, {'marketplace'}))
@@ -0,0 +1,156 @@
+"""
+This module holds the policies that choose which producer's units a consumer gets.
+
+A producer of several products stops at the first one its full buffer has no room for.
+Which buffers the consumers drain decides whether it ever gets rid of the units nobody
+buys anymore, so a scenario that finishes under one policy could deadlock under another:
+tests/10.in did when fullest-first favoured the fullest buffers regardless of what they
+held.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import random
+import unittest
+
+from .buffer import ProducerBuffer
+
+
+class FirstFitSelection:
+    """
+    Takes the units of the producer that has held the product the longest. The index keeps
+    the holders in the order they got the product, so this drains one producer at a time.
+    """
+
+    def select(self, product_id, holders, buffers):
+        """
+        Chooses the producer a consumer takes the next units of a product from. Called with
+        the lock stripe of the product held, so the state kept per product is safe.
+
+        :type product_id: Int
+        :param product_id: the id of the product
+
+        :type holders: Dict
+        :param holders: a dict<producer_id, count>, not empty, of the producers holding it
+
+        :type buffers: List
+        :param buffers: a list<ProducerBuffer> indexed by producer_id
+
+        :returns the id of one of the holders
+        """
+        # pylint: disable=unused-argument
+        return next(iter(holders))
+
+
+class RoundRobinSelection(FirstFitSelection):
+    """
+    Takes the units of each product from its holders in turn, by producer id
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.last = {}  # a dict<product_id, the producer_id its last units came from>
+
+    def select(self, product_id, holders, buffers):
+        last = self.last.get(product_id, -1)
+        producer_id = min((idx for idx in holders if idx > last), default=None)
+        if producer_id is None:
+            producer_id = min(holders)
+        self.last[product_id] = producer_id
+        return producer_id
+
+
+class FullestFirstSelection(FirstFitSelection):
+    """
+    Takes the units of the holder whose buffer is the fullest of the product, the one
+    where most of the buffer is made of its units. That producer is most likely waiting
+    for room to publish more of it, and draining it lets the producer move on to its
+    next product. Favouring the fullest buffer regardless of what it holds would instead
+    spread the units taken over buffers full of other products, where a producer of
+    several products stays stuck. Ties go to the first holder, as in first-fit, and the
+    chosen producer always holds the product. The buffers are sized without their locks:
+    a size that is out of date only makes the choice less accurate.
+    """
+
+    def select(self, product_id, holders, buffers):
+        return max(holders, key=lambda idx: holders[idx] / max(len(buffers[idx]), 1))
+
+
+class RandomSelection(FirstFitSelection):
+    """
+    Takes the units of a holder chosen at random
+    """
+
+    def __init__(self, seed=None):
+        """
+        Constructor
+
+        :type seed: Int
+        :param seed: seeds the choices, None for a different sequence on every run
+        """
+        self.random = random.Random(seed)
+
+    def select(self, product_id, holders, buffers):
+        return self.random.choice(list(holders))
+
+
+# a dict<name, class> of the policies Marketplace accepts
+SELECTION_POLICIES = {
+    'first-fit': FirstFitSelection,
+    'round-robin': RoundRobinSelection,
+    'fullest-first': FullestFirstSelection,
+    'random': RandomSelection,
+}
+
+
+class TestSelection(unittest.TestCase):
+    """
+    Unit testing for the selection policies
+    """
+
+    def setUp(self):
+        """
+        Set up three producers holding a product, with 1, 3 and 2 units in their buffers
+        """
+        self.holders = {2: 2, 0: 1, 1: 3}
+        self.buffers = [ProducerBuffer() for _ in range(3)]
+        for idx, count in self.holders.items():
+            self.buffers[idx].add('product', count)
+
+    def test_first_fit(self):
+        """
+        Check that the first holder in the index is chosen
+        """
+        self.assertEqual(FirstFitSelection().select(0, self.holders, self.buffers), 2)
+
+    def test_round_robin(self):
+        """
+        Check that the holders are taken in turn, separately for each product
+        """
+        policy = RoundRobinSelection()
+        self.assertListEqual([policy.select(0, self.holders, self.buffers) for _ in range(4)],
+                             [0, 1, 2, 0])
+        self.assertEqual(policy.select(1, self.holders, self.buffers), 0)
+
+    def test_fullest_first(self):
+        """
+        Check that the holder whose buffer is the fullest of the product is chosen, not
+        the one with the fullest buffer, and that ties go to the first holder
+        """
+        policy = FullestFirstSelection()
+        self.assertEqual(policy.select(0, self.holders, self.buffers), 2)
+
+        self.buffers[1].add('other product', 3)
+        self.buffers[2].add('other product', 2)
+        self.assertEqual(policy.select(0, self.holders, self.buffers), 0)
+
+    def test_random(self):
+        """
+        Check that a seeded policy chooses holders, the same ones on every run
+        """
+        choices = [RandomSelection(7).select(0, self.holders, self.buffers) for _ in range(2)]
+        self.assertIn(choices[0], self.holders)
+        self.assertEqual(choices[0], choices[1])
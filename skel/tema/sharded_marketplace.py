@@ -0,0 +1,552 @@
+"""
+This module represents the process-parallel, sharded Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import io
+import multiprocessing
+import os
+import queue
+import threading
+import unittest
+from contextlib import redirect_stderr
+from multiprocessing import shared_memory
+
+from .cart import CartTable
+from .consumer import Consumer
+from .output import OrderWriter
+from .producer import Producer
+from .product import Tea, Coffee
+
+COUNTER_SIZE = 8  # the counters in the shared memory are signed 64-bit integers
+OUTPUT_POLL_INTERVAL = 0.5  # seconds between the checks for failed shards
+
+
+class SharedInventory:
+    """
+    The counters shared by all the shards: the stock of every (product, producer) pair,
+    followed by the number of units each producer has in the marketplace, and the locks
+    guarding the latter
+    """
+
+    def __init__(self, num_products, num_producers, occupancy_locks, name=None):
+        """
+        Constructor. Creates the shared memory block, or attaches to the existing one
+        if its name is given
+
+        :type num_products: Int
+        :param num_products: the number of distinct products in the marketplace
+
+        :type num_producers: Int
+        :param num_producers: the number of producers in the marketplace
+
+        :type occupancy_locks: List
+        :param occupancy_locks: process-shared locks, striped by producer, guarding the
+        occupancy counters
+
+        :type name: String
+        :param name: the name of an existing shared memory block
+        """
+        self.num_products = num_products
+        self.num_producers = num_producers
+        self.occupancy_locks = occupancy_locks
+        size = max(1, (num_products + 1) * num_producers) * COUNTER_SIZE
+
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.memory.buf[:size] = bytes(size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.counters = self.memory.buf.cast('q')
+
+    @property
+    def name(self):
+        """
+        Returns the name other processes use to attach to the shared memory block
+        """
+        return self.memory.name
+
+    def stock(self, product_idx, producer_id):
+        """
+        Returns the offset of the stock counter of a (product, producer) pair
+        """
+        return product_idx * self.num_producers + producer_id
+
+    def occupancy(self, producer_id):
+        """
+        Returns the offset of the counter of the units a producer has in the marketplace
+        """
+        return self.num_products * self.num_producers + producer_id
+
+    def occupancy_lock(self, producer_id):
+        """
+        Returns the process-shared lock guarding the occupancy of the given producer
+        """
+        return self.occupancy_locks[producer_id % len(self.occupancy_locks)]
+
+    def close(self, unlink=False):
+        """
+        Detaches from the shared memory block and, for its creator, frees it
+        """
+        self.counters.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class ShardMarketplace:
+    """
+    The part of the marketplace that runs in one worker process. It owns a subset of the
+    products and has the same methods as Marketplace, so the regular Producer and Consumer
+    threads can use it.
+    """
+
+    def __init__(self, queue_size_per_producer, inventory, product_ids, producer_ids):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type inventory: SharedInventory
+        :param inventory: the counters and their locks, shared with the other shards
+
+        :type product_ids: Dict
+        :param product_ids: a dict<product, index> for the products owned by this shard
+
+        :type producer_ids: Dict
+        :param producer_ids: a dict<producer name, id>, the same in every shard
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        self.inventory = inventory
+        self.product_ids = product_ids
+        self.producer_ids = producer_ids
+        self.print_lock = threading.Lock()  # lock used for print() calls by consumers
+        self.stock_condition = threading.Condition()  # guards the stock of this shard
+        # the carts, multisets of (producer_id, product) pairs
+        self.carts = CartTable()
+        self.holders = {}  # a dict<product index, dict<producer_id, None>> of the stock owners
+        self.departed = set()  # the ids of the producers that unregistered from this shard
+        self.closed = False  # set once the shard's consumers are done, stops publishing
+
+    def get_print_lock(self):
+        """
+        Returns the lock used for printing consumer lists
+        """
+        return self.print_lock
+
+    def register_producer(self):
+        """
+        Returns the id of the producer that calls this. Every shard runs a thread for the
+        same producer, so the id is looked up by the thread's name instead of being counted.
+        """
+        return self.producer_ids[threading.current_thread().name]
+
+    def unregister_producer(self, producer_id):
+        """
+        Takes a producer's units out of this shard's stock, freeing their room in its
+        buffer. The ids are fixed, so they are never reused; the producer's units that are
+        removed from carts afterwards are dropped.
+
+        :returns a list with the producer's unsold products in this shard, one per unit
+        """
+        counters = self.inventory.counters
+        products = {idx: product for product, idx in self.product_ids.items()}
+        unsold = []
+        with self.stock_condition:
+            self.departed.add(producer_id)
+            for product_idx, holders in self.holders.items():
+                if producer_id not in holders:
+                    continue
+                del holders[producer_id]
+                stock = self.inventory.stock(product_idx, producer_id)
+                unsold += [products[product_idx]] * counters[stock]
+                counters[stock] = 0
+            with self.inventory.occupancy_lock(producer_id):
+                counters[self.inventory.occupancy(producer_id)] -= len(unsold)
+        return unsold
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        Adds the product provided by the producer to the marketplace
+
+        :returns True or False. If the caller receives False, it should wait and then try again.
+        """
+        return self.publish_many(producer_id, product, 1, timeout) == 1
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Adds up to quantity units of the product to the marketplace. The room in the buffer
+        is shared with the other shards, so timeout is not supported and the caller should
+        retry after republish_wait_time.
+
+        :returns the number of units published
+        """
+        # pylint: disable=unused-argument
+        counters = self.inventory.counters
+        occupancy = self.inventory.occupancy(producer_id)
+        with self.inventory.occupancy_lock(producer_id):
+            count = min(quantity, self.queue_size_per_producer - counters[occupancy])
+            if count <= 0:
+                return 0
+            counters[occupancy] += count
+
+        product_idx = self.product_ids[product]
+        with self.stock_condition:
+            if self.closed:
+                with self.inventory.occupancy_lock(producer_id):
+                    counters[occupancy] -= count
+                return 0
+            counters[self.inventory.stock(product_idx, producer_id)] += count
+            self.holders.setdefault(product_idx, {})[producer_id] = None
+            self.stock_condition.notify_all()
+        return count
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        return self.carts.new()
+
+    def release_cart(self, cart_id):
+        """
+        Gives up a cart once its order was placed: the units still in it go back in stock
+        and its id may be given to a new cart
+        """
+        cart = self.carts[cart_id]
+        for product in list(cart.products):
+            self.remove_from_cart(cart_id, product, cart.count(product))
+        self.carts.release(cart_id)
+
+    def add_to_cart(self, cart_id, product, quantity=1, timeout=0):
+        """
+        Adds up to quantity units of a product to the given cart, waiting at most timeout
+        seconds for the product to be in stock
+
+        :returns the number of units added
+        """
+        counters = self.inventory.counters
+        product_idx = self.product_ids[product]
+        taken = {}  # a dict<producer_id, count> of the units reserved from each producer
+
+        with self.stock_condition:
+            if not self.holders.get(product_idx) and timeout != 0:
+                self.stock_condition.wait_for(lambda: self.holders.get(product_idx), timeout)
+
+            holders = self.holders.get(product_idx)
+            added = 0
+            while holders and added < quantity:
+                idx = next(iter(holders))
+                stock = self.inventory.stock(product_idx, idx)
+                count = min(counters[stock], quantity - added)
+                counters[stock] -= count
+                if counters[stock] == 0:
+                    del holders[idx]
+                self.carts[cart_id].add(idx, product, count)
+                taken[idx] = count
+                added += count
+
+        for idx, count in taken.items():
+            with self.inventory.occupancy_lock(idx):
+                counters[self.inventory.occupancy(idx)] -= count
+        return added
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        Removes up to quantity units of a product from cart
+
+        :returns the number of units removed
+        """
+        counters = self.inventory.counters
+        product_idx = self.product_ids[product]
+        returned = self.carts[cart_id].remove(product, quantity)
+        removed = sum(returned.values())
+
+        if returned:
+            with self.stock_condition:
+                for idx, count in returned.items():
+                    # the units of the producers that left are dropped
+                    if idx in self.departed:
+                        continue
+                    with self.inventory.occupancy_lock(idx):
+                        counters[self.inventory.occupancy(idx)] += count
+                    counters[self.inventory.stock(product_idx, idx)] += count
+                    self.holders.setdefault(product_idx, {})[idx] = None
+                self.stock_condition.notify_all()
+        return removed
+
+    def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart.
+        """
+        cart = self.carts[cart_id]
+        result = list(cart.expand())
+        cart.clear()
+        return result
+
+    def available(self, product):
+        """
+        Returns the number of units of a product in stock, without taking any lock
+        """
+        product_idx = self.product_ids[product]
+        counters = self.inventory.counters
+        # the holders are copied in one step, another thread may change them meanwhile
+        return sum(counters[self.inventory.stock(product_idx, idx)]
+                   for idx in list(self.holders.get(product_idx, ())))
+
+    def inventory_snapshot(self):
+        """
+        Returns a dict<product, units in stock> of the products of this shard in stock,
+        without taking any lock
+        """
+        snapshot = {product: self.available(product) for product in self.product_ids}
+        return {product: count for product, count in snapshot.items() if count}
+
+    def publish_retry_after(self, producer_id):
+        """
+        The sharded marketplace gives no retry hints
+
+        :returns None
+        """
+        # pylint: disable=unused-argument
+        return None
+
+    def add_retry_after(self, product):
+        """
+        The sharded marketplace gives no retry hints
+
+        :returns None
+        """
+        # pylint: disable=unused-argument
+        return None
+
+    def record_retry(self, operation):
+        """
+        Called by producers and consumers when an operation has to be retried. The
+        sharded marketplace takes no metrics.
+        """
+
+    def release_stock(self):
+        """
+        Takes this shard's unsold units out of the marketplace, freeing the room they
+        took in their producers' buffers for the shards that are still running. Nothing
+        can be published afterwards.
+        """
+        counters = self.inventory.counters
+        with self.stock_condition:
+            self.closed = True
+            for product_idx, holders in self.holders.items():
+                for idx in holders:
+                    stock = self.inventory.stock(product_idx, idx)
+                    with self.inventory.occupancy_lock(idx):
+                        counters[self.inventory.occupancy(idx)] -= counters[stock]
+                    counters[stock] = 0
+            self.holders.clear()
+
+
+def shard_config(market_config, product_ids):
+    """
+    Returns the producers and consumers of the given configuration restricted to the
+    products in product_ids. Producers and consumers left with nothing to do are dropped.
+    """
+    producers = []
+    for producer in market_config['producers']:
+        products = [entry for entry in producer['products'] if entry[0] in product_ids]
+        if products:
+            producers.append(dict(producer, products=products))
+
+    consumers = []
+    for consumer in market_config['consumers']:
+        carts = [[op for op in cart if op['product'] in product_ids]
+                 for cart in consumer['carts']]
+        carts = [cart for cart in carts if cart]
+        if carts:
+            consumers.append(dict(consumer, carts=carts))
+
+    return producers, consumers
+
+
+def run_shard(market_config, product_ids, producer_ids, inventory_name,
+              occupancy_locks, blocking, aggregate, retry, output):
+    """
+    Runs, in a worker process, the producers and consumers of one shard and sends the
+    consumers' orders, as text, to the output queue
+    """
+    # pylint: disable=too-many-arguments
+    inventory = SharedInventory(len(market_config['products']),
+                                len(market_config['producers']), occupancy_locks,
+                                inventory_name)
+    marketplace = ShardMarketplace(market_config['marketplace']['queue_size_per_producer'],
+                                   inventory, product_ids, producer_ids)
+    producers_config, consumers_config = shard_config(market_config, product_ids)
+
+    printed = io.StringIO()
+    with OrderWriter(printed, aggregate) as writer:
+        producers = [Producer(**p_market_config, marketplace=marketplace, retry=retry,
+                              daemon=True)
+                     for p_market_config in producers_config]
+        for producer in producers:
+            producer.start()
+
+        consumers = [Consumer(**c_market_config, marketplace=marketplace, blocking=blocking,
+                              output=writer, retry=retry)
+                     for c_market_config in consumers_config]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+
+    # The producers keep running until the process exits, so the shared memory stays mapped
+    marketplace.release_stock()
+    output.put(printed.getvalue())
+
+
+def run_market(market_config, shards=None, blocking=False, aggregate=False, retry='fixed'):
+    """
+    Runs the given configuration (with the product ids already turned into products)
+    on several processes, each owning a shard of the products, and prints what the
+    consumers bought
+
+    :type shards: Int
+    :param shards: the number of worker processes, by default one per CPU
+
+    :type aggregate: Bool
+    :param aggregate: print the orders in the aggregated format of OrderWriter
+
+    :type retry: String
+    :param retry: the retry policy of the producers and consumers, without hints
+    """
+    products = list(dict.fromkeys(product for producer in market_config['producers']
+                                  for product, _, _ in producer['products']))
+    producer_ids = {producer['name']: idx
+                    for idx, producer in enumerate(market_config['producers'])}
+    shards = max(1, min(shards or os.cpu_count(), len(products)))
+
+    config = dict(market_config, products=products)
+    inventory = SharedInventory(len(products), len(producer_ids),
+                                [multiprocessing.Lock()
+                                 for _ in range(min(16, len(producer_ids) or 1))])
+    output = multiprocessing.Queue()
+
+    workers = [multiprocessing.Process(
+        target=run_shard,
+        args=(config, {product: idx for idx, product in enumerate(products)
+                       if idx % shards == shard},
+              producer_ids, inventory.name, inventory.occupancy_locks, blocking, aggregate,
+              retry, output))
+               for shard in range(shards)]
+    try:
+        for worker in workers:
+            worker.start()
+
+        pending = len(workers)
+        while pending:
+            try:
+                print(output.get(timeout=OUTPUT_POLL_INTERVAL), end='')
+                pending -= 1
+            except queue.Empty as exc:
+                # a shard that failed never sends its output
+                failed = [worker for worker in workers if worker.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError("shard worker {} exited with code {}".format(
+                        failed[0].name, failed[0].exitcode)) from exc
+
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.kill()
+        inventory.close(unlink=True)
+
+
+class TestShardedMarketplace(unittest.TestCase):
+    """
+    Unit testing for the shared counters of the sharded marketplace
+    """
+
+    def setUp(self):
+        """
+        Set up a one-shard marketplace with 2 products and 2 producers
+        """
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+        self.inventory = SharedInventory(2, 2, [multiprocessing.Lock()])
+        self.marketplace = ShardMarketplace(3, self.inventory,
+                                            {self.tea_product: 0, self.coffee_product: 1},
+                                            {'prod1': 0, 'prod2': 1})
+
+    def tearDown(self):
+        """
+        Free the shared memory
+        """
+        self.inventory.close(unlink=True)
+
+    def test_counters(self):
+        """
+        Check that the stock and occupancy counters follow the operations
+        """
+        counters = self.inventory.counters
+        self.assertEqual(self.marketplace.publish_many(0, self.tea_product, 2), 2)
+        self.assertEqual(self.marketplace.publish_many(0, self.coffee_product, 2), 1)
+        self.assertEqual(self.marketplace.publish_many(1, self.tea_product, 1), 1)
+        self.assertEqual(counters[self.inventory.occupancy(0)], 3)
+        self.assertEqual(counters[self.inventory.stock(0, 0)], 2)
+        self.assertEqual(self.marketplace.available(self.tea_product), 3)
+        self.assertDictEqual(self.marketplace.inventory_snapshot(),
+                             {self.tea_product: 3, self.coffee_product: 1})
+
+        cart = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_to_cart(cart, self.tea_product, 5), 3)
+        self.assertEqual(counters[self.inventory.occupancy(0)], 1)
+        self.assertEqual(counters[self.inventory.occupancy(1)], 0)
+
+        self.assertEqual(self.marketplace.remove_from_cart(cart, self.tea_product, 1), 1)
+        self.assertEqual(counters[self.inventory.stock(0, 0)], 1)
+        self.assertListEqual(self.marketplace.place_order(cart), [self.tea_product] * 2)
+
+        self.marketplace.release_stock()
+        self.assertEqual(counters[self.inventory.occupancy(0)], 0)
+        self.assertEqual(counters[self.inventory.stock(1, 0)], 0)
+
+    def test_shard_config(self):
+        """
+        Check that a shard only keeps the operations on its own products
+        """
+        market_config = {
+            'producers': [{'name': 'prod1', 'republish_wait_time': 0.1,
+                           'products': [(self.tea_product, 1, 0.1)]}],
+            'consumers': [{'name': 'cons1', 'retry_wait_time': 0.1,
+                           'carts': [[{'type': 'add', 'product': self.coffee_product,
+                                       'quantity': 1}],
+                                     [{'type': 'add', 'product': self.tea_product,
+                                       'quantity': 1}]]}]
+        }
+        producers, consumers = shard_config(market_config, {self.tea_product: 0})
+        self.assertEqual(len(producers), 1)
+        self.assertEqual(len(consumers[0]['carts']), 1)
+
+        producers, consumers = shard_config(market_config, {self.coffee_product: 1})
+        self.assertListEqual(producers, [])
+        self.assertEqual(consumers[0]['carts'][0][0]['product'], self.coffee_product)
+
+    def test_failed_shard(self):
+        """
+        Check that a shard failing does not leave the parent waiting for its output
+        """
+        market_config = {
+            'marketplace': {'queue_size_per_producer': 2},
+            'producers': [{'name': 'prod1', 'republish_wait_time': 0.1,
+                           'products': [(self.tea_product, 1, 0.1)]}],
+            # the missing retry_wait_time makes the Consumer constructor fail in the worker
+            'consumers': [{'name': 'cons1',
+                           'carts': [[{'type': 'add', 'product': self.tea_product,
+                                       'quantity': 1}]]}]
+        }
+        with redirect_stderr(io.StringIO()), self.assertRaises(RuntimeError):
+            run_market(market_config, shards=1)
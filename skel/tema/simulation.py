@@ -0,0 +1,288 @@
+"""
+This module runs producers and consumers as a discrete-event simulation, against a
+virtual clock.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import contextlib
+import heapq
+import io
+import itertools
+import os
+import time
+import unittest
+from collections import Counter
+
+from .consumer import Consumer
+from .marketplace import Marketplace
+from .producer import Producer
+from .product import Tea, Coffee
+from .scenario import load_market_config
+
+# how many times longer than the bound of a healthy run a scenario may run by default
+TIME_LIMIT_FACTOR = 2
+# the longest a retry waits, in retry wait times, as for retry.ExponentialBackoff's spread
+RETRY_SPREAD = 4
+
+
+class Simulation:
+    """
+    Runs agents, generators that yield the number of seconds they sleep, one step at a
+    time in the order of a virtual clock. Sleeping only moves an agent further in the
+    event queue, so it takes no wall time. Agents due at the same time run in the order
+    they were scheduled in, which makes every run of a scenario identical.
+    """
+
+    def __init__(self, time_limit=None):
+        """
+        Constructor
+
+        :type time_limit: Float
+        :param time_limit: the virtual time after which run() gives up, None for no limit
+        """
+        self.now = 0.0  # the virtual time, in seconds
+        self.time_limit = time_limit
+        self.events = []  # a heap of (time, sequence number, agent, daemon)
+        self.sequence = itertools.count()  # orders the events due at the same time
+        self.running = 0  # the number of non-daemon agents that did not finish
+        self.steps = 0
+
+    def spawn(self, agent, daemon=False):
+        """
+        Adds an agent, whose first step runs at the current virtual time.
+        As for threads, run() does not wait for the daemon agents to finish.
+        """
+        heapq.heappush(self.events, (self.now, next(self.sequence), agent, daemon))
+        if not daemon:
+            self.running += 1
+
+    def run(self):
+        """
+        Runs the agents until all the non-daemon ones finished
+
+        :returns the virtual time at which the last of them finished
+        """
+        while self.running:
+            when, _, agent, daemon = heapq.heappop(self.events)
+            if self.time_limit is not None and when > self.time_limit:
+                raise TimeoutError("the simulation did not finish in {} virtual seconds, "
+                                   "{} agents are still running".format(self.time_limit,
+                                                                        self.running))
+            self.now = when
+            self.steps += 1
+            try:
+                delay = next(agent)
+            except StopIteration:
+                if not daemon:
+                    self.running -= 1
+                continue
+            heapq.heappush(self.events, (when + delay, next(self.sequence), agent, daemon))
+        return self.now
+
+
+def default_time_limit(producers, consumers):
+    """
+    Returns a virtual time a run of the given producers and consumers (the entries of a
+    market configuration) can not reach unless it deadlocked: the producers publish side
+    by side, so each unit added to a cart is served, at the latest, once the slowest of
+    them went through all its products and its consumer waited the longest it retries
+    for. The agents poll the marketplace, so a deadlocked run never runs out of events
+    and has to be stopped at such a limit.
+    """
+    cycle = 0
+    for p_market_config in producers:
+        cycle = max(cycle, sum(product[1] * product[2]
+                               + RETRY_SPREAD * p_market_config['republish_wait_time']
+                               for product in p_market_config['products']))
+
+    limit = 0
+    for c_market_config in consumers:
+        units = sum(operation['quantity'] for cart in c_market_config['carts']
+                    for operation in cart if operation['type'] == 'add')
+        limit = max(limit, (units + 1) * (cycle + RETRY_SPREAD
+                                          * c_market_config['retry_wait_time']))
+    return TIME_LIMIT_FACTOR * max(limit, 1)
+
+
+def run_market(market_config, time_limit=None, output=None, retry='fixed'):
+    """
+    Runs the producers and consumers of the given configuration (with the product ids
+    already turned into products) on a virtual clock, in the calling thread, until
+    every consumer placed its order. Producers and consumers retry as in the threads
+    engine without blocking, but their sleeps take no time.
+
+    :type time_limit: Float
+    :param time_limit: the virtual seconds after which the run fails with a TimeoutError,
+    e.g. when the scenario deadlocks, None for the default_time_limit of the scenario
+
+    :type output: OrderWriter
+    :param output: the writer the orders are submitted to, None prints them directly
+
+    :type retry: String
+    :param retry: the retry policy of the producers and consumers
+
+    :returns the Marketplace used
+    """
+    marketplace = Marketplace(**market_config['marketplace'])
+    simulation = Simulation(time_limit)
+    # the retry hints are measured in virtual time
+    if marketplace.hints is not None:
+        marketplace.hints.clock = lambda: simulation.now
+
+    # the agents are only stepped, never started as threads
+    for p_market_config in market_config['producers']:
+        producer = Producer(**p_market_config, marketplace=marketplace, retry=retry)
+        simulation.spawn(producer.steps(), daemon=True)
+
+    # the consumers may be streamed, the limit is known once they were all read
+    c_market_configs = []
+    for c_market_config in market_config['consumers']:
+        consumer = Consumer(**c_market_config, marketplace=marketplace, output=output,
+                            retry=retry)
+        simulation.spawn(consumer.steps())
+        c_market_configs.append(c_market_config)
+    if time_limit is None:
+        simulation.time_limit = default_time_limit(market_config['producers'],
+                                                   c_market_configs)
+
+    simulation.run()
+    return marketplace
+
+
+class TestSimulation(unittest.TestCase):
+    """
+    Unit testing for the virtual clock and the simulated market
+    """
+
+    def setUp(self):
+        """
+        Set up the products used by the tests
+        """
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+    def market_config(self, producers_products):
+        """
+        Returns a configuration with the given producers and two consumers of coffee
+        """
+        return {
+            'marketplace': {'queue_size_per_producer': 2},
+            'producers': [{'name': 'prod{}'.format(idx), 'products': products,
+                           'republish_wait_time': 5}
+                          for idx, products in enumerate(producers_products)],
+            'consumers': [{'name': 'cons{}'.format(idx), 'retry_wait_time': 3,
+                           'carts': [[{'type': 'add', 'product': self.coffee_product,
+                                       'quantity': 3},
+                                      {'type': 'remove', 'product': self.coffee_product,
+                                       'quantity': 1}],
+                                     [{'type': 'add', 'product': self.coffee_product,
+                                       'quantity': 2}]]}
+                          for idx in range(2)],
+        }
+
+    def test_event_order(self):
+        """
+        Check that agents run in virtual time order, ties in the order they were scheduled
+        """
+        simulation = Simulation()
+        trace = []
+
+        def agent(name, delays):
+            for delay in delays:
+                trace.append((simulation.now, name))
+                yield delay
+            trace.append((simulation.now, name))
+
+        simulation.spawn(agent('a', [2, 2]))
+        simulation.spawn(agent('b', [1, 3]))
+        simulation.spawn(agent('daemon', itertools.repeat(4)), daemon=True)
+
+        self.assertEqual(simulation.run(), 4)
+        self.assertListEqual(trace, [(0, 'a'), (0, 'b'), (0, 'daemon'), (1, 'b'),
+                                     (2, 'a'), (4, 'daemon'), (4, 'b'), (4, 'a')])
+
+    def test_run_market(self):
+        """
+        Check that the consumers buy what their carts hold, without sleeping for real
+        """
+        start = time.perf_counter()
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            run_market(self.market_config([[(self.coffee_product, 4, 10)]]))
+        self.assertLess(time.perf_counter() - start, 1)
+
+        self.assertEqual(Counter(printed.getvalue().splitlines()),
+                         {'cons0 bought {}'.format(self.coffee_product): 4,
+                          'cons1 bought {}'.format(self.coffee_product): 4})
+
+        # the runs are deterministic
+        printed_again = io.StringIO()
+        with contextlib.redirect_stdout(printed_again):
+            run_market(self.market_config([[(self.coffee_product, 4, 10)]]))
+        self.assertEqual(printed.getvalue(), printed_again.getvalue())
+
+    def test_idle_producers(self):
+        """
+        Check that producers with nothing to publish do not keep the simulation busy
+        """
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            run_market(self.market_config([[], [(self.tea_product, 0, 1)],
+                                           [(self.coffee_product, 4, 10)]]))
+        self.assertEqual(len(printed.getvalue().splitlines()), 8)
+
+    def test_backoff(self):
+        """
+        Check that the consumers retry with a backoff guided by the marketplace's hints,
+        and that such runs are reproducible too
+        """
+        market_config = self.market_config([[(self.coffee_product, 4, 10)]])
+        market_config['marketplace']['retry_hints'] = True
+        printed = [io.StringIO(), io.StringIO()]
+        for output in printed:
+            with contextlib.redirect_stdout(output):
+                run_market(market_config, retry='backoff')
+        self.assertEqual(len(printed[0].getvalue().splitlines()), 8)
+        self.assertEqual(printed[0].getvalue(), printed[1].getvalue())
+
+    def test_time_limit(self):
+        """
+        Check that a scenario whose consumers can never be served stops at the limit
+        """
+        with self.assertRaises(TimeoutError):
+            run_market(self.market_config([[(self.tea_product, 1, 1)]]), time_limit=1000)
+
+    def test_default_time_limit(self):
+        """
+        Check that a deadlocked scenario stops without a time limit, and that the default
+        limit leaves room for the scenarios that finish
+        """
+        market_config = self.market_config([[(self.tea_product, 1, 1)]])
+        # each consumer adds 5 units, each served within 1 + 4 * 5 + 4 * 3 = 33 seconds
+        self.assertEqual(default_time_limit(market_config['producers'],
+                                            market_config['consumers']), 2 * 6 * 33)
+        with self.assertRaises(TimeoutError):
+            run_market(market_config)
+
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            run_market(self.market_config([[(self.coffee_product, 4, 10)]]))
+        self.assertEqual(len(printed.getvalue().splitlines()), 8)
+
+    def test_fullest_first_selection(self):
+        """
+        Check that tests/10.in, whose producers of several products used to get stuck
+        under the fullest-first selection, finishes with the expected orders
+        """
+        tests_dir = os.path.join(os.path.dirname(__file__), os.pardir, 'tests')
+        market_config = load_market_config(os.path.join(tests_dir, '10.in'))
+        market_config['marketplace']['selection'] = 'fullest-first'
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            run_market(market_config, time_limit=1000)
+
+        with open(os.path.join(tests_dir, '10.ref.out'), encoding='utf-8') as ref_file:
+            self.assertEqual(Counter(printed.getvalue().splitlines()),
+                             Counter(ref_file.read().splitlines()))
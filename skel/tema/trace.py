@@ -0,0 +1,746 @@
+"""
+This module records the calls made to a Marketplace in a compact binary trace, converts
+the text marketplace.log to the same format and replays a trace on a new Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import ast
+import calendar
+import inspect
+import math
+import os
+import pickle
+import re
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter, deque
+
+from .metrics import Histogram
+from .product import Product, Tea, Coffee
+
+# the traced methods, a call's operation is its index in this list
+OPERATIONS = ['register_producer', 'unregister_producer', 'publish', 'publish_many',
+              'new_cart', 'release_cart', 'add_to_cart', 'remove_from_cart', 'place_order']
+CREATES = {'register_producer': 'producer', 'new_cart': 'cart'}  # the calls returning ids
+UNKNOWN = -1  # the result of a call converted from a log line that does not show it
+
+TRACE_MAGIC = b'MKTTRACE'
+# the magic, the queue_size_per_producer (0 if unknown) and the time the trace started
+HEADER = struct.Struct('<8sId')
+PRODUCT_RECORD = 0  # the id and the length of a pickled product, first used by a call
+THREAD_RECORD = 1  # the index and the length of the name of a thread, before its first call
+CALL_RECORD = 2
+RECORD_FORMATS = {
+    PRODUCT_RECORD: struct.Struct('<II'),
+    THREAD_RECORD: struct.Struct('<HH'),
+    # the operation, the thread, the start and the end of the call in nanoseconds since the
+    # trace started, the producer or cart id, the product id (-1 for none), the quantity,
+    # the timeout (NaN for None) and the result
+    CALL_RECORD: struct.Struct('<BHqqiiidq'),
+}
+BUFFER_SIZE = 1 << 16  # the bytes of records kept in memory before being written
+
+
+class TraceCall:
+    """
+    A call read from a trace
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ['operation', 'thread', 'start', 'end', 'target', 'product', 'quantity',
+                 'timeout', 'result']
+
+    def __init__(self, operation, thread, start, end, target, product, quantity, timeout,
+                 result):
+        """
+        Constructor, with the fields of a call record. The operation is its name, the
+        product its id and a timeout of None waits for as long as it takes.
+        """
+        # pylint: disable=too-many-arguments
+        self.operation = operation
+        self.thread = thread
+        self.start = start
+        self.end = end
+        self.target = target
+        self.product = product
+        self.quantity = quantity
+        self.timeout = timeout
+        self.result = result
+
+
+class TraceWriter:
+    """
+    Writes the records of a trace, from any number of threads
+    """
+
+    def __init__(self, filename, queue_size_per_producer=0, started=None):
+        """
+        Constructor
+
+        :type filename: String
+        :param filename: the trace file
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the size of the buffers of the traced Marketplace,
+        0 if unknown
+
+        :type started: Float
+        :param started: the time (since the epoch) the trace started, now by default
+        """
+        # kept open across the writes, until close()
+        self.file = open(filename, 'wb')  # pylint: disable=consider-using-with
+        self.file.write(HEADER.pack(TRACE_MAGIC, queue_size_per_producer,
+                                    time.time() if started is None else started))
+        self.lock = threading.Lock()  # guards the attributes below
+        self.buffer = bytearray()  # the records not written yet
+        self.products = {}  # a dict<product, id in the trace>
+        self.threads = {}  # a dict<thread key, index in the trace>
+
+    def product_id(self, product):
+        """
+        Returns the id of a product in the trace, defining it if it is new. Called with
+        the lock held.
+        """
+        product_id = self.products.get(product)
+        if product_id is None:
+            product_id = self.products[product] = len(self.products)
+            data = pickle.dumps(product, pickle.HIGHEST_PROTOCOL)
+            self.buffer.append(PRODUCT_RECORD)
+            self.buffer += RECORD_FORMATS[PRODUCT_RECORD].pack(product_id, len(data))
+            self.buffer += data
+        return product_id
+
+    def thread_index(self, key, name):
+        """
+        Returns the index of a thread in the trace, naming it if it is new. Called with
+        the lock held.
+        """
+        index = self.threads.get(key)
+        if index is None:
+            index = self.threads[key] = len(self.threads)
+            data = name.encode()
+            self.buffer.append(THREAD_RECORD)
+            self.buffer += RECORD_FORMATS[THREAD_RECORD].pack(index, len(data))
+            self.buffer += data
+        return index
+
+    def add_call(self, operation, thread, start, end, target=0, product=None, quantity=0,
+                 timeout=0, result=0):
+        """
+        Adds a call record
+
+        :type operation: Int
+        :param operation: the index of the method in OPERATIONS
+
+        :type thread: Tuple
+        :param thread: the key and the name of the thread that made the call
+
+        :type start: Int
+        :param start: when the call started, in nanoseconds since the trace started
+        """
+        # pylint: disable=too-many-arguments
+        with self.lock:
+            thread_index = self.thread_index(*thread)
+            product_id = -1 if product is None else self.product_id(product)
+            self.buffer.append(CALL_RECORD)
+            self.buffer += RECORD_FORMATS[CALL_RECORD].pack(
+                operation, thread_index, start, end, target, product_id, quantity,
+                math.nan if timeout is None else timeout, result)
+            if len(self.buffer) >= BUFFER_SIZE:
+                self.file.write(self.buffer)
+                self.buffer.clear()
+
+    def close(self):
+        """
+        Writes the records left and closes the file
+        """
+        with self.lock:
+            self.file.write(self.buffer)
+            self.buffer.clear()
+            self.file.close()
+
+
+class TraceRecorder:
+    """
+    Records the calls made to a Marketplace. The calls a method makes to the others
+    (release_cart removes the units left in the cart) are part of it, not recorded.
+    """
+
+    def __init__(self, filename):
+        """
+        Constructor
+
+        :type filename: String
+        :param filename: the trace file, written once attach() is called
+        """
+        self.filename = filename
+        self.writer = None  # the TraceWriter, created by attach()
+        self.started = None  # time.perf_counter_ns() when the trace started
+        self.local = threading.local()  # whether each thread is in a traced call
+
+    def attach(self, marketplace):
+        """
+        Starts the trace and wraps the traced methods of the marketplace. Called by the
+        Marketplace the recorder is given to.
+        """
+        self.writer = TraceWriter(self.filename, marketplace.queue_size_per_producer)
+        self.started = time.perf_counter_ns()
+        for operation, name in enumerate(OPERATIONS):
+            setattr(marketplace, name, self.traced(marketplace, operation,
+                                                   getattr(marketplace, name)))
+
+    def close(self):
+        """
+        Writes the calls recorded so far and closes the trace
+        """
+        if self.writer is not None:
+            self.writer.close()
+
+    def traced(self, marketplace, operation, method):
+        """
+        Returns method wrapped so that its outermost calls are recorded
+        """
+        products = marketplace.registry.products
+        # the parameters of the method, after self, as timed methods hide them
+        function = inspect.unwrap(method).__func__
+        code = function.__code__
+        names = code.co_varnames[1:code.co_argcount]
+        defaults = dict(zip(reversed(names), reversed(function.__defaults__ or ())))
+        add_call = self.writer.add_call
+        local = self.local
+
+        def traced_method(*args, **kwargs):
+            if getattr(local, 'depth', 0):
+                return method(*args, **kwargs)
+            local.depth = 1
+            start = time.perf_counter_ns()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                local.depth = 0
+            end = time.perf_counter_ns()
+
+            values = dict(defaults, **dict(zip(names, args)), **kwargs)
+            product = values.get('product')
+            if isinstance(product, int):
+                product = products[product]
+            if isinstance(result, list):
+                count = len(result)
+            elif OPERATIONS[operation] in CREATES:
+                count = result
+            else:
+                count = int(result or 0)
+            thread = threading.current_thread()
+            add_call(operation, (thread.ident, thread.name), start - self.started,
+                     end - self.started, values.get('producer_id', values.get('cart_id', 0)),
+                     product, values.get('quantity', 1), values.get('timeout', 0), count)
+            return result
+
+        return traced_method
+
+
+def read_trace(filename):
+    """
+    Reads a trace
+
+    :returns a dict with the 'queue_size_per_producer' (0 if unknown), the time the trace
+    'started', the 'products' and the 'threads' (names), indexed by id, and the 'calls',
+    a list of TraceCall in the order they were recorded
+    """
+    with open(filename, 'rb') as trace_file:
+        data = trace_file.read()
+    if data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise ValueError("{} is not a marketplace trace".format(filename))
+    _, queue_size, started = HEADER.unpack_from(data)
+
+    products, threads, calls = [], [], []
+    offset = HEADER.size
+    while offset < len(data):
+        kind = data[offset]
+        fields = RECORD_FORMATS[kind].unpack_from(data, offset + 1)
+        offset += 1 + RECORD_FORMATS[kind].size
+        if kind == CALL_RECORD:
+            operation, thread, start, end, target, product, quantity, timeout, result = fields
+            calls.append(TraceCall(OPERATIONS[operation], thread, start, end, target,
+                                   product, quantity, None if math.isnan(timeout) else timeout,
+                                   result))
+        elif kind == PRODUCT_RECORD:
+            products.append(pickle.loads(data[offset:offset + fields[1]]))
+            offset += fields[1]
+        else:
+            threads.append(data[offset:offset + fields[1]].decode())
+            offset += fields[1]
+    return {'queue_size_per_producer': queue_size, 'started': started,
+            'products': products, 'threads': threads, 'calls': calls}
+
+
+# the lines of marketplace.log: "[<time>] <level> [<logger>.<function>:<line>] <message>",
+# the messages being "Call <method>(<arguments>)" and "Ret <method>[ = <result>]". The
+# older logs have "Call <method> = <result>" instead of the Ret lines.
+LOG_LINE = re.compile(r"\[(?P<time>[^\]]+)\] \w+ \[[^\]]*\] "
+                      r"(?P<kind>Call|Ret) (?P<name>\w+)(?P<rest>.*)")
+LOG_TIME_FORMAT = '%Y-%m-%d T%H:%M:%S'
+PRODUCT_CLASSES = {'Product': Product, 'Tea': Tea, 'Coffee': Coffee}
+
+
+def parse_product(node):
+    """
+    Returns the product described by an AST node, from its repr or its id
+    """
+    if isinstance(node, ast.Call):
+        return PRODUCT_CLASSES[node.func.id](**{keyword.arg: ast.literal_eval(keyword.value)
+                                               for keyword in node.keywords})
+    # a product passed by its id in the registry, which the log does not describe
+    return Product("product {}".format(ast.literal_eval(node)), 0)
+
+
+def parse_result(text):
+    """
+    Returns the result shown by a Ret line, as traced, or UNKNOWN
+    """
+    match = re.match(r"\s*=\s*(\w+)", text)
+    if match is None:
+        return UNKNOWN
+    try:
+        return int(ast.literal_eval(match.group(1)))
+    except (ValueError, SyntaxError):
+        return UNKNOWN
+
+
+def parse_log(filenames):
+    """
+    Reads the calls of marketplace.log files, oldest first (marketplace.log.1 before
+    marketplace.log). The log has no thread ids, so every producer and cart id is given a
+    thread of its own, and its times are in seconds, so the calls made in the same second
+    are spread evenly over it. A Ret line ends the oldest call of its method in progress.
+
+    :returns the queue_size_per_producer of the marketplace (0 if the log does not show
+    it), the time of the first call and a list of dict<'operation', 'time', 'target',
+    'product', 'quantity', 'timeout', 'result', 'end'>, ordered by time, None being the
+    end of a call that has no Ret line
+    """
+    # pylint: disable=too-many-locals,too-many-branches
+    queue_size = 0
+    calls = []
+    pending = {}  # a dict<method, deque of its calls in progress>
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as log_file:
+            for line in log_file:
+                match = LOG_LINE.match(line.strip())
+                if match is None:
+                    continue
+                name, rest = match.group('name'), match.group('rest')
+                second = calendar.timegm(time.strptime(match.group('time'), LOG_TIME_FORMAT))
+
+                if match.group('kind') == 'Call' and rest.startswith('('):
+                    try:
+                        arguments = {keyword.arg: keyword.value for keyword in
+                                     ast.parse('f' + rest, mode='eval').body.keywords}
+                    except SyntaxError:
+                        # cut by a rotation, or a product repr that is not Python
+                        continue
+                    if name == '__init__':
+                        queue_size = ast.literal_eval(arguments['queue_size_per_producer'])
+                    if name not in OPERATIONS:
+                        continue
+                    call = {'operation': name, 'time': second, 'target': 0, 'product': None,
+                            'quantity': 1, 'timeout': 0, 'result': UNKNOWN, 'end': None}
+                    for key in ('producer_id', 'cart_id'):
+                        if key in arguments:
+                            call['target'] = ast.literal_eval(arguments[key])
+                    if 'product' in arguments:
+                        call['product'] = parse_product(arguments['product'])
+                    if 'quantity' in arguments:
+                        call['quantity'] = ast.literal_eval(arguments['quantity'])
+                    calls.append(call)
+                    pending.setdefault(name, deque()).append(call)
+                elif pending.get(name):
+                    # a Ret line, or an older "Call <method> = <result>" one
+                    call = pending[name].popleft()
+                    call['result'] = parse_result(rest)
+                    call['end'] = second
+
+    # spread the calls of each second over it, in the order they were logged
+    per_second = Counter(call['time'] for call in calls)
+    seen = Counter()
+    for call in calls:
+        call['time'] += seen[call['time']] / per_second[call['time']]
+        seen[int(call['time'])] += 1
+    return queue_size, calls[0]['time'] if calls else 0, calls
+
+
+def convert_log(filenames, output_filename, queue_size_per_producer=0):
+    """
+    Converts marketplace.log files (see parse_log) to a trace. The ids returned by
+    register_producer and new_cart are not logged: they are given as the Marketplace
+    gives them, reusing the released ones first.
+
+    :returns the number of calls converted
+    """
+    queue_size, started, calls = parse_log(filenames)
+    writer = TraceWriter(output_filename, queue_size or queue_size_per_producer, started)
+    free_ids = {'producer': [], 'cart': []}  # the released ids, reused last in first out
+    next_ids = {'producer': 0, 'cart': 0}  # the lowest id never given
+    for call in calls:
+        operation = call['operation']
+        kind = CREATES.get(operation)
+        if kind is not None and call['result'] == UNKNOWN:
+            if free_ids[kind]:
+                call['result'] = free_ids[kind].pop()
+            else:
+                call['result'] = next_ids[kind]
+            call['target'] = call['result']
+        elif operation in ('unregister_producer', 'release_cart'):
+            free_ids['producer' if operation == 'unregister_producer' else 'cart'].append(
+                call['target'])
+        kind = kind or ('producer' if 'producer' in operation or 'publish' in operation
+                        else 'cart')
+        next_ids[kind] = max(next_ids[kind], call['target'] + 1)
+
+        start = int((call['time'] - started) * 1e9)
+        end = start if call['end'] is None else max(start, int((call['end'] - started) * 1e9))
+        writer.add_call(OPERATIONS.index(operation),
+                        ((kind, call['target']), '{}{}'.format(kind, call['target'])),
+                        start, end, call['target'], call['product'], call['quantity'],
+                        call['timeout'], call['result'])
+    writer.close()
+    return len(calls)
+
+
+class TracedIds:
+    """
+    The ids the marketplace gave to the producers and the carts of a trace, set by the
+    replay thread that created them and read by any other
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.ids = {'producer': {}, 'cart': {}}  # a dict<traced id, id in the marketplace>
+        self.condition = threading.Condition()  # signaled when an id is mapped
+
+    def set(self, kind, traced_id, marketplace_id):
+        """
+        Maps a traced producer or cart ('producer' or 'cart' kind) to its marketplace id
+        """
+        with self.condition:
+            self.ids[kind][traced_id] = marketplace_id
+            self.condition.notify_all()
+
+    def get(self, kind, traced_id):
+        """
+        Returns the id in the marketplace of a traced producer or cart, waiting for the
+        call creating it to return if another thread made it
+        """
+        ids = self.ids[kind]
+        marketplace_id = ids.get(traced_id)
+        if marketplace_id is None:
+            with self.condition:
+                self.condition.wait_for(lambda: traced_id in ids)
+                marketplace_id = ids[traced_id]
+        return marketplace_id
+
+
+class ReplayResults:
+    """
+    What the threads of a replay measured: the latency of the replayed calls and the
+    calls whose result differs from the trace or that raised, per operation
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.latencies = {name: Histogram() for name in OPERATIONS}  # of the replayed calls
+        self.mismatches = {}  # a dict<operation, calls whose result differs from the trace>
+        self.errors = {}  # a dict<operation, calls that raised>
+        self.lock = threading.Lock()  # guards the two dicts above
+
+    def count(self, counters, operation):
+        """
+        Counts a call of an operation in mismatches or errors
+        """
+        with self.lock:
+            counters[operation] = counters.get(operation, 0) + 1
+
+
+class TraceReplayer:
+    """
+    Replays a trace on a Marketplace: every traced thread gets a thread that makes its
+    calls, with the producer and cart ids of the trace mapped to those the marketplace
+    gives. At full speed, the calls start in the order they started in the trace, without
+    waiting in between; at the original pace, each one starts as long after the start of
+    the replay as it did after the start of the trace.
+    """
+
+    def __init__(self, trace, marketplace, pace='full', max_timeout=1.0):
+        """
+        Constructor
+
+        :type trace: Dict
+        :param trace: the trace, as read_trace returns it
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace the calls are made to
+
+        :type pace: String
+        :param pace: 'full' or 'original'
+
+        :type max_timeout: Float
+        :param max_timeout: the longest a call waits in the marketplace. The stock a
+        traced call waited for may never come in another interleaving.
+        """
+        self.trace = trace
+        self.marketplace = marketplace
+        self.pace = pace
+        self.max_timeout = max_timeout
+        self.ids = TracedIds()
+        self.results = ReplayResults()
+        # a dict<traced thread, Semaphore> released when the thread's next call is due
+        self.turns = {}
+        self.owners = []  # the thread of each call, in the order they started
+        self.started = None  # time.perf_counter() when the replay started
+
+    def run(self):
+        """
+        Replays the trace
+
+        :returns a dict with the number of 'calls', the 'wall_s' of the replay and the
+        'traced_s' it took when traced, the 'mismatches' and the 'errors' per operation
+        and the 'latency' of each operation, replayed and 'traced'
+        """
+        calls = sorted(self.trace['calls'], key=lambda call: call.start)
+        self._map_missing_ids(calls)
+
+        threads_calls = {}  # a dict<traced thread, list<(turn, call)>>
+        for turn, call in enumerate(calls):
+            threads_calls.setdefault(call.thread, []).append((turn, call))
+            self.owners.append(call.thread)
+        self.turns = {thread: threading.Semaphore(0) for thread in threads_calls}
+        threads = [threading.Thread(target=self._replay_thread, args=(thread_calls,),
+                                    name=self._thread_name(thread), daemon=True)
+                   for thread, thread_calls in threads_calls.items()]
+
+        self.started = time.perf_counter()
+        if calls:
+            self.turns[self.owners[0]].release()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - self.started
+
+        traced = {name: Histogram() for name in OPERATIONS}
+        for call in calls:
+            traced[call.operation].record(call.end - call.start)
+        return {
+            'calls': len(calls),
+            'wall_s': wall,
+            'traced_s': (max((call.end for call in calls), default=0)
+                         - min((call.start for call in calls), default=0)) / 1e9,
+            'mismatches': self.results.mismatches,
+            'errors': self.results.errors,
+            'latency': {name: histogram.snapshot()
+                        for name, histogram in self.results.latencies.items()
+                        if histogram.count},
+            'traced': {name: histogram.snapshot()
+                       for name, histogram in traced.items() if histogram.count},
+        }
+
+    def _thread_name(self, thread):
+        """
+        Returns the name of a traced thread
+        """
+        threads = self.trace['threads']
+        return threads[thread] if thread < len(threads) else 'thread{}'.format(thread)
+
+    def _map_missing_ids(self, calls):
+        """
+        Gives an id in the marketplace to the producers and carts that are used in the
+        trace without having been created in it, as when it starts in the middle of a run
+        """
+        created = {'producer': set(), 'cart': set()}
+        for call in calls:
+            kind = CREATES.get(call.operation)
+            if kind is not None:
+                created[kind].add(call.result)
+                continue
+            kind = self._target_kind(call.operation)
+            if call.target not in created[kind]:
+                created[kind].add(call.target)
+                if kind == 'producer':
+                    self.ids.set(kind, call.target, self.marketplace.register_producer())
+                else:
+                    self.ids.set(kind, call.target, self.marketplace.new_cart())
+
+    @staticmethod
+    def _target_kind(operation):
+        """
+        Returns whether the target of an operation is a producer or a cart
+        """
+        return 'producer' if 'producer' in operation or 'publish' in operation else 'cart'
+
+    def _replay_thread(self, thread_calls):
+        """
+        Makes the calls of a traced thread
+        """
+        for turn, call in thread_calls:
+            if self.pace == 'original':
+                delay = self.started + call.start / 1e9 - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                # wait for the calls started before it to start, then let the next one
+                self.turns[call.thread].acquire()
+                if turn + 1 < len(self.owners):
+                    self.turns[self.owners[turn + 1]].release()
+
+            try:
+                self._replay_call(call)
+            except Exception:  # pylint: disable=broad-except
+                self.results.count(self.results.errors, call.operation)
+
+    def _replay_call(self, call):
+        """
+        Makes a traced call and compares its result with the traced one
+        """
+        marketplace = self.marketplace
+        operation = call.operation
+        product = self.trace['products'][call.product] if call.product >= 0 else None
+        timeout = self.max_timeout if call.timeout is None \
+            else min(call.timeout, self.max_timeout)
+
+        start = time.perf_counter_ns()
+        if operation in CREATES:
+            self.ids.set(CREATES[operation], call.result, getattr(marketplace, operation)())
+            result = call.result
+        else:
+            target = self.ids.get(self._target_kind(operation), call.target)
+            if operation in ('publish_many', 'add_to_cart'):
+                result = getattr(marketplace, operation)(target, product, call.quantity,
+                                                         timeout)
+            elif operation == 'publish':
+                result = marketplace.publish(target, product, timeout)
+            elif operation == 'remove_from_cart':
+                result = marketplace.remove_from_cart(target, product, call.quantity)
+            else:
+                result = getattr(marketplace, operation)(target)
+        self.results.latencies[operation].record(time.perf_counter_ns() - start)
+
+        if isinstance(result, list):
+            result = len(result)
+        result = int(result or 0)
+        if call.result not in (UNKNOWN, result):
+            self.results.count(self.results.mismatches, operation)
+
+
+class TestTrace(unittest.TestCase):
+    """
+    Unit testing for the trace recorder, the log converter and the replayer
+    """
+
+    def setUp(self):
+        """
+        Set up a file for the trace and 2 products
+        """
+        descriptor, self.filename = tempfile.mkstemp()
+        os.close(descriptor)
+        self.tea_product = Tea("Some tea", 10, "A bit lame")
+        self.coffee_product = Coffee("Coffee", 10, "5.5", "MEDIUM")
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def run_market(self, marketplace):
+        """
+        Makes a producer and two consumers use the marketplace, one after the other
+        """
+        prod_id = marketplace.register_producer()
+        marketplace.publish_many(prod_id, self.tea_product, 3)
+        marketplace.publish(prod_id, self.coffee_product)
+        carts = [marketplace.new_cart() for _ in range(2)]
+        marketplace.add_to_cart(carts[0], self.tea_product, 2)
+        marketplace.add_to_cart(carts[1], self.coffee_product)
+        marketplace.add_to_cart(carts[1], self.coffee_product)
+        marketplace.remove_from_cart(carts[0], self.tea_product)
+        marketplace.place_order(carts[0])
+        marketplace.release_cart(carts[0])
+
+    def test_record(self):
+        """
+        Check that the outermost calls are recorded, with their arguments and results
+        """
+        from .marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        recorder = TraceRecorder(self.filename)
+        self.run_market(Marketplace(8, trace=recorder, metrics=True))
+        recorder.close()
+
+        trace = read_trace(self.filename)
+        self.assertEqual(trace['queue_size_per_producer'], 8)
+        self.assertListEqual(trace['products'], [self.tea_product, self.coffee_product])
+        self.assertListEqual(trace['threads'], [threading.current_thread().name])
+        calls = trace['calls']
+        self.assertListEqual([call.operation for call in calls], [
+            'register_producer', 'publish_many', 'publish', 'new_cart', 'new_cart',
+            'add_to_cart', 'add_to_cart', 'add_to_cart', 'remove_from_cart', 'place_order',
+            'release_cart'])
+        self.assertListEqual([call.result for call in calls],
+                             [0, 3, 1, 0, 1, 2, 1, 0, 1, 1, 0])
+        self.assertEqual((calls[5].target, calls[5].product, calls[5].quantity), (0, 0, 2))
+        self.assertTrue(all(call.start <= call.end for call in calls))
+
+    def test_replay(self):
+        """
+        Check that a trace replayed on a new marketplace gets the same results, at full
+        speed and at the original pace
+        """
+        from .marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        recorder = TraceRecorder(self.filename)
+        self.run_market(Marketplace(8, trace=recorder))
+        recorder.close()
+
+        trace = read_trace(self.filename)
+        for pace in ('full', 'original'):
+            marketplace = Marketplace(8)
+            results = TraceReplayer(trace, marketplace, pace).run()
+            self.assertEqual(results['calls'], 11)
+            self.assertDictEqual(results['mismatches'], {})
+            self.assertDictEqual(results['errors'], {})
+            self.assertEqual(results['latency']['add_to_cart']['count'], 3)
+            self.assertEqual(marketplace.available(self.tea_product), 2)
+
+    def test_convert_log(self):
+        """
+        Check that the calls of marketplace.log are converted, with their results
+        when the log shows them, and can be replayed
+        """
+        # pylint: disable=import-outside-toplevel
+        import logging
+        from .log_config import configure_logging, TRACE_LOGGER
+        from .marketplace import Marketplace
+        log_filename = self.filename + '.log'
+        try:
+            configure_logging(filename=log_filename, max_bytes=0)
+            self.run_market(Marketplace(8))
+            configure_logging("off")
+            self.assertEqual(convert_log([log_filename], self.filename), 11)
+        finally:
+            logging.getLogger(TRACE_LOGGER).setLevel(logging.NOTSET)
+            os.remove(log_filename)
+
+        trace = read_trace(self.filename)
+        self.assertEqual(trace['queue_size_per_producer'], 8)
+        self.assertListEqual(trace['products'], [self.tea_product, self.coffee_product])
+        self.assertListEqual(trace['threads'], ['producer0', 'cart0', 'cart1'])
+        calls = trace['calls']
+        self.assertListEqual([call.result for call in calls],
+                             [0, 3, 1, 0, 1, 2, 1, 0, 1, UNKNOWN, UNKNOWN])
+
+        results = TraceReplayer(trace, Marketplace(8)).run()
+        self.assertDictEqual(results['mismatches'], {})
+        self.assertDictEqual(results['errors'], {})
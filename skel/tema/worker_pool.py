@@ -0,0 +1,171 @@
+"""
+This module runs agents, such as the consumers, on a fixed number of threads.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+import heapq
+import itertools
+import time
+import traceback
+import unittest
+from threading import Condition, Lock, Thread
+
+
+class WorkerPool:
+    """
+    Runs agents, generators that yield the number of seconds they sleep (as for
+    simulation.Simulation), on a fixed number of worker threads. A sleeping agent only
+    waits in a queue of timers, so the number of threads does not grow with the number
+    of agents and an agent that has to wait leaves its worker to the others.
+    """
+
+    def __init__(self, workers):
+        """
+        Constructor
+
+        :type workers: Int
+        :param workers: the number of worker threads
+        """
+        self.condition = Condition()  # guards the attributes below, signaled on changes
+        self.events = []  # a heap of (time the agent is due, sequence number, agent)
+        self.sequence = itertools.count()  # orders the agents due at the same time
+        self.running = 0  # the number of agents that did not finish
+        self.closed = False  # set once no more agents are spawned
+        self.threads = [Thread(target=self._work, name='worker{}'.format(idx), daemon=True)
+                        for idx in range(max(1, workers))]
+
+    def start(self):
+        """
+        Starts the worker threads
+        """
+        for thread in self.threads:
+            thread.start()
+
+    def spawn(self, agent):
+        """
+        Adds an agent, whose first step runs as soon as a worker is free
+        """
+        with self.condition:
+            heapq.heappush(self.events, (time.monotonic(), next(self.sequence), agent))
+            self.running += 1
+            self.condition.notify()
+
+    def join(self):
+        """
+        Waits until every agent spawned finished, then stops the workers
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def _next_agent(self):
+        """
+        Waits until an agent is due and takes it out of the queue
+
+        :returns the agent, or None once all of them finished
+        """
+        with self.condition:
+            while True:
+                if self.closed and not self.running:
+                    return None
+                if not self.events:
+                    self.condition.wait()
+                    continue
+
+                wait = self.events[0][0] - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+
+                _, _, agent = heapq.heappop(self.events)
+                # another agent may be due already, for another worker
+                if self.events and self.events[0][0] <= time.monotonic():
+                    self.condition.notify()
+                return agent
+
+    def _work(self):
+        """
+        The loop of a worker thread: runs one step of the next agent due
+        """
+        while True:
+            agent = self._next_agent()
+            if agent is None:
+                return
+
+            try:
+                delay = next(agent)
+            except StopIteration:
+                delay = None
+            except Exception:  # pylint: disable=broad-except
+                # as for a thread that dies, the agent is reported and the others go on
+                traceback.print_exc()
+                delay = None
+
+            with self.condition:
+                if delay is None:
+                    self.running -= 1
+                    if self.closed and not self.running:
+                        self.condition.notify_all()
+                else:
+                    heapq.heappush(self.events, (time.monotonic() + delay,
+                                                 next(self.sequence), agent))
+                    self.condition.notify()
+
+
+class TestWorkerPool(unittest.TestCase):
+    """
+    Unit testing for the worker pool
+    """
+
+    def test_bounded_threads(self):
+        """
+        Check that every agent finishes and no more run at once than there are workers
+        """
+        lock = Lock()
+        active = [0, 0]  # the agents in a step now, the most ever
+
+        def agent():
+            for _ in range(3):
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                time.sleep(0.001)
+                with lock:
+                    active[0] -= 1
+                yield 0.001
+
+        pool = WorkerPool(3)
+        pool.start()
+        agents = [agent() for _ in range(20)]
+        for each in agents:
+            pool.spawn(each)
+        pool.join()
+
+        self.assertLessEqual(active[1], 3)
+        self.assertEqual(pool.running, 0)
+        for each in agents:
+            self.assertIsNone(next(each, None))
+
+    def test_sleeping_agents_free_the_worker(self):
+        """
+        Check that agents sleeping at the same time share a single worker
+        """
+        finished = []
+
+        def agent(name):
+            yield 0.2
+            finished.append(name)
+
+        pool = WorkerPool(1)
+        pool.start()
+        start = time.monotonic()
+        pool.spawn(agent('a'))
+        pool.spawn(agent('b'))
+        pool.join()
+
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertListEqual(finished, ['a', 'b'])
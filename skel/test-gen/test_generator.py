@@ -11,12 +11,15 @@ Script input
     - max number of carts per consumer
     - is basic test
     - should have removal operations
+    - --stream: write the input and the aggregated expected output incrementally
 """
 import argparse
 import random
+from collections import Counter
 from json import loads, dumps
 
 from tema.product import *  # pylint: disable=wildcard-import, unused-wildcard-import
+from tema.scenario import build_products
 from test_utils import *  # pylint: disable=wildcard-import, unused-wildcard-import
 
 
@@ -33,6 +36,10 @@ def generate_test():
         print("Invalid arguments")
     print(cmdline_arguments)
 
+    if cmdline_arguments[ARG_STREAM]:
+        generate_test_stream(cmdline_arguments)
+        return
+
     products = generate_products(cmdline_arguments[ARG_PRODUCTS])
     producers = generate_producers(cmdline_arguments[ARG_PRODUCERS],
                                    products, cmdline_arguments[ARG_IS_BASIC])
@@ -64,6 +71,78 @@ def generate_test():
     generate_in_out_test_files(cmdline_arguments[ARG_TEST_NAME])
 
 
+def generate_test_stream(cmdline_arguments):
+    """
+    Generates the same test as generate_test, but writes the input file and the expected
+    output one consumer at a time, so memory does not grow with the number of consumers.
+    The expected output is aggregated, one "<consumer> bought <count> x <product>" line per
+    consumer and product, in tests/{test_name}.ref.counts. No .json file is written.
+
+    :return: nothing
+    """
+    products = generate_products(cmdline_arguments[ARG_PRODUCTS])
+    producers = generate_producers(cmdline_arguments[ARG_PRODUCERS],
+                                   products, cmdline_arguments[ARG_IS_BASIC])
+
+    for prod_id in list(products.keys()):
+        if not products[prod_id]["is_produced"]:
+            del products[prod_id]
+
+    consumers = iter_consumers(cmdline_arguments[ARG_CONSUMERS],
+                               products,
+                               cmdline_arguments[ARG_MIN_CARTS],
+                               cmdline_arguments[ARG_MAX_CARTS],
+                               cmdline_arguments[ARG_IS_BASIC],
+                               cmdline_arguments[ARG_SUPPORTS_REMOVAL])
+    marketplace = generate_marketplace(cmdline_arguments[ARG_MARKETPLACE_Q])
+
+    for prod_id in products.keys():
+        del products[prod_id]["is_produced"]
+
+    # every product is rendered once, not once per expected unit
+    product_reprs = {k: str(product) for k, product in build_products(products).items()}
+
+    test_name = cmdline_arguments[ARG_TEST_NAME]
+    with open(f'{TESTS_DIR}/{test_name}.in', 'w') as input_file, \
+            open(f'{TESTS_DIR}/{test_name}.ref.counts', 'w') as counts_file:
+        # products and marketplace first, so a reader can set up before the consumers
+        input_file.write(f'{{"{ARG_PRODUCTS}": {dumps(products)},\n')
+        input_file.write(f'"marketplace": {dumps(marketplace)},\n')
+        write_json_list(input_file, ARG_PRODUCERS, producers)
+        input_file.write(',\n')
+
+        def consumer_inputs():
+            for consumer in consumers:
+                expected = Counter()
+                for cart in consumer['carts']:
+                    expected.update(cart['expected_cart'])
+                counts_file.writelines(f'{consumer["name"]} bought {count} x {product_reprs[k]}\n'
+                                       for k, count in expected.items())
+
+                consumer['carts'] = [cart['ops'] for cart in consumer['carts']]
+                yield consumer
+
+        write_json_list(input_file, ARG_CONSUMERS, consumer_inputs())
+        input_file.write('}\n')
+
+
+def write_json_list(output_file, key, items):
+    """
+    Writes '"key": [...]' with one JSON item per line, without building the list
+    :param output_file: the file to write to
+    :param key: the name of the list
+    :param items: an iterable of JSON serializable items
+    :return: nothing
+    """
+    output_file.write(f'"{key}": [')
+    separator = '\n'
+    for item in items:
+        output_file.write(separator)
+        output_file.write(dumps(item))
+        separator = ',\n'
+    output_file.write('\n]')
+
+
 def parse_input():
     """
     Parses command line input and returns a dictionary with all parameters.
@@ -93,6 +172,8 @@ def parse_input():
                         help="True if it is a simple test, False otherwise")
     parser.add_argument(ARG_SUPPORTS_REMOVAL, type=bool, nargs='?', default=True,
                         help="True if the consumer can remove products from cart, False otherwise")
+    parser.add_argument("--" + ARG_STREAM, action="store_true",
+                        help="write the .in and an aggregated .ref.counts file incrementally")
 
     return parser.parse_args().__dict__
 
@@ -142,9 +223,16 @@ def generate_products(count):
     # to avoid random duplicates
     coffee_names_copy = list(COFFEE_NAMES)
     tea_list_copy = list(TEA_NAMES_TYPES.keys())
+    tea_types = dict(TEA_NAMES_TYPES)
+    coffee_round = tea_round = 1
 
     for i in range(count):
         if i < count / 2:
+            if not coffee_names_copy:
+                # the catalog is used up, continue with numbered copies of it
+                coffee_round += 1
+                coffee_names_copy = [f"{name} {coffee_round}" for name in COFFEE_NAMES]
+
             product = {"product_type": "Coffee"}
             name = random.choice(coffee_names_copy)
             coffee_names_copy.remove(name)
@@ -152,10 +240,15 @@ def generate_products(count):
             product["acidity"] = round(random.uniform(MIN_ACIDITY, MAX_ACIDITY), 2)
             product["roast_level"] = random.choice(ROAST_LEVEL)
         else:
+            if not tea_list_copy:
+                tea_round += 1
+                tea_list_copy = [f"{name} {tea_round}" for name in TEA_NAMES_TYPES]
+                tea_types.update(zip(tea_list_copy, TEA_NAMES_TYPES.values()))
+
             product = {"product_type": "Tea"}
             tea = random.choice(tea_list_copy)
             product["name"] = tea
-            product["type"] = TEA_NAMES_TYPES[tea]
+            product["type"] = tea_types[tea]
             tea_list_copy.remove(tea)
 
         product["price"] = random.randint(1, 10)
@@ -204,7 +297,7 @@ def generate_producers(count, products, basic_test):
         producer = {"name": PRODUCER_NAME_PREFIX + str(i + 1)}
 
         num_products_per_producer = random.randint(1, len(products.keys()))
-        products_to_produce = random.sample(products.keys(), num_products_per_producer)
+        products_to_produce = random.sample(list(products.keys()), num_products_per_producer)
 
         products_list = [[x, random.randint(1, max_quantity), round(random.uniform(0.05, 0.4), 2)]
                          for x in products_to_produce]
@@ -222,6 +315,16 @@ def generate_producers(count, products, basic_test):
 
 def generate_consumers(count, products, min_cart, max_cart,
                        has_remove_operation=True, basic_test=True):
+    """
+    Generates all the consumers, see iter_consumers
+    :return: list of consumers
+    """
+    return list(iter_consumers(count, products, min_cart, max_cart,
+                               has_remove_operation, basic_test))
+
+
+def iter_consumers(count, products, min_cart, max_cart,
+                   has_remove_operation=True, basic_test=True):
     """ Example:
     [
         {
@@ -240,9 +343,9 @@ def generate_consumers(count, products, min_cart, max_cart,
             ]
         }
     ],
-    :return: list of consumers
+    :return: a generator of consumers, each one generated when it is requested
     """
-    consumers = []
+    product_keys = list(products.keys())
     max_operations_per_cart = 3 if basic_test else 10
     max_quantity = 5 if basic_test else 10
 
@@ -256,11 +359,10 @@ def generate_consumers(count, products, min_cart, max_cart,
         for _ in range(num_carts):
             num_operations = random.randint(1, max_operations_per_cart)
 
-            print(products.keys(), " ", num_operations)
             if len(products) < num_operations:
                 num_operations = len(products)
 
-            product_ids = random.sample(products.keys(), num_operations)
+            product_ids = random.sample(product_keys, num_operations)
             operations = [{"type": ADD_TO_CART_OP, "product": x,
                            "quantity": random.randint(1, max_quantity)} for x in product_ids]
 
@@ -277,8 +379,7 @@ def generate_consumers(count, products, min_cart, max_cart,
             consumer["carts"].append({"ops": operations,
                                       "expected_cart": compute_expected_cart(operations)})
 
-        consumers.append(consumer)
-    return consumers
+        yield consumer
 
 
 def compute_expected_cart(operations):
@@ -327,7 +428,6 @@ def generate_in_out_test_files(test_name):
 
     lines = []
     for consumer in conf['consumers']:
-        print("consumer" + str(consumer))
         for cart in consumer['carts']:
             for product, count in cart['expected_cart'].items():
                 lines += ([f'{consumer["name"]} bought {product}'] * count)
@@ -6,13 +6,109 @@ Assignment 1
 March 2020
 """
 
-import sys
-from json import loads
+import argparse
+import json
+import logging
 
-from tema.producer import Producer
-from tema.consumer import Consumer
-from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
+from tema.engines import ENGINES, run_market
+from tema.log_config import configure_logging, LOG_MODES
+from tema.persistence import WriteAheadLog
+from tema.profiling import Profiler
+from tema.trace import TraceRecorder
+from tema.retry import RETRY_POLICIES
+from tema.scenario import load_market_config
+from tema.selection import SELECTION_POLICIES
+
+
+def parse_args():
+    """
+        Parse the command line: the input file and the run options
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", help="the market configuration (tests/*.in, or a "
+                                           "binary scenario written by convert_scenario.py)")
+    parser.add_argument("--blocking", action="store_true",
+                        help="producers and consumers wait in the marketplace for room/stock "
+                             "instead of sleeping between retries")
+    parser.add_argument("--engine", choices=ENGINES, default="threads",
+                        help="run producers and consumers as OS threads, as coroutines "
+                             "in a single asyncio event loop, as threads in worker "
+                             "processes that each own a shard of the products, or as a "
+                             "simulation on a virtual clock, where sleeping takes no time")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="run the consumers of the threads engine on this many worker "
+                             "threads, which they leave while sleeping between retries, "
+                             "instead of a thread per consumer")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="number of worker processes for the processes engine "
+                             "(default: one per CPU)")
+    parser.add_argument("--time-limit", type=float, default=None, metavar="SECONDS",
+                        help="virtual seconds after which the sim engine fails, so "
+                             "a deadlocked scenario does not run forever (default: "
+                             "derived from the scenario)")
+    parser.add_argument("--aggregate", action="store_true",
+                        help="print one '<consumer> bought <count> x <product>' line per "
+                             "product of an order instead of one line per unit")
+    parser.add_argument("--selection", choices=SELECTION_POLICIES, default="first-fit",
+                        help="which producer's units a consumer gets when several hold "
+                             "the product")
+    parser.add_argument("--retry", choices=RETRY_POLICIES, default="fixed",
+                        help="sleep the configured wait between retries, or back off "
+                             "exponentially with jitter, guided by the marketplace's "
+                             "estimate of when the operation could succeed")
+    parser.add_argument("--log", choices=LOG_MODES, default="sync",
+                        help="write the marketplace trace from the calling threads, from a "
+                             "background thread, or disable it")
+    parser.add_argument("--log-max-bytes", type=int, default=10000,
+                        help="size at which marketplace.log is rotated (0: never)")
+    parser.add_argument("--log-sample", type=int, default=1, metavar="N",
+                        help="keep one trace record out of every N")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="measure the marketplace and dump its metrics_snapshot() "
+                             "as JSON to FILE at exit (threads and asyncio engines)")
+    parser.add_argument("--wal", metavar="DIR",
+                        help="log the marketplace's changes to a write-ahead log in DIR, "
+                             "which persistence.open_marketplace recovers (threads and sim "
+                             "engines)")
+    parser.add_argument("--wal-sync", action="store_true",
+                        help="with --wal, every operation returns once its records are "
+                             "on disk")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record the calls to the marketplace in a binary trace, "
+                             "which replay_trace.py replays (threads and sim engines)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="record the waits for the marketplace's and the log's locks "
+                             "and how long they were held, per lock and call site, and "
+                             "write the report to FILE, as JSON if it ends with .json "
+                             "(threads and sim engines)")
+    parser.add_argument("--profile-cpu", action="store_true",
+                        help="with --profile, sample the stacks of the threads using the "
+                             "CPU")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile, trace the allocations with tracemalloc")
+
+    args = parser.parse_args()
+    if args.metrics and args.engine == "processes":
+        parser.error("--metrics is not supported by the processes engine")
+    if args.selection != "first-fit" and args.engine == "processes":
+        parser.error("--selection is not supported by the processes engine")
+    if args.workers is not None and (args.engine != "threads" or args.blocking):
+        parser.error("--workers is only supported by the threads engine, without --blocking")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.blocking and args.engine == "sim":
+        parser.error("--blocking is not supported by the sim engine")
+    if args.wal and args.engine not in ("threads", "sim"):
+        parser.error("--wal is only supported by the threads and sim engines")
+    if args.trace and args.engine not in ("threads", "sim"):
+        parser.error("--trace is only supported by the threads and sim engines")
+    if args.wal_sync and not args.wal:
+        parser.error("--wal-sync needs --wal")
+    if args.profile and args.engine not in ("threads", "sim"):
+        parser.error("--profile is only supported by the threads and sim engines")
+    if (args.profile_cpu or args.profile_memory) and not args.profile:
+        parser.error("--profile-cpu and --profile-memory need --profile")
+    return args
 
 
 def main():
@@ -20,54 +116,50 @@ def main():
         Convert the market_configuration input file into specific models:
         Producer, Consumer, Marketplace
     """
-    try:
-        filename = sys.argv[1]
-    except IndexError:
-        print("no input file specified")
-        raise SystemExit
-
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
-
-    # turn product definitions into actual products
-    products = {}
-
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
+    args = parse_args()
+    log_listener = configure_logging(args.log, max_bytes=args.log_max_bytes,
+                                     sample_every=args.log_sample)
+
+    # the consumers are read from the file while they are started
+    market_config = load_market_config(args.input_file)
+
+    if args.metrics:
+        market_config['marketplace']['metrics'] = True
+    if args.selection != "first-fit":
+        market_config['marketplace']['selection'] = args.selection
+    wal = None
+    if args.wal:
+        wal = market_config['marketplace']['wal'] = WriteAheadLog(args.wal, sync=args.wal_sync)
+    recorder = None
+    if args.trace:
+        recorder = market_config['marketplace']['trace'] = TraceRecorder(args.trace)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(cpu=args.profile_cpu, memory=args.profile_memory)
+        market_config['marketplace']['profile'] = profiler.locks
+        profiler.watch_handlers(logging.getLogger().handlers)
+        if log_listener is not None:
+            profiler.watch_handlers(log_listener.handlers)
+        profiler.start()
 
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
-
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
-
-    # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
-
-    # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
-                 for p_market_config in market_config['producers']]
-
-    for producer in producers:
-        producer.start()
-
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
-                 for c_market_config in market_config['consumers']]
-
-    for consumer in consumers:
-        consumer.start()
-
-    for consumer in consumers:
-        consumer.join()
+    try:
+        marketplace = run_market(args.engine, market_config, args.blocking, args.shards,
+                                 args.time_limit, args.aggregate, args.retry, args.workers)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if wal is not None:
+            wal.close()
+        if recorder is not None:
+            recorder.close()
+        if log_listener is not None:
+            log_listener.stop()
+
+    if args.metrics:
+        with open(args.metrics, 'w') as metrics_file:
+            json.dump(marketplace.metrics_snapshot(), metrics_file, indent=4)
+    if args.profile:
+        profiler.write_report(args.profile)
 
 
 if __name__ == '__main__':